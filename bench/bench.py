@@ -0,0 +1,283 @@
+"""
+Benchmarks every stage of a search on a synthetic corpus.
+
+    python bench/bench.py run --size medium --out current.json
+    python bench/bench.py compare baseline.json current.json
+
+Each metric is timed `repeat` times and reported as median and minimum
+seconds. `compare` exits with status 1 when a median got slower than the
+baseline by more than the tolerance.
+"""
+
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import fire
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+from corpus import EXTENSIONS, SIZES, CorpusSpec, corpus_files, generate  # noqa: E402
+
+from codesearch.config import determine_included_files, load_config  # noqa: E402
+from codesearch.handlers import (  # noqa: E402
+    fast_handlers,
+    handler_for_extension,
+    symbol_cache,
+)
+from codesearch.searcher import CodeSearch  # noqa: E402
+
+# Patterns searched by the query benchmarks: a word used all over the corpus,
+# an anchored prefix, and everything (nothing for the prefilter to go on)
+QUERIES = {"literal": "load", "anchored": "^parse_", "all": "."}
+# Differences below this many seconds are noise, whatever the ratio
+MIN_DIFFERENCE = 0.002
+# Seconds to wait for the benchmarked daemon to listen
+DAEMON_START_TIMEOUT = 30
+
+
+def timed(fn: Callable, repeat: int) -> Dict[str, float]:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"median": statistics.median(runs), "min": min(runs), "runs": len(runs)}
+
+
+def consume(results):
+    for _ in results:
+        pass
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_parse(root, repeat: int, metrics: Dict):
+    for ext, files in sorted(corpus_files(root).items()):
+        name = ext.lstrip(".")
+        variants = [("parse", handler_for_extension(ext))]
+        if ext in fast_handlers:
+            variants.append(("parse_fast", handler_for_extension(ext, fast=True)))
+        for metric, handler in variants:
+
+            def parse_all(handler=handler):
+                for f in files:
+                    handler.index_file(f)
+
+            metrics[f"{metric}.{name}"] = timed(parse_all, repeat)
+
+
+def missing_languages(spec: CorpusSpec) -> Dict[str, str]:
+    """Languages of the mix whose handler can't be loaded, with the reason"""
+    res = {}
+    for lang in spec.mix:
+        try:
+            handler_for_extension(EXTENSIONS[lang])
+        except ImportError as e:
+            # Native handlers that weren't built
+            res[lang] = str(e)
+    return res
+
+
+def bench_queries(searcher: CodeSearch, mode: str, repeat: int, metrics: Dict):
+    for kind in ("fun", "cls", "ref"):
+        for label, pattern in QUERIES.items():
+            if kind == "ref" and label == "all":
+                # References to everything is mostly a test of the terminal
+                continue
+
+            def query(kind=kind, pattern=pattern):
+                if mode == "scan":
+                    # Every file is parsed again, as in a one-off search
+                    symbol_cache.clear()
+                consume(searcher.search(kind, pattern))
+
+            metrics[f"query.{kind}.{label}.{mode}"] = timed(query, repeat)
+
+
+def bench_index(root, jobs: int, repeat: int, metrics: Dict):
+    metrics["index.build"] = timed(
+        lambda: CodeSearch(root, use_index=True, persist_index=False, jobs=jobs),
+        repeat,
+    )
+    # Built once so that the timed runs only load the stored symbols
+    CodeSearch(root, use_index=True, persist_index=True, jobs=jobs).close()
+    metrics["index.load_persisted"] = timed(
+        lambda: CodeSearch(root, use_index=True, persist_index=True, jobs=jobs),
+        repeat,
+    )
+    shutil.rmtree(os.path.join(root, ".codesearch"), ignore_errors=True)
+
+
+def bench_startup(repeat: int, metrics: Dict):
+    """One-off search in an empty directory: interpreter start, imports and config"""
+    import codesearch
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(codesearch.__file__))
+        ),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        command = [sys.executable, "-m", "codesearch", "fun", "x", "--dir", tmp]
+        metrics["startup"] = timed(
+            lambda: subprocess.run(command, env=env, check=True, capture_output=True),
+            repeat,
+        )
+
+
+def bench_daemon(root, repeat: int, metrics: Dict):
+    from codesearch.daemon import CodeSearchClient, CodeSearchDaemon, DaemonAddress
+    from codesearch.protocol import DaemonSearchReqMsg
+
+    with tempfile.TemporaryDirectory() as tmp:
+        address = DaemonAddress(socket_path=os.path.join(tmp, "bench.sock"))
+        daemon = CodeSearchDaemon(root, watch=False, address=address)
+        # Doesn't keep the benchmark alive if it never comes up
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        try:
+            deadline = time.monotonic() + DAEMON_START_TIMEOUT
+            while not os.path.exists(address.socket_path):
+                if not thread.is_alive() or time.monotonic() > deadline:
+                    raise RuntimeError("The daemon didn't start")
+                time.sleep(0.01)
+            client = CodeSearchClient(root, False, address=address)
+            for kind in ("fun", "cls", "ref"):
+
+                def roundtrip(kind=kind):
+                    client.sock.send_msg(
+                        DaemonSearchReqMsg(kind, [QUERIES["literal"]], root=client.root)
+                    )
+                    consume(client.results())
+
+                metrics[f"daemon.{kind}.literal"] = timed(roundtrip, repeat)
+            client.close()
+        finally:
+            daemon.stop()
+            thread.join(DAEMON_START_TIMEOUT)
+
+
+class Bench:
+    def generate(self, out, size="small", files=None, mix=None, seed=0):
+        """Writes a corpus to `out` without benchmarking it"""
+        generate(out, self._spec(size, files, mix, seed))
+
+    def run(
+        self,
+        size="small",
+        files=None,
+        mix=None,
+        seed=0,
+        repeat=5,
+        jobs=1,
+        out=None,
+        daemon=True,
+    ):
+        """Benchmarks a freshly generated corpus and prints or writes the results"""
+        spec = self._spec(size, files, mix, seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            root = str(generate(os.path.join(tmp, "corpus"), spec))
+            results = run_benchmarks(root, spec, repeat, jobs, daemon)
+        data = json.dumps(results, indent=2, sort_keys=True)
+        if out is None:
+            print(data)
+        else:
+            pathlib.Path(out).write_text(data + "\n")
+
+    def compare(self, baseline, current, tolerance=0.2):
+        """Prints the ratio of every metric, exits with 1 on regressions"""
+        base = json.loads(pathlib.Path(baseline).read_text())
+        cur = json.loads(pathlib.Path(current).read_text())
+        regressions = compare_results(base, cur, tolerance)
+        if len(regressions) != 0:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+    @staticmethod
+    def _spec(size, files, mix, seed) -> CorpusSpec:
+        if size not in SIZES:
+            raise ValueError(f"Size must be one of {', '.join(SIZES)}")
+        spec = CorpusSpec(files=SIZES[size] if files is None else files, seed=seed)
+        if mix is not None:
+            spec.mix = CorpusSpec.parse_mix(mix)
+        for lang, reason in missing_languages(spec).items():
+            print(f"Leaving {lang} out of the corpus: {reason}", file=sys.stderr)
+            del spec.mix[lang]
+        return spec
+
+
+def run_benchmarks(root, spec: CorpusSpec, repeat=5, jobs=1, daemon=True) -> Dict:
+    metrics: Dict = {}
+    config = load_config(root)
+    bench_startup(repeat, metrics)
+    metrics["walk"] = timed(lambda: determine_included_files(config, root), repeat)
+    bench_parse(root, repeat, metrics)
+    bench_index(root, jobs, repeat, metrics)
+    searcher = CodeSearch(root, jobs=jobs)
+    bench_queries(searcher, "scan", repeat, metrics)
+    # Repeated queries of a process that keeps parsed symbols around
+    bench_queries(searcher, "scan_warm", repeat, metrics)
+    searcher.close()
+    searcher = CodeSearch(root, use_index=True, persist_index=False, jobs=jobs)
+    bench_queries(searcher, "index", repeat, metrics)
+    searcher.close()
+    if daemon:
+        bench_daemon(root, repeat, metrics)
+    return {
+        "meta": {
+            "corpus": spec.to_dict(),
+            "repeat": repeat,
+            "jobs": jobs,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "revision": git_revision(),
+        },
+        "metrics": metrics,
+    }
+
+
+def compare_results(baseline: Dict, current: Dict, tolerance: float):
+    """Prints a line per metric and returns the names of the ones that regressed"""
+    if baseline["meta"]["corpus"] != current["meta"]["corpus"]:
+        print("Warning: the results were measured on different corpora")
+    regressions = []
+    for name, cur in sorted(current["metrics"].items()):
+        base = baseline["metrics"].get(name, None)
+        if base is None or "median" not in base or "median" not in cur:
+            continue
+        ratio = cur["median"] / base["median"] if base["median"] > 0 else 1.0
+        slower = (
+            ratio > 1 + tolerance and cur["median"] - base["median"] > MIN_DIFFERENCE
+        )
+        if slower:
+            regressions.append(name)
+        print(
+            f"{name:<32} {base['median']:10.4f}s {cur['median']:10.4f}s "
+            f"{ratio:6.2f}x{'  REGRESSION' if slower else ''}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    fire.Fire(Bench)
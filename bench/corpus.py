@@ -0,0 +1,186 @@
+"""
+Generates synthetic source trees for the benchmarks.
+
+The output only depends on the spec (seed included), so runs on different
+machines or revisions search exactly the same code.
+"""
+
+import os
+import pathlib
+import random
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+WORDS = [
+    "load", "save", "parse", "render", "update", "fetch", "build", "merge",
+    "index", "query", "cache", "store", "token", "stream", "buffer", "event",
+    "config", "handler", "client", "server", "session", "widget", "layout",
+    "record", "schema", "report", "filter", "matcher", "worker", "task",
+    "queue", "node", "graph", "path", "file", "entry", "symbol", "module",
+]  # fmt: skip
+
+# Preset sizes, in number of files
+SIZES = {"small": 60, "medium": 600, "large": 6000}
+EXTENSIONS = {"py": ".py", "js": ".js", "ts": ".ts", "cpp": ".cpp"}
+
+
+@dataclass
+class CorpusSpec:
+    files: int = SIZES["small"]
+    # Relative weight of every language
+    mix: Dict[str, float] = field(
+        default_factory=lambda: {"py": 5, "js": 3, "ts": 1, "cpp": 1}
+    )
+    functions: int = 12
+    classes: int = 3
+    methods: int = 4
+    # Number of directory levels files are spread over
+    depth: int = 3
+    seed: int = 0
+
+    @classmethod
+    def parse_mix(cls, mix: str) -> Dict[str, float]:
+        """Parses "py=5,js=3" into {"py": 5.0, "js": 3.0}"""
+        res = {}
+        for part in mix.split(","):
+            lang, _, weight = part.partition("=")
+            if lang not in EXTENSIONS:
+                raise ValueError(f'Unknown language "{lang}"')
+            res[lang] = float(weight or 1)
+        return res
+
+    def to_dict(self):
+        return asdict(self)
+
+
+class Names:
+    """Unique identifiers made of a couple of words"""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.used = set()
+
+    def make(self, style: str = "snake") -> str:
+        while True:
+            words = self.rng.sample(WORDS, 2)
+            if style == "camel":
+                name = words[0] + words[1].capitalize()
+            elif style == "pascal":
+                name = "".join(w.capitalize() for w in words)
+            else:
+                name = "_".join(words)
+            name += str(len(self.used))
+            if name not in self.used:
+                self.used.add(name)
+                return name
+
+
+def python_source(rng, names: Names, spec: CorpusSpec, callees: List[str]) -> str:
+    lines = ["import os", ""]
+    for _ in range(spec.classes):
+        lines.append(f"class {names.make('pascal')}:")
+        for _ in range(spec.methods):
+            lines.append(f"    def {names.make()}(self, value):")
+            lines.append(f"        return {rng.choice(callees)}(value)")
+            lines.append("")
+    for _ in range(spec.functions):
+        name = names.make()
+        callees.append(name)
+        lines.append(f"def {name}(value, count=0):")
+        lines.append(f'    """Calls {rng.choice(callees)} on the value"""')
+        lines.append(f"    result = {rng.choice(callees)}(value)")
+        lines.append("    return os.path.join(str(result), str(count))")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def js_source(rng, names: Names, spec: CorpusSpec, callees: List[str]) -> str:
+    # Also used for TypeScript files, which esprima can only read without types
+    lines = []
+    for _ in range(spec.classes):
+        lines.append(f"export class {names.make('pascal')} {{")
+        for _ in range(spec.methods):
+            lines.append(f"  {names.make('camel')}(value) {{")
+            lines.append(f"    return {rng.choice(callees)}(value);")
+            lines.append("  }")
+        lines.append("}")
+    for i in range(spec.functions):
+        name = names.make("camel")
+        callees.append(name)
+        if i % 2 == 0:
+            lines.append(f"export function {name}(value) {{")
+            lines.append(f"  // Calls {rng.choice(callees)}")
+            lines.append(f"  return `${{{rng.choice(callees)}(value)}}`;")
+            lines.append("}")
+        else:
+            lines.append(f"export const {name} = (value) =>")
+            lines.append(f"  {rng.choice(callees)}(value);")
+    return "\n".join(lines) + "\n"
+
+
+def cpp_source(rng, names: Names, spec: CorpusSpec, callees: List[str]) -> str:
+    lines = ["#include <string>", ""]
+    declared = []
+    for _ in range(spec.functions):
+        name = names.make()
+        lines.append(f"int {name}(int value);")
+        declared.append(name)
+    for _ in range(spec.classes):
+        lines.append(f"class {names.make('pascal')} {{")
+        lines.append(" public:")
+        for _ in range(spec.methods):
+            lines.append(f"  int {names.make()}(int value) {{")
+            lines.append(f"    return {rng.choice(declared)}(value);")
+            lines.append("  }")
+        lines.append("};")
+    for name in declared:
+        lines.append(f"int {name}(int value) {{")
+        lines.append(f"  return {rng.choice(declared)}(value) + 1;")
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def generate(root, spec: CorpusSpec) -> pathlib.Path:
+    """Writes a source tree under `root`, which must not exist yet"""
+    root = pathlib.Path(root)
+    root.mkdir(parents=True)
+    rng = random.Random(spec.seed)
+    names = Names(rng)
+    langs = sorted(spec.mix)
+    weights = [spec.mix[lang] for lang in langs]
+    # Functions that later files call, per language
+    callees: Dict[str, List[str]] = {
+        lang: ["print" if lang == "py" else "console.log"] for lang in langs
+    }
+    callees["cpp"] = ["abs"]
+    for i in range(spec.files):
+        lang = rng.choices(langs, weights)[0]
+        parts = [f"{rng.choice(WORDS)}{rng.randrange(4)}" for _ in range(spec.depth)]
+        d = root.joinpath(*parts)
+        d.mkdir(parents=True, exist_ok=True)
+        if lang == "py":
+            source = python_source(rng, names, spec, callees[lang])
+        elif lang == "cpp":
+            source = cpp_source(rng, names, spec, callees[lang])
+        else:
+            source = js_source(rng, names, spec, callees[lang])
+        (d / f"{names.make()}{EXTENSIONS[lang]}").write_text(source)
+    # Ignored output, only there to be skipped by the file walk
+    (root / ".gitignore").write_text("build/\n")
+    build = root / "build"
+    build.mkdir()
+    for i in range(max(1, spec.files // 10)):
+        (build / f"generated{i}.py").write_text("def generated():\n    pass\n")
+    return root
+
+
+def corpus_files(root) -> Dict[str, List[pathlib.Path]]:
+    """Generated source files by extension"""
+    res: Dict[str, List[pathlib.Path]] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in ("build", ".codesearch"))
+        for name in sorted(filenames):
+            _, ext = os.path.splitext(name)
+            if ext in EXTENSIONS.values():
+                res.setdefault(ext, []).append(pathlib.Path(dirpath, name))
+    return res
@@ -1,52 +1,317 @@
-import fire
-from codesearch.searcher import CodeSearch, print_search_results
-from codesearch.daemon import CodeSearchClient, CodeSearchDaemon
-from typing import Optional
+import contextlib
+import re
+import sys
+from codesearch.output import FORMATS, write_batch_results, write_search_results
+from codesearch.searcher import CodeSearch, InvalidDirectoryPath
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from codesearch.daemon import CodeSearchClient
 
 
 class CodeSearchCLI:
-    client: Optional[CodeSearchClient] = None
+    client: Optional["CodeSearchClient"] = None
     searcher: CodeSearch
     use_client: bool = False
     dir: str = "."
 
-    def __init__(self, dir=".", source=False, client=False):
+    def __init__(
+        self,
+        dir=".",
+        source=False,
+        client=False,
+        index=False,
+        jobs=1,
+        limit=None,
+        first=False,
+        socket=None,
+        port=None,
+        fast=False,
+        stats=False,
+        profile=None,
+        format="text",
+        color=None,
+        git=False,
+        untracked=False,
+        commit=None,
+    ):
         self.dir = dir
         self.use_client = client
         self.show_source = source
+        self.use_index = index
+        # Number of worker processes used for parsing, 0 means one per CPU core
+        self.jobs = jobs
+        # Stop searching once this many entries were found
+        self.limit = 1 if first else limit
+        # The daemon listens on a Unix domain socket unless a TCP port is given
+        self.socket = socket
+        self.port = port
+        # Find definitions with quick text scans where a language supports it
+        self.fast = fast
+        # Report where the time went on stderr once the search is done
+        self.show_stats = stats
+        # Write a cProfile dump of the search to this path
+        self.profile = profile
+        # One of FORMATS, everything but "text" prints one entry per line
+        self.format = format
+        # Colored text output, by default only when printing to a terminal
+        self.color = color
+        # List files with git instead of walking the tree, with the untracked ones or not
+        self.git = git
+        self.untracked = untracked
+        # Search the files of this commit (or any revision naming one) instead
+        self.commit = commit
+
+    def daemon_address(self):
+        # The daemon modules (asyncio, sockets) are only loaded when talking to a daemon
+        from codesearch.daemon import DaemonAddress
+
+        return DaemonAddress(socket_path=self.socket, port=self.port)
 
-    def init_searcher(self):
+    def init_searcher(self, stats=None):
         if self.use_client:
-            self.client = CodeSearchClient(self.dir, self.show_source)
+            if self.git or self.untracked or self.commit is not None:
+                raise ValueError("The daemon searches the files of the working tree")
+            from codesearch.daemon import CodeSearchClient
+
+            self.client = CodeSearchClient(
+                self.dir, self.show_source, address=self.daemon_address()
+            )
         else:
-            self.searcher = CodeSearch(self.dir, self.show_source)
+            self.searcher = CodeSearch(
+                self.dir,
+                self.show_source,
+                use_index=self.use_index,
+                jobs=self.jobs,
+                fast=self.fast,
+                stats=stats,
+                git=self.git,
+                untracked=self.untracked,
+                commit=self.commit,
+            )
 
-    def cls(self, classname):
-        self.init_searcher()
+    def _search(self, handler_key, pattern):
+        self._profiled(self._run_search, handler_key, pattern)
+
+    def _profiled(self, run, *args):
+        if self.profile is None:
+            run(*args)
+            return
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(self.profile)
+            print(f'Profile written to "{self.profile}"', file=sys.stderr)
+
+    def _start(self):
+        """Sets up the searcher, returns the stats to fill when asked for"""
+        if self.format not in FORMATS:
+            raise ValueError(
+                f'Unknown format "{self.format}", use one of {", ".join(FORMATS)}'
+            )
+        stats = None
+        if self.show_stats:
+            from codesearch.stats import SearchStats
+
+            stats = SearchStats()
+        self.init_searcher(stats)
+        return stats
+
+    def _run_search(self, handler_key, pattern):
+        stats = self._start()
         if self.client is not None:
-            self.client.exec("cls", classname)
+            results = self.client.search(handler_key, pattern, limit=self.limit)
         else:
-            print_search_results(self.searcher.cls(classname))
+            results = self.searcher.search(handler_key, pattern, limit=self.limit)
+        if stats is not None:
+            from codesearch.stats import timed_iter
 
-    def fun(self, funname):
-        self.init_searcher()
-        if self.client is not None:
-            self.client.exec("fun", funname)
+            results = timed_iter(stats, results, "search", "output")
+        write_search_results(results, self.format, self.color)
+        if stats is not None:
+            print(stats.report(), file=sys.stderr)
+
+    def _run_batch(self, file):
+        if file == "-":
+            queries = parse_queries(sys.stdin)
         else:
-            print_search_results(self.searcher.fun(funname))
+            with open(file) as f:
+                queries = parse_queries(f)
+        stats = self._start()
+        phase = stats.phase if stats is not None else lambda _: contextlib.nullcontext()
+        with phase("search"):
+            if self.client is not None:
+                results = self.client.search_many(queries, limit=self.limit)
+            else:
+                results = self.searcher.search_many(queries, limit=self.limit)
+        with phase("output"):
+            write_batch_results(queries, results, self.format, self.color)
+        if stats is not None:
+            print(stats.report(), file=sys.stderr)
+
+    def cls(self, classname):
+        self._search("cls", classname)
+
+    def fun(self, funname):
+        self._search("fun", funname)
 
     def ref(self, symname):
-        self.init_searcher()
-        if self.client is not None:
-            self.client.exec("ref", symname)
-        else:
-            print_search_results(self.searcher.ref(symname))
+        self._search("ref", symname)
+
+    def find(self, query):
+        """Fuzzy search for functions and classes, best matches first (--limit of them)"""
+        self._search("find", query)
+
+    def batch(self, file="-"):
+        """
+        Runs many queries in one pass over the tree. `file` (stdin by default)
+        holds a `<fun|cls|ref|find> <pattern>` query per line.
+        """
+        self._profiled(self._run_batch, file)
+
+    def daemon(self, watch=True, memory=None):
+        """`memory` is the budget in MB for the indexes of all served projects"""
+        from codesearch.daemon import CodeSearchDaemon
+        from codesearch.projects import DEFAULT_MEMORY_BUDGET_MB
 
-    def daemon(self):
         print("Running daemon")
-        d = CodeSearchDaemon(self.dir)
+        if memory is None:
+            memory = DEFAULT_MEMORY_BUDGET_MB
+        d = CodeSearchDaemon(
+            self.dir,
+            watch=watch,
+            jobs=self.jobs,
+            address=self.daemon_address(),
+            memory_budget=int(memory) * 1024 * 1024,
+        )
         d.run()
 
+    def daemon_stats(self):
+        """Prints the counters of the searches the daemon served"""
+        import json
+
+        from codesearch.daemon import CodeSearchClient
+
+        client = CodeSearchClient(self.dir, False, address=self.daemon_address())
+        try:
+            print(json.dumps(client.stats(), indent=2))
+        finally:
+            client.close()
+
+
+SEARCH_COMMANDS = {"cls", "fun", "ref", "find"}
+# Options of CodeSearchCLI, with the type of their value (None for boolean flags)
+OPTIONS: Dict[str, Any] = {
+    "dir": str,
+    "source": None,
+    "client": None,
+    "index": None,
+    "jobs": int,
+    "limit": int,
+    "first": None,
+    "socket": str,
+    "port": int,
+    "fast": None,
+    "stats": None,
+    "profile": str,
+    "format": str,
+    "color": None,
+    "git": None,
+    "untracked": None,
+    "commit": str,
+}
+
+
+def parse_queries(lines: Iterable[str]) -> List[Tuple[str, str]]:
+    """Reads `<command> <pattern>` lines, skipping blank ones and # comments"""
+    queries = []
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        command, _, pattern = line.partition(" ")
+        if command not in SEARCH_COMMANDS:
+            raise ValueError(f'Line {n}: unknown search command "{command}"')
+        queries.append((command, pattern.strip()))
+    return queries
+
+
+def parse_search_args(argv: List[str]) -> Optional[Tuple[Dict[str, Any], str, str]]:
+    """
+    Parses plain search invocations (a search command, its pattern and known
+    options) without going through fire, which takes longer to import than
+    the search itself on small trees. Returns None for anything else.
+    """
+    options: Dict[str, Any] = {}
+    positional = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if not arg.startswith("-"):
+            positional.append(arg)
+            continue
+        if not arg.startswith("--"):
+            # Short flags like -h are left to fire
+            return None
+        name, has_value, value = arg[2:].partition("=")
+        name = name.replace("-", "_")
+        if name not in OPTIONS or has_value and OPTIONS[name] is None:
+            if name.startswith("no") and OPTIONS.get(name[2:], int) is None:
+                # --noindex and the like
+                options[name[2:]] = False
+                continue
+            return None
+        convert = OPTIONS[name]
+        if convert is None:
+            options[name] = True
+            continue
+        if not has_value:
+            if i == len(argv):
+                return None
+            value = argv[i]
+            i += 1
+        try:
+            options[name] = convert(value)
+        except ValueError:
+            return None
+    if len(positional) != 2 or positional[0] not in SEARCH_COMMANDS:
+        return None
+    return options, positional[0], positional[1]
+
+
+def run_cli():
+    args = parse_search_args(sys.argv[1:])
+    if args is not None:
+        options, command, pattern = args
+        getattr(CodeSearchCLI(**options), command)(pattern)
+        return
+    import fire
 
-def main():
     fire.Fire(CodeSearchCLI)
+
+
+def main():
+    """Errors the user can fix are reported in one line, with exit status 1"""
+    try:
+        run_cli()
+    except re.error as e:
+        print(f"csr: Invalid pattern: {e}", file=sys.stderr)
+        return 1
+    except (InvalidDirectoryPath, ValueError) as e:
+        # Bad options, formats and batch lines
+        print(f"csr: {e}", file=sys.stderr)
+        return 1
+    except Exception as e:
+        # Only git-based searches import it
+        from codesearch.git import GitError
+
+        if not isinstance(e, GitError):
+            raise
+        print(f"csr: {e}", file=sys.stderr)
+        return 1
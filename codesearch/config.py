@@ -1,13 +1,14 @@
-import fnmatch
 import json
 import os
 import pathlib
 import sys
 from dataclasses import dataclass, field
-from functools import reduce
-from typing import Any, List, Set
+from typing import Dict, Iterable, List, Optional, Set
+
+from codesearch.gitignore import IgnoreRules
 
 CONFNAME = "code-searcher.json"
+GITIGNORE = ".gitignore"
 
 
 class InvalidConfig(Exception):
@@ -19,6 +20,8 @@ class InvalidConfig(Exception):
 class Config:
     exclude: Set[str] = field(default_factory=set)
     source: bool = False
+    # Use the quicker, less precise extractors where a language has one
+    fast: bool = False
 
     @staticmethod
     def from_json(json_s: str):
@@ -35,50 +38,6 @@ class Config:
         return conf
 
 
-def gitignore_arr_to_glob(
-    gitignore_arr: List[str], root_dir: pathlib.Path
-) -> List[str]:
-    # remove comments and empty lines
-    lines: Any = filter(
-        lambda line: not line.startswith("#") and not line == "", gitignore_arr
-    )
-    lines = filter(lambda line: "/." not in line and "." not in line, lines)
-    # rec
-    lines = map(lambda line: line if line.startswith("/") else "**/" + line, lines)
-    # add root dir
-    lines = map(
-        lambda line: f"{root_dir}{line}"
-        if line.startswith("/")
-        else f"{root_dir}/{line}",
-        lines,
-    )
-
-    def double(acc, line):
-        acc.append(line)
-        acc.append(line + "/**")
-        return acc
-
-    lines = reduce(double, lines, [])
-    lines = map(lambda line: f"{{{line}}}", lines)
-    # negate ignore statement
-    lines = map(
-        lambda line: line if line.startswith("!") else "!" + line,
-        lines,
-    )
-    glob_pattern = list(lines)
-    # print(glob_pattern)
-    return glob_pattern
-
-
-def gitignore_to_glob(
-    gitignore_path: pathlib.Path, root_dir: pathlib.Path
-) -> List[str]:
-    with open(gitignore_path, "r") as f:
-        content = f.read()
-    lines = content.split("\n")
-    return gitignore_arr_to_glob(lines, root_dir)
-
-
 def construct_default_config_for_dir(dirpath: pathlib.Path):
     exclude = {
         "__main__.py",
@@ -97,6 +56,7 @@ def construct_default_config_for_dir(dirpath: pathlib.Path):
         "*.html",
         "*.css",
         ".git",
+        ".codesearch",
         "Makefile",
         "*.json",
         "LICENSE",
@@ -119,15 +79,7 @@ def construct_default_config_for_dir(dirpath: pathlib.Path):
 
 
 def merge_configs(a: Config, b: Config) -> Config:
-    return Config(exclude=set([*a.exclude, *b.exclude]))
-
-
-def load_gitignore(gip: pathlib.Path, dirpath: pathlib.Path) -> Config:
-    with open(gip, "r") as f:
-        ignored: Any = f.read().split("\n")
-    ignored = filter(lambda line: not line.startswith("#") and not line == "", ignored)
-    ignored = list(ignored)
-    return Config(exclude=ignored)
+    return Config(exclude=set([*a.exclude, *b.exclude]), fast=a.fast or b.fast)
 
 
 def load_config(dirpath):
@@ -138,28 +90,114 @@ def load_config(dirpath):
             conf_json = f.read()
             conf = Config.from_json(conf_json)
         cfg = merge_configs(cfg, conf)
-    gip = pathlib.Path(dirpath, ".gitignore")
-    if os.path.exists(gip):
-        gitignore_cfg = load_gitignore(gip, dirpath)
-        cfg = merge_configs(cfg, gitignore_cfg)
     return cfg
 
 
-def determine_included_files(config: Config, dir: str):
-    files = []
-
-    def iter(d):
-        for f in os.listdir(d):
-            skip = any([fnmatch.fnmatch(f, p) for p in config.exclude])
-            fp = pathlib.Path(d, f)
-            if skip:
+class FileFilter:
+    """
+    Decides which files of a tree are searched.
+
+    The configured excludes are compiled once and act like a .gitignore at the
+    root of the tree (so plain names match at any depth). On top of that every
+    .gitignore file found in the tree applies to its own directory, with the
+    usual negation and anchoring rules.
+    """
+
+    def __init__(self, config: Config, root):
+        self.root = os.fspath(root)
+        self.excludes = IgnoreRules(config.exclude)
+        # Relative directory path ("" for the root, "a/b/" otherwise) -> its .gitignore rules
+        self.gitignores: Dict[str, Optional[IgnoreRules]] = {}
+
+    def _gitignore(self, rel_dir: str) -> Optional[IgnoreRules]:
+        if rel_dir not in self.gitignores:
+            gip = os.path.join(self.root, rel_dir, GITIGNORE)
+            rules = IgnoreRules.from_file(gip) if os.path.isfile(gip) else None
+            self.gitignores[rel_dir] = rules if rules else None
+        return self.gitignores[rel_dir]
+
+    def _is_ignored(self, rel: str, is_dir: bool, rel_dirs: List[str]) -> bool:
+        # The deepest .gitignore with an opinion wins, the configured excludes come last
+        for rel_dir in reversed(rel_dirs):
+            rules = self.gitignores[rel_dir]
+            if rules is None:
                 continue
-            if os.path.isdir(fp):
-                if fp in config.exclude:
-                    continue
-                iter(fp)
+            res = rules.match(rel[len(rel_dir) :], is_dir)
+            if res is not None:
+                return res
+        return self.excludes.match(rel, is_dir) is True
+
+    def is_excluded(self, path, is_dir: bool) -> bool:
+        """Check a single path, assuming its parent directories are not excluded"""
+        rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+        parts = rel.split("/")
+        rel_dirs = [""]
+        for i in range(1, len(parts)):
+            rel_dirs.append("/".join(parts[:i]) + "/")
+        for rel_dir in rel_dirs:
+            self._gitignore(rel_dir)
+        return self._is_ignored(rel, is_dir, rel_dirs)
+
+    def select(self, paths: Iterable[str]) -> List[str]:
+        """
+        Paths relative to the root (with / separators) that the configured
+        excludes leave in. Meant for file lists coming from git, which
+        already applied the .gitignore files.
+        """
+        # Relative directory path ("a/b/") -> whether it or a parent is excluded
+        excluded_dirs: Dict[str, bool] = {"": False}
+
+        def is_excluded_dir(rel_dir: str) -> bool:
+            res = excluded_dirs.get(rel_dir, None)
+            if res is None:
+                parent = rel_dir[: rel_dir.rfind("/", 0, -1) + 1]
+                res = is_excluded_dir(parent) or (
+                    self.excludes.match(rel_dir[:-1], True) is True
+                )
+                excluded_dirs[rel_dir] = res
+            return res
+
+        return [
+            rel
+            for rel in paths
+            if not is_excluded_dir(rel[: rel.rfind("/") + 1])
+            and self.excludes.match(rel, False) is not True
+        ]
+
+    def invalidate(self):
+        self.gitignores.clear()
+
+    def walk(self) -> List[pathlib.Path]:
+        files: List[pathlib.Path] = []
+        rel_dirs: List[str] = []
+
+        def iter(d: str, rel_dir: str):
+            try:
+                entries = list(os.scandir(d))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                return
+            if any(e.name == GITIGNORE for e in entries):
+                self.gitignores[rel_dir] = (
+                    IgnoreRules.from_file(os.path.join(d, GITIGNORE)) or None
+                )
             else:
-                files.append(fp)
+                self.gitignores[rel_dir] = None
+            rel_dirs.append(rel_dir)
+            for e in entries:
+                is_dir = e.is_dir()
+                rel = rel_dir + e.name
+                if self._is_ignored(rel, is_dir, rel_dirs):
+                    continue
+                if is_dir:
+                    # Excluded directories are never entered
+                    iter(e.path, rel + "/")
+                else:
+                    files.append(pathlib.Path(d, e.name))
+            rel_dirs.pop()
+
+        iter(self.root, "")
+        return files
+
 
-    iter(dir)
-    return files
+def determine_included_files(config: Config, dir) -> List[pathlib.Path]:
+    return FileFilter(config, dir).walk()
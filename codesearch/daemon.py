@@ -1,94 +1,47 @@
-import json
+import asyncio
+import os
+import re
 import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from enum import IntEnum
 from socket import SO_REUSEADDR, SOL_SOCKET
-from typing import Any, Dict, List, Optional
-from codesearch.logger import configure_loggers, logger
-from codesearch.entry import Entry
-from codesearch.searcher import CodeSearch, CodeSearchIndex, print_search_results
-
-DAEMON_PORT = 32458
-N = 2048
-ENCODING = "utf-8"
-
-
-class NetworkMessageType(IntEnum):
-    ENTRIES_MSG = 0
-    DAEMON_SEARCH = 1
-
-
-@dataclass
-class NetworkMessage:
-    type: NetworkMessageType
-
-    def _to_dict(self):
-        return {"type": self.type}
-
-    def pack(self):
-        d = self._to_dict()
-        j = json.dumps(d)
-        return j.encode(ENCODING)
-
-    @classmethod
-    def from_bytes(cls, b):
-        j = b.decode(ENCODING)
-        d = json.loads(j)
-        ttc = {
-            NetworkMessageType.DAEMON_SEARCH: DaemonSearchReqMsg,
-            NetworkMessageType.ENTRIES_MSG: EntriesMessage,
-        }
-        c = ttc[d["type"]]
-        del d["type"]
-        return c.from_dict(d)
-
-
-@dataclass
-class EntriesMessage(NetworkMessage):
-    entries: Dict[str, Entry]
-
-    def _to_dict(self):
-        return {
-            **NetworkMessage._to_dict(self),
-            "entries": {
-                k: list(map(lambda e: e.to_dict(), v))
-                for [k, v] in self.entries.items()
-            },
-        }
-
-    @classmethod
-    def from_dict(cls, d):
-        return cls(
-            entries={
-                k: [Entry.from_dict(e) for e in v] for [k, v] in d["entries"].items()
-            }
-        )
-
-    def __init__(self, entries):
-        NetworkMessage.__init__(self, NetworkMessageType.ENTRIES_MSG)
-        self.entries = entries
-
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-@dataclass
-class DaemonSearchReqMsg(NetworkMessage):
-    handler_key: str
-    params: List[Any]
-
-    def _to_dict(self):
-        return {
-            **NetworkMessage._to_dict(self),
-            "params": [p for p in self.params],
-            "handler_key": self.handler_key,
-        }
-
-    @classmethod
-    def from_dict(cls, d):
-        return cls(**d)
-
-    def __init__(self, handler_key, params):
-        NetworkMessage.__init__(self, NetworkMessageType.DAEMON_SEARCH)
-        self.handler_key = handler_key
-        self.params = params
+from codesearch.logger import configure_loggers, logger
+from codesearch.protocol import (
+    HEADER,
+    DaemonBatchReqMsg,
+    DaemonSearchReqMsg,
+    DaemonStatsReqMsg,
+    EndMessage,
+    ErrorMessage,
+    MalformedMessage,
+    NetworkMessage,
+    ProtocolError,
+    StatsMessage,
+    entries_frames,
+)
+from codesearch.projects import DEFAULT_MEMORY_BUDGET_MB, ProjectCache, project_root
+from codesearch.searcher import InvalidDirectoryPath, print_search_results
+from codesearch.stats import DaemonStats, SearchStats
+
+SOCKET_NAME = "codesearch.sock"
+# Number of searches that can run at the same time
+SEARCH_THREADS = 4
+# Frames buffered per client before the search waits for the client to catch up
+QUEUED_FRAMES = 8
+# Number of query results kept by the daemon, and the largest one worth keeping
+QUERY_CACHE_SIZE = 256
+MAX_CACHED_RESULT_BYTES = 4 * 1024 * 1024
+
+
+class ConnectionClosed(ConnectionError):
+    pass
 
 
 class Socket:
@@ -104,27 +57,19 @@ class Socket:
         obj.sock = socket
         return obj
 
-    def accept(self):
-        while True:
-            (clientsocket, address) = self.sock.accept()
-            yield Socket.from_socket(clientsocket)
-
-    def read_msg(self):
-        chunks = []
-        bytes_recd = 0
-        msg = None
-        while True:
-            chunk = self.sock.recv(N)
+    def read_exactly(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
             if len(chunk) == 0:
-                continue
-            chunks.append(chunk)
-            bytes_recd = bytes_recd + len(chunk)
-            if len(chunk) != N:
-                # last chunk
-                break
-        bb = b"".join(chunks)
-        msg = NetworkMessage.from_bytes(bb)
-        return msg
+                raise ConnectionClosed
+            buf += chunk
+        return bytes(buf)
+
+    def read_msg(self) -> NetworkMessage:
+        msg_type, length = NetworkMessage.parse_header(self.read_exactly(HEADER.size))
+        payload = self.read_exactly(length) if length != 0 else b""
+        return NetworkMessage.from_payload(msg_type, payload)
 
     def send_msg(self, msg):
         self.sock.sendall(msg.pack())
@@ -142,43 +87,427 @@ class Socket:
         self.sock.close(*args, **kwargs)
 
 
+QueryKey = Tuple[int, str, Tuple[str, ...], Optional[int]]
+
+
+def query_key(generation: int, msg: DaemonSearchReqMsg) -> QueryKey:
+    return (generation, msg.handler_key, tuple(map(str, msg.params)), msg.limit)
+
+
+class QueryCache:
+    """
+    The packed result frames of recent queries, dropped in LRU order.
+
+    Keys start with the generation of the index the query ran on. Every index
+    update gets a new generation, so results of an outdated index can't be
+    looked up anymore and just age out.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: Dict[QueryKey, List[bytes]] = OrderedDict()
+
+    def get(self, key: QueryKey) -> Optional[List[bytes]]:
+        with self.lock:
+            frames = self.entries.get(key, None)
+            if frames is not None:
+                self.entries.move_to_end(key)
+            return frames
+
+    def put(self, key: QueryKey, frames: List[bytes]):
+        if sum(map(len, frames)) > MAX_CACHED_RESULT_BYTES:
+            return
+        with self.lock:
+            self.entries[key] = frames
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
 class FailedToConnectToDaemon(Exception):
     def __str__(self):
         return "Failed to connect. Is the daemon running?"
 
 
-class CodeSearchDaemon:
-    searcher: CodeSearch
-    sock: Socket
-    index: CodeSearchIndex
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None)
+    if runtime_dir is not None and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    return os.path.join(tempfile.gettempdir(), f"codesearch-{os.getuid()}.sock")
+
+
+@dataclass
+class DaemonAddress:
+    """Where the daemon listens: a Unix domain socket unless a TCP port is given"""
+
+    socket_path: Optional[str] = None
+    host: str = "localhost"
+    port: Optional[int] = None
+
+    @property
+    def is_tcp(self):
+        return self.port is not None
 
-    def __init__(self, dir):
-        self.sock = Socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((socket.gethostname(), DAEMON_PORT))
-        self.searcher = CodeSearch(dir, use_index=True)
+    def resolved_socket_path(self) -> str:
+        return (
+            self.socket_path if self.socket_path is not None else default_socket_path()
+        )
+
+    def __str__(self):
+        if self.is_tcp:
+            return f"{self.host}:{self.port}"
+        return self.resolved_socket_path()
+
+
+async def read_msg_async(reader: asyncio.StreamReader) -> NetworkMessage:
+    msg_type, length = NetworkMessage.parse_header(
+        await reader.readexactly(HEADER.size)
+    )
+    payload = await reader.readexactly(length) if length != 0 else b""
+    return NetworkMessage.from_payload(msg_type, payload)
+
+
+class CodeSearchDaemon:
+    """
+    Serves search requests from many clients at once, for any number of
+    projects.
+
+    Connections are handled on an asyncio event loop while the searches
+    themselves run on a pool of worker threads, so a slow query doesn't hold
+    up other clients. Results are streamed back frame by frame. Each request
+    names the project root it searches; project indexes are loaded on first
+    use and the least recently used ones are dropped to stay within the
+    memory budget.
+    """
+
+    projects: ProjectCache
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    server: Optional[asyncio.AbstractServer] = None
+
+    def __init__(
+        self,
+        dir=None,
+        watch=True,
+        jobs=1,
+        address: Optional[DaemonAddress] = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024,
+    ):
+        self.address = address if address is not None else DaemonAddress()
+        # Searched by requests that don't name a project
+        self.dir = dir
+        self.projects = ProjectCache(memory_budget, jobs=jobs, watch=watch)
+        self.stats = DaemonStats()
+        self.queries = QueryCache(QUERY_CACHE_SIZE)
+        self.executor = ThreadPoolExecutor(
+            max_workers=SEARCH_THREADS, thread_name_prefix="codesearch-search"
+        )
+        # Connection handler task -> its writer, for every connected client
+        self.clients: Dict[asyncio.Task, asyncio.StreamWriter] = {}
         configure_loggers(daemon=True)
+        if dir is not None:
+            self.projects.get(dir)
 
     def run(self):
-        self.sock.listen(5)
-        for clientsocket in self.sock.accept():
-            msg = clientsocket.read_msg()
-            handler_key = msg.handler_key
-            params = msg.params
-            entries = self.searcher.for_all_files_execute_handler(handler_key, *params)
-            clientsocket.send_msg(EntriesMessage(entries=entries))
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.projects.close()
+
+    async def start_server(self) -> asyncio.AbstractServer:
+        if self.address.is_tcp:
+            return await asyncio.start_server(
+                self.handle_client, self.address.host, self.address.port
+            )
+        path = self.address.resolved_socket_path()
+        if os.path.exists(path):
+            # Left behind by a daemon that didn't exit cleanly
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle_client, path=path)
+        os.chmod(path, 0o600)
+        return server
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = server = await self.start_server()
+        logger.info(f"Listening on {self.address}")
+        try:
+            async with server:
+                try:
+                    await server.serve_forever()
+                except asyncio.CancelledError:
+                    # stop() was called
+                    pass
+                await self.close_clients()
+        finally:
+            if not self.address.is_tcp:
+                try:
+                    os.unlink(self.address.resolved_socket_path())
+                except FileNotFoundError:
+                    pass
+
+    def stop(self):
+        """Stops serving, can be called from any thread"""
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def close_clients(self):
+        """Disconnects the clients that are still connected, once their searches ended"""
+        tasks = list(self.clients)
+        for task, writer in list(self.clients.items()):
+            writer.close()
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        try:
+            while True:
+                try:
+                    msg = await read_msg_async(reader)
+                except asyncio.IncompleteReadError:
+                    # The client is done
+                    break
+                if isinstance(msg, DaemonStatsReqMsg):
+                    writer.write(StatsMessage(self.stats_dict()).pack())
+                    await writer.drain()
+                    continue
+                if isinstance(msg, DaemonBatchReqMsg):
+                    await self.handle_batch(msg, writer)
+                    continue
+                if not isinstance(msg, DaemonSearchReqMsg):
+                    raise ProtocolError(f"Unexpected message {msg.type.name}")
+                await self.handle_search(msg, writer)
+        except MalformedMessage as e:
+            logger.warn(f"Bad request, closing the connection: {e}")
+            try:
+                writer.write(ErrorMessage(str(e)).pack() + EndMessage().pack())
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except (ConnectionError, ProtocolError) as e:
+            logger.warn(f"Client went away: {e}")
+        except asyncio.CancelledError:
+            # The daemon is stopping, the search of the client (if any) is over
+            pass
+        finally:
+            del self.clients[task]
+            writer.close()
+
+    async def handle_search(
+        self, msg: DaemonSearchReqMsg, writer: asyncio.StreamWriter
+    ):
+        start = time.perf_counter()
+        root = msg.root if msg.root is not None else self.dir
+        # Repeated queries on a loaded project are answered right away
+        searcher = self.projects.loaded(root) if root is not None else None
+        if searcher is not None:
+            cached = self.queries.get(query_key(searcher.index.generation, msg))
+            if cached is not None:
+                for data in cached:
+                    writer.write(data)
+                writer.write(EndMessage().pack())
+                await writer.drain()
+                self.stats.add_request(
+                    msg.handler_key,
+                    time.perf_counter() - start,
+                    None,
+                    failed=False,
+                    cached=True,
+                )
+                return
+
+        stats = SearchStats()
+        failed = False
+
+        def search(put: Callable[[bytes], None], cancelled: threading.Event):
+            nonlocal failed
+            try:
+                if root is None:
+                    raise ProtocolError("No project root given")
+                with stats.phase("load"):
+                    searcher = self.projects.get(root)
+                # Taken before searching, a concurrent update only makes the results newer
+                key = query_key(searcher.index.generation, msg)
+                sent = []
+                with stats.phase("search"):
+                    results = searcher.search(
+                        msg.handler_key, *msg.params, limit=msg.limit, stats=stats
+                    )
+                    for frame in entries_frames(results):
+                        data = frame.pack()
+                        sent.append(data)
+                        put(data)
+                        if cancelled.is_set():
+                            results.close()
+                            break
+                if not cancelled.is_set():
+                    self.queries.put(key, sent)
+            except re.error as e:
+                failed = True
+                put(ErrorMessage(f"Invalid pattern: {e}").pack())
+            except (InvalidDirectoryPath, ProtocolError) as e:
+                failed = True
+                put(ErrorMessage(str(e)).pack())
+            except Exception as e:
+                failed = True
+                logger.exception(f"Search {msg.handler_key} {msg.params} failed")
+                put(ErrorMessage(f"Search failed: {e}").pack())
+            finally:
+                put(EndMessage().pack())
+
+        try:
+            await self.stream(search, writer)
+        finally:
+            self.stats.add_request(
+                msg.handler_key, time.perf_counter() - start, stats, failed
+            )
+
+    async def handle_batch(self, msg: DaemonBatchReqMsg, writer: asyncio.StreamWriter):
+        start = time.perf_counter()
+        root = msg.root if msg.root is not None else self.dir
+        stats = SearchStats()
+        failed = False
+
+        def search(put: Callable[[bytes], None], cancelled: threading.Event):
+            nonlocal failed
+            error = None
+            ended = 0
+            try:
+                if root is None:
+                    raise ProtocolError("No project root given")
+                with stats.phase("load"):
+                    searcher = self.projects.get(root)
+                with stats.phase("search"):
+                    results = searcher.search_many(msg.queries, msg.limit, stats=stats)
+                for query_results in results:
+                    for frame in entries_frames(query_results):
+                        put(frame.pack())
+                        if cancelled.is_set():
+                            return
+                    put(EndMessage().pack())
+                    ended += 1
+            except re.error as e:
+                error = f"Invalid pattern: {e}"
+            except (InvalidDirectoryPath, ProtocolError) as e:
+                error = str(e)
+            except Exception as e:
+                logger.exception(f"Batch of {len(msg.queries)} queries failed")
+                error = f"Search failed: {e}"
+            if error is not None:
+                failed = True
+                # Still one (empty) result per query
+                put(ErrorMessage(error).pack())
+                for _ in range(len(msg.queries) - ended):
+                    put(EndMessage().pack())
+
+        try:
+            await self.stream(search, writer)
+        finally:
+            self.stats.add_request("batch", time.perf_counter() - start, stats, failed)
+
+    async def stream(
+        self,
+        work: Callable[[Callable[[bytes], None], threading.Event], None],
+        writer: asyncio.StreamWriter,
+    ):
+        """
+        Runs `work` on a search thread and sends the packed messages it puts
+        to the client as they come. The event passed to `work` is set once
+        the client went away.
+        """
+        loop = asyncio.get_running_loop()
+        frames: asyncio.Queue = asyncio.Queue(maxsize=QUEUED_FRAMES)
+        cancelled = threading.Event()
+
+        def put(data: Optional[bytes]):
+            # Blocks the worker thread while the client is slow to read
+            asyncio.run_coroutine_threadsafe(frames.put(data), loop).result()
+
+        def run():
+            try:
+                work(put, cancelled)
+            finally:
+                put(None)
+
+        done = loop.run_in_executor(self.executor, run)
+        try:
+            while True:
+                data = await frames.get()
+                if data is None:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # The client went away or the daemon is stopping
+            cancelled.set()
+            # Let the search thread finish up
+            while await frames.get() is not None:
+                pass
+            raise
+        finally:
+            await done
+
+    def stats_dict(self) -> Dict[str, Any]:
+        res = self.stats.to_dict()
+        # Estimated index size of every loaded project
+        res["projects"] = self.projects.sizes()
+        return res
 
 
 class CodeSearchClient:
     sock: Socket
 
-    def __init__(self, dir, source):
-        self.sock = Socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, dir, source, address: Optional[DaemonAddress] = None):
+        self.root = project_root(dir)
+        address = address if address is not None else DaemonAddress()
         try:
-            self.sock.connect((socket.gethostname(), DAEMON_PORT))
-        except ConnectionRefusedError:
+            if address.is_tcp:
+                self.sock = Socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.connect((address.host, address.port))
+            else:
+                self.sock = Socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(address.resolved_socket_path())
+        except (ConnectionRefusedError, FileNotFoundError):
             raise FailedToConnectToDaemon
 
-    def exec(self, handler_key: str, *params):
-        self.sock.send_msg(DaemonSearchReqMsg(handler_key, params))
-        entries_msg = self.sock.read_msg()
-        print_search_results(entries_msg.entries)
+    def exec(self, handler_key: str, *params, limit=None):
+        print_search_results(self.search(handler_key, *params, limit=limit))
+
+    def search(self, handler_key: str, *params, limit=None):
+        self.sock.send_msg(
+            DaemonSearchReqMsg(handler_key, params, limit=limit, root=self.root)
+        )
+        return self.results()
+
+    def search_many(self, queries: Sequence[Tuple[str, str]], limit=None):
+        """Results of every query, see CodeSearch.search_many()"""
+        self.sock.send_msg(
+            DaemonBatchReqMsg(list(queries), limit=limit, root=self.root)
+        )
+        return [list(self.results()) for _ in queries]
+
+    def stats(self) -> Dict[str, Any]:
+        self.sock.send_msg(DaemonStatsReqMsg())
+        msg = self.sock.read_msg()
+        if not isinstance(msg, StatsMessage):
+            raise ProtocolError(f"Unexpected message {msg.type.name}")
+        return msg.stats
+
+    def results(self):
+        """Yields the (file, entries) results streamed back by the daemon"""
+        while True:
+            msg = self.sock.read_msg()
+            if isinstance(msg, EndMessage):
+                break
+            if isinstance(msg, ErrorMessage):
+                print(msg.error, file=sys.stderr)
+                continue
+            yield from msg.entries
+
+    def close(self):
+        self.sock.close()
@@ -7,6 +7,8 @@ class EntryKind(IntEnum):
     Function = 0
     Class = 1
     Call = 2
+    # Any occurrence of an identifier outside of its definition
+    Reference = 3
 
     def __str__(self):
         return entry_kind_to_str[self]
@@ -16,6 +18,7 @@ entry_kind_to_str = {
     EntryKind.Function: "Fun",
     EntryKind.Class: "Class",
     EntryKind.Call: "Call",
+    EntryKind.Reference: "Ref",
 }
 
 
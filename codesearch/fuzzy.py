@@ -0,0 +1,177 @@
+import heapq
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from codesearch.entry import Entry, EntryKind
+from codesearch.symbols import FileSymbols
+
+# Number of results of a fuzzy search when no limit is given
+DEFAULT_TOP_K = 50
+
+# Every matched character
+SCORE_MATCH = 16
+# ...plus these when it starts the name, follows a separator, starts a camelCase
+# word or a number
+BONUS_START = 12
+BONUS_SEPARATOR = 10
+BONUS_CAMEL = 9
+BONUS_DIGIT = 4
+# ...or directly follows the previously matched character
+BONUS_CONSECUTIVE = 8
+# ...or has the same case as in the query
+BONUS_CASE = 1
+# Every skipped run of characters between two matched ones
+PENALTY_GAP = 3
+# The query spells out the beginning of the name, or the whole name
+BONUS_PREFIX = 24
+BONUS_EXACT = 48
+# Per character of the name, and per directory level of the file
+PENALTY_LENGTH = 0.5
+PENALTY_DEPTH = 1.0
+
+SEPARATORS = "_.-$:/"
+DEFINITIONS = (EntryKind.Function, EntryKind.Class)
+
+
+def position_bonus(name: str, j: int) -> int:
+    if j == 0:
+        return BONUS_START
+    prev, c = name[j - 1], name[j]
+    if prev in SEPARATORS:
+        return BONUS_SEPARATOR
+    if c.isupper() and prev.islower():
+        return BONUS_CAMEL
+    if c.isdigit() and not prev.isdigit():
+        return BONUS_DIGIT
+    return 0
+
+
+def fuzzy_score(query: str, name: str) -> Optional[Tuple[float, Tuple[int, int]]]:
+    """
+    Scores `name` against `query`, whose characters must all appear in it in
+    order (case-insensitively). Returns None when they don't, otherwise the
+    score and the span from the first to the last matched character.
+
+    Of all the ways to match, the best scoring one is picked, which favors
+    characters at word boundaries (start, after `_` or `.`, camelCase humps)
+    and runs of consecutive characters.
+    """
+    if len(query) == 0:
+        return -PENALTY_LENGTH * len(name), (0, 0)
+    lower_name = name.lower()
+    lower_query = query.lower()
+    n = len(name)
+    # best[j]: best score of the query so far with its last character at j,
+    # along with where that match started
+    best: List[Optional[Tuple[int, int]]] = [None] * n
+    for i, qc in enumerate(lower_query):
+        current: List[Optional[Tuple[int, int]]] = [None] * n
+        # Best match of the previous characters ending before j - 1
+        running: Optional[Tuple[int, int]] = None
+        for j in range(i, n):
+            if j >= 2 and i != 0 and best[j - 2] is not None:
+                if running is None or best[j - 2][0] > running[0]:
+                    running = best[j - 2]
+            if lower_name[j] != qc:
+                continue
+            score = SCORE_MATCH + position_bonus(name, j)
+            if name[j] == query[i]:
+                score += BONUS_CASE
+            if i == 0:
+                current[j] = (score, j)
+                continue
+            options = []
+            if best[j - 1] is not None:
+                prev_score, start = best[j - 1]
+                options.append((prev_score + BONUS_CONSECUTIVE, start))
+            if running is not None:
+                options.append((running[0] - PENALTY_GAP, running[1]))
+            if len(options) != 0:
+                prev_score, start = max(options)
+                current[j] = (prev_score + score, start)
+        best = current
+    end, result = max(
+        ((j, r) for j, r in enumerate(best) if r is not None),
+        key=lambda jr: jr[1][0],
+        default=(0, None),
+    )
+    if result is None:
+        return None
+    score: float = result[0]
+    if lower_name.startswith(lower_query):
+        score += BONUS_EXACT if len(name) == len(query) else BONUS_PREFIX
+    score -= PENALTY_LENGTH * n
+    return score, (result[1], end + 1)
+
+
+class FuzzyMatcher:
+    """
+    Keeps the `k` best scoring definitions for a query in a bounded heap.
+
+    Names are first checked with a regex (every query character in order),
+    which rules out most of them without going through the scoring, and
+    every distinct name is only scored once.
+    """
+
+    def __init__(self, query: str, k: int = DEFAULT_TOP_K):
+        self.query = "".join(query.split())
+        self.k = k
+        self.quick_check = re.compile(
+            ".*?".join(map(re.escape, self.query)), re.IGNORECASE
+        ).search
+        self.scores: Dict[str, Optional[Tuple[float, Tuple[int, int]]]] = {}
+        # Min-heap of (score, -order, file, entry)
+        self.heap: List[Tuple[float, int, str, Entry]] = []
+        # Ties go to the definitions seen first
+        self.order = 0
+
+    def score(self, name: str) -> Optional[Tuple[float, Tuple[int, int]]]:
+        try:
+            return self.scores[name]
+        except KeyError:
+            pass
+        res = fuzzy_score(self.query, name) if self.quick_check(name) else None
+        self.scores[name] = res
+        return res
+
+    def add_file(self, f, symbols: FileSymbols):
+        if self.k <= 0:
+            return
+        f = str(f)
+        depth_penalty = PENALTY_DEPTH * f.count(os.sep)
+        for i, name in enumerate(symbols.names):
+            if symbols.kinds[i] not in DEFINITIONS:
+                continue
+            res = self.score(name)
+            if res is None:
+                continue
+            score = res[0] - depth_penalty
+            self.order += 1
+            if len(self.heap) == self.k and score <= self.heap[0][0]:
+                continue
+            entry = Entry(
+                line=symbols.lines[i],
+                kind=EntryKind(symbols.kinds[i]),
+                name=name,
+                col=symbols.cols[i],
+                match=res[1],
+            )
+            item = (score, -self.order, f, entry)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            else:
+                heapq.heappushpop(self.heap, item)
+
+    def add_files(self, files: Iterable[Tuple[object, FileSymbols]]):
+        for f, symbols in files:
+            self.add_file(f, symbols)
+
+    def results(self) -> List[Tuple[float, str, Entry]]:
+        """Best match first"""
+        return [
+            (score, f, entry)
+            for score, _, f, entry in sorted(
+                self.heap, key=lambda item: item[:2], reverse=True
+            )
+        ]
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import pathlib
+import subprocess
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Modes of tracked entries that aren't regular files
+SYMLINK_MODE = "120000"
+SUBMODULE_MODE = "160000"
+
+
+class GitError(Exception):
+    pass
+
+
+def content_hash(data: bytes) -> str:
+    # Same as the git blob id of the content
+    h = hashlib.sha1()
+    h.update(b"blob %d\0" % len(data))
+    h.update(data)
+    return h.hexdigest()
+
+
+def git(dir, *args: str) -> bytes:
+    try:
+        res = subprocess.run(["git", *args], cwd=dir, capture_output=True, check=True)
+    except OSError as e:
+        raise GitError(f"Couldn't run git: {e}")
+    except subprocess.CalledProcessError as e:
+        raise GitError(e.stderr.decode(errors="replace").strip())
+    return res.stdout
+
+
+def split_nul(out: bytes) -> List[str]:
+    return [os.fsdecode(item) for item in out.split(b"\0") if len(item) != 0]
+
+
+def worktree_files(dir, untracked: bool = False) -> Dict[str, Optional[str]]:
+    """
+    Files of the working tree under `dir` as listed by the git index, relative
+    to `dir`, with their blob id. Files whose content may differ from the
+    index (modified, conflicted, symlinks) or that are untracked (only listed
+    with `untracked`, minus the ignored ones) have no blob id.
+    """
+    files: Dict[str, Optional[str]] = {}
+    for line in split_nul(git(dir, "ls-files", "-z", "--stage")):
+        info, _, path = line.partition("\t")
+        mode, blob, stage = info.split()
+        if mode == SUBMODULE_MODE:
+            continue
+        if mode == SYMLINK_MODE and not os.path.isfile(os.path.join(dir, path)):
+            # Links to directories or to nothing
+            continue
+        if mode == SYMLINK_MODE or stage != "0" or path in files:
+            files[path] = None
+        else:
+            files[path] = blob
+    args = ["ls-files", "-z", "-t", "--modified", "--deleted"]
+    if untracked:
+        args += ["--others", "--exclude-standard"]
+    deleted = set()
+    for line in split_nul(git(dir, *args)):
+        tag, path = line[0], line[2:]
+        if tag == "R":
+            deleted.add(path)
+        else:
+            # C(hanged) or ? (untracked)
+            files[path] = None
+    for path in deleted:
+        files.pop(path, None)
+    return files
+
+
+def resolve_commit(dir, rev: str) -> str:
+    if rev.startswith("-"):
+        raise GitError(f'Invalid revision "{rev}"')
+    try:
+        out = git(dir, "rev-parse", "--verify", "--quiet", rev + "^{commit}")
+    except GitError:
+        raise GitError(f'Unknown commit "{rev}"')
+    return out.decode().strip()
+
+
+def commit_files(dir, commit: str) -> Dict[str, str]:
+    """Regular files under `dir` in `commit`, relative to `dir`, with their blob id"""
+    files = {}
+    for line in split_nul(git(dir, "ls-tree", "-r", "-z", commit)):
+        info, _, path = line.partition("\t")
+        mode, kind, blob = info.split()
+        if kind == "blob" and mode != SYMLINK_MODE:
+            files[path] = blob
+    return files
+
+
+def read_blobs(dir, blobs: Sequence[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yields (blob id, content) for every blob, in order, streamed out of a
+    single `git cat-file --batch`
+    """
+    if len(blobs) == 0:
+        return
+    proc = subprocess.Popen(
+        ["git", "cat-file", "--batch"],
+        cwd=dir,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+    def write_ids():
+        try:
+            proc.stdin.write("".join(f"{blob}\n" for blob in blobs).encode())
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+
+    # Fed from another thread, git would stop reading ids while we aren't reading its output
+    writer = threading.Thread(target=write_ids, daemon=True)
+    writer.start()
+    try:
+        for blob in blobs:
+            header = proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                raise GitError(f"Can't read blob {blob}")
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            yield blob, data
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+        writer.join()
+
+
+def common_dir(dir) -> pathlib.Path:
+    """The .git directory shared by every worktree of the repository of `dir`"""
+    out = os.fsdecode(git(dir, "rev-parse", "--git-common-dir").strip())
+    return pathlib.Path(dir, out).resolve()
@@ -0,0 +1,135 @@
+import re
+from typing import Iterable, List, Optional, Tuple
+
+
+def _translate_glob(pat: str) -> str:
+    """Translate a gitignore glob into a regular expression body"""
+    res = []
+    i, n = 0, len(pat)
+    while i < n:
+        c = pat[i]
+        if pat.startswith("**/", i) and (i == 0 or pat[i - 1] == "/"):
+            # zero or more leading directories
+            res.append("(?:.*/)?")
+            i += 3
+            continue
+        if pat.startswith("**", i) and i + 2 == n and (i == 0 or pat[i - 1] == "/"):
+            # everything inside
+            res.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res.append(re.escape(pat[i]))
+        elif c == "[":
+            j = pat.find("]", i + 2 if pat.startswith("[!", i) else i + 1)
+            if j == -1:
+                res.append(re.escape(c))
+            else:
+                body = pat[i + 1 : j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                res.append("[" + body.replace("\\", "\\\\") + "]")
+                i = j
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res)
+
+
+def parse_rule(line: str) -> Optional[Tuple[str, bool, bool]]:
+    """
+    Parse a single gitignore line into (regex, negated, dir_only).
+    The regex is matched against paths relative to the directory of the
+    file the rule comes from, using "/" as the separator.
+    """
+    if line.endswith("\n"):
+        line = line[:-1]
+    # trailing spaces are ignored unless escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) != len(line):
+        stripped += " "
+    line = stripped
+    if line == "" or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    if dir_only:
+        line = line.rstrip("/")
+    if line == "":
+        return None
+    # Patterns with a slash anywhere but at the end are relative to the gitignore location
+    anchored = "/" in line
+    line = line.lstrip("/")
+    body = _translate_glob(line)
+    if anchored:
+        regex = f"^{body}$"
+    else:
+        regex = f"^(?:.*/)?{body}$"
+    return regex, negated, dir_only
+
+
+class IgnoreRules:
+    """
+    Compiled rules of a single gitignore file (or of the configured excludes).
+
+    Without negated rules every pattern is folded into a single regular
+    expression, otherwise the rules are checked from last to first, since the
+    last matching rule decides.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        rules = [r for r in map(parse_rule, lines) if r is not None]
+        self.ordered: Optional[List[Tuple[re.Pattern, bool, bool]]] = None
+        self.any_re: Optional[re.Pattern] = None
+        self.dir_re: Optional[re.Pattern] = None
+        if any(negated for _, negated, _ in rules):
+            self.ordered = [
+                (re.compile(regex), negated, dir_only)
+                for regex, negated, dir_only in reversed(rules)
+            ]
+            return
+        any_rules = [regex for regex, _, dir_only in rules if not dir_only]
+        dir_rules = [regex for regex, _, dir_only in rules if dir_only]
+        if len(any_rules) != 0:
+            self.any_re = re.compile("|".join(any_rules))
+        if len(dir_rules) != 0:
+            self.dir_re = re.compile("|".join(dir_rules))
+
+    @classmethod
+    def from_file(cls, path) -> "IgnoreRules":
+        with open(path, "r", errors="replace") as f:
+            return cls(f.readlines())
+
+    def __bool__(self):
+        return (
+            self.ordered is not None
+            or self.any_re is not None
+            or self.dir_re is not None
+        )
+
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        """
+        Returns True if `path` is ignored, False if it is explicitly re-included
+        and None if no rule says anything about it
+        """
+        if self.ordered is not None:
+            for regex, negated, dir_only in self.ordered:
+                if dir_only and not is_dir:
+                    continue
+                if regex.match(path):
+                    return not negated
+            return None
+        if self.any_re is not None and self.any_re.match(path):
+            return True
+        if is_dir and self.dir_re is not None and self.dir_re.match(path):
+            return True
+        return None
@@ -1,4 +1,18 @@
 import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from codesearch.entry import Entry
+from codesearch.literals import exact_name
+from codesearch.logger import logger
+from codesearch.symbols import FileSymbols
+
+# Number of files whose extracted symbols are kept around for searches without an index
+SYMBOL_CACHE_SIZE = 4096
+
+# (mtime in ns, size, content hash) of a file
+Stamp = Tuple[int, int, str]
 
 
 def import_python_handler():
@@ -7,6 +21,12 @@ def import_python_handler():
     return PythonHandler
 
 
+def import_python_fast_handler():
+    from codesearch.handlers.python import PythonFastHandler
+
+    return PythonFastHandler
+
+
 def import_cpp_handler():
     from codesearch.handlers.cpp import CppHandler
 
@@ -19,6 +39,12 @@ def import_js_handler():
     return JSHandler
 
 
+def import_js_fast_handler():
+    from codesearch.handlers.js import JSFastHandler
+
+    return JSFastHandler
+
+
 handlers = {
     ".py": import_python_handler,
     ".cpp": import_cpp_handler,
@@ -30,11 +56,188 @@ handlers = {
     ".ts": import_js_handler,
 }
 
+# Handlers used in fast mode, which trade some precision for extraction speed
+fast_handlers = {
+    ".py": import_python_fast_handler,
+    ".js": import_js_fast_handler,
+    ".ts": import_js_fast_handler,
+}
 
-def handler_for_file_type(f: str):
-    _, ext = os.path.splitext(f)
-    handler_importer = handlers.get(ext, None)
+
+# (extension, fast mode) -> handler class (or None), filled in as extensions are seen
+resolved_handlers: Dict[Tuple[str, bool], Any] = {}
+
+
+def handler_for_extension(ext: str, fast: bool = False):
+    """The handler module of a language is only imported once a file of it shows up"""
+    try:
+        return resolved_handlers[ext, fast]
+    except KeyError:
+        pass
+    handler_importer = None
+    if fast:
+        handler_importer = fast_handlers.get(ext, None)
     if handler_importer is None:
-        return None
-    handler = handler_importer()
+        handler_importer = handlers.get(ext, None)
+    handler = handler_importer() if handler_importer is not None else None
+    resolved_handlers[ext, fast] = handler
     return handler
+
+
+def handler_for_file_type(f: str, fast: bool = False):
+    _, ext = os.path.splitext(f)
+    return handler_for_extension(ext, fast)
+
+
+def try_index_file(handler, f) -> Optional[FileSymbols]:
+    """Symbols of `f`, None when it can't be parsed, which is only logged"""
+    try:
+        return handler.index_file(f)
+    except Exception as e:
+        logger.warn(f'Failed to index "{f}": {e}')
+        return None
+
+
+def index_stamped(handler, f) -> Tuple[FileSymbols, Stamp]:
+    """
+    Symbols of `f` along with the stamp of the content they were extracted
+    from, which is read only once. Handlers that read files themselves parse
+    it after it was stamped, so a change in between shows up as a change.
+    """
+    from codesearch.git import content_hash
+
+    with open(f, "rb") as bf:
+        st = os.fstat(bf.fileno())
+        data = bf.read()
+    stamp = (st.st_mtime_ns, st.st_size, content_hash(data))
+    if hasattr(handler, "index_source"):
+        return handler.index_source(f, data), stamp
+    return handler.index_file(f), stamp
+
+
+def try_index_stamped(handler, f) -> Optional[Tuple[FileSymbols, Stamp]]:
+    """Same as index_stamped(), None when `f` can't be parsed, which is only logged"""
+    try:
+        return index_stamped(handler, f)
+    except Exception as e:
+        logger.warn(f'Failed to index "{f}": {e}')
+        return None
+
+
+def match_symbols(symbols, kind, pattern):
+    """
+    Yield entries for the extracted symbols of `kind` whose name matches `pattern`.
+
+    The pattern is tried once per distinct name, occurrences of the matching
+    names are then looked up in the file's inverted name index. Patterns that
+    can only match one name (`^name$`) go straight to the lookup.
+    """
+    by_name = symbols.by_name()
+    exact = exact_name(pattern)
+    if exact is not None:
+        positions = by_name.get(exact, None)
+        matches = [(exact, positions, (0, len(exact)))] if positions else []
+    else:
+        search = pattern.search
+        matches = []
+        for name, positions in by_name.items():
+            match = search(name)
+            if match:
+                matches.append((name, positions, match.span()))
+    kinds = symbols.kinds
+    hits = []
+    for name, positions, span in matches:
+        for i in positions:
+            if kinds[i] == kind:
+                hits.append((i, name, span))
+    hits.sort()
+    for i, name, span in hits:
+        yield Entry(
+            line=symbols.lines[i],
+            col=symbols.cols[i],
+            name=name,
+            kind=kind,
+            match=span,
+        )
+
+
+class SymbolCache:
+    """
+    Extracted symbols of recently searched files, so that every query kind
+    (fun, cls, ref) over the same file shares a single parse. Entries are
+    keyed by the file's mtime and size and dropped in LRU order. Files whose
+    git blob id is known are keyed by that instead, so identical files of
+    other checkouts or commits share it too.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, str], Tuple[int, int, FileSymbols]] = (
+            OrderedDict()
+        )
+        # (extractor, git blob id) -> symbols, shared by every file with that content
+        self.blobs: Dict[Tuple[str, str], FileSymbols] = OrderedDict()
+
+    def get(self, handler, f) -> FileSymbols:
+        st = os.stat(f)
+        key = (handler.EXTRACTOR, os.fspath(f))
+        with self.lock:
+            cached = self.entries.get(key, None)
+            if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+                self.entries.move_to_end(key)
+                return cached[2]
+        symbols = try_index_file(handler, f)
+        if symbols is None:
+            # No symbols until the file changes
+            symbols = FileSymbols()
+        with self.lock:
+            self.entries[key] = (st.st_mtime_ns, st.st_size, symbols)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return symbols
+
+    def get_blob(self, handler, blob: str) -> Optional[FileSymbols]:
+        key = (handler.EXTRACTOR, blob)
+        with self.lock:
+            symbols = self.blobs.get(key, None)
+            if symbols is not None:
+                self.blobs.move_to_end(key)
+            return symbols
+
+    def add_blob(self, handler, blob: str, symbols: FileSymbols):
+        key = (handler.EXTRACTOR, blob)
+        with self.lock:
+            self.blobs[key] = symbols
+            self.blobs.move_to_end(key)
+            while len(self.blobs) > self.size:
+                self.blobs.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.blobs.clear()
+
+
+symbol_cache = SymbolCache(SYMBOL_CACHE_SIZE)
+
+
+def cached_symbols(handler, f) -> FileSymbols:
+    return symbol_cache.get(handler, f)
+
+
+def cached_blob_symbols(handler, f, blob: str) -> FileSymbols:
+    """
+    Symbols of `f`, whose content is the git blob `blob`. Only for handlers
+    with an index_source(), whose symbols don't depend on anything but the
+    content of the file.
+    """
+    symbols = symbol_cache.get_blob(handler, blob)
+    if symbols is None:
+        # Content that fails to parse never will, it keeps no symbols
+        symbols = try_index_file(handler, f)
+        if symbols is None:
+            symbols = FileSymbols()
+        symbol_cache.add_blob(handler, blob, symbols)
+    return symbols
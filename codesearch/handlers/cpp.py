@@ -5,24 +5,78 @@ import pathlib
 import cpp_handler
 from codesearch.config import Config
 from codesearch.entry import Entry, EntryKind
+from codesearch.handlers import match_symbols
+from codesearch.symbols import FileSymbols
 
 
 class CppHandler:
+    EXTRACTOR = "cpp:5"
+
     @classmethod
     def cls(cls, config: Config, f: pathlib.Path, pattern, index=None):
-        entries = cpp_handler.file_cls(str(f), pattern.pattern, bool(index))
+        if index is not None:
+            # The native matcher is case-insensitive, so keep it that way here
+            pattern = re.compile(pattern.pattern, re.IGNORECASE)
+            yield from match_symbols(index, EntryKind.Class, pattern)
+            return
+        entries = cpp_handler.file_cls(str(f), pattern.pattern, False)
         entries = [Entry(kind=EntryKind.Class, **entry) for entry in entries]
         for e in entries:
             yield e
 
     @classmethod
     def index_file(cls, f: pathlib.Path):
-        index = cpp_handler.index_file(str(f))
-        return index
+        # All three kinds come from a single parse with function bodies. The
+        # translation unit is cached and reparsed when the file changes.
+        symbols = FileSymbols()
+        functions, classes, refs = cpp_handler.file_symbols(str(f))
+        for kind, entries in [
+            (EntryKind.Function, functions),
+            (EntryKind.Class, classes),
+            (EntryKind.Reference, refs),
+        ]:
+            for e in entries:
+                symbols.add(kind, e["name"], e["line"], e["col"])
+        return symbols
 
     @classmethod
     def fun(cls, config: Config, f: pathlib.Path, pattern: re.Pattern, index=None):
-        entries = cpp_handler.file_fun(str(f), pattern.pattern, bool(index))
+        if index is not None:
+            pattern = re.compile(pattern.pattern, re.IGNORECASE)
+            yield from match_symbols(index, EntryKind.Function, pattern)
+            return
+        entries = cpp_handler.file_fun(str(f), pattern.pattern, False)
         entries = [Entry(kind=EntryKind.Function, **entry) for entry in entries]
         for e in entries:
             yield e
+
+    @classmethod
+    def search_batch(
+        cls, handler_key: str, config: Config, files, pattern: re.Pattern, threads=1
+    ):
+        """
+        Searches many files in one call. libclang parses them on `threads`
+        native threads without holding the GIL.
+        """
+        search, kind = {
+            "fun": (cpp_handler.files_fun, EntryKind.Function),
+            "cls": (cpp_handler.files_cls, EntryKind.Class),
+            "ref": (cpp_handler.files_refs, EntryKind.Reference),
+        }[handler_key]
+        results = search([str(f) for f in files], pattern.pattern, threads)
+        for f, rows in zip(files, results):
+            yield f, [
+                Entry(line=line, kind=kind, name=name, col=col, match=(start, end))
+                for name, line, col, start, end in rows
+            ]
+
+    @classmethod
+    def ref(cls, config: Config, f: pathlib.Path, pattern: re.Pattern, index=None):
+        if index is not None:
+            pattern = re.compile(pattern.pattern, re.IGNORECASE)
+            yield from match_symbols(index, EntryKind.Reference, pattern)
+            return
+        entries = cpp_handler.file_refs(str(f), pattern.pattern, False)
+        entries = [Entry(kind=EntryKind.Reference, **entry) for entry in entries]
+        for e in entries:
+            yield e
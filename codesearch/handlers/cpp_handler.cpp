@@ -1,176 +1,462 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <clang-c/CXCompilationDatabase.h>
 #include <clang-c/Index.h>  // This is libclang.
 
+#include <algorithm>
+#include <atomic>
 #include <filesystem>
 #include <functional>
 #include <iostream>
+#include <list>
+#include <mutex>
 #include <regex>
 #include <set>
+#include <string>
+#include <thread>
+#include <unordered_map>
 #include <utility>
+#include <vector>
 
 using namespace std;
 namespace fs = std::filesystem;
 
-template <typename Function>
-struct function_traits;
-
-template <typename Ret, typename... Args>
-struct function_traits<Ret(Args...)> {
-  typedef Ret (*ptr)(Args...);
-};
-
-template <typename Ret, typename... Args>
-struct function_traits<Ret (*const)(Args...)> : function_traits<Ret(Args...)> {
-};
-
-template <typename Cls, typename Ret, typename... Args>
-struct function_traits<Ret (Cls::*)(Args...) const>
-    : function_traits<Ret(Args...)> {};
-
-using voidfun = void (*)();
-
-template <typename F>
-voidfun lambda_to_void_function(F lambda) {
-  static auto lambda_copy = lambda;
-
-  return []() { lambda_copy(); };
-}
-
-// requires C++20
-template <typename F>
-auto lambda_to_pointer(F lambda) ->
-    typename function_traits<decltype(&F::operator())>::ptr {
-  static auto lambda_copy = lambda;
-
-  return []<typename... Args>(Args... args) { return lambda_copy(args...); };
-}
-
 using u32 = unsigned int;
 using i32 = int;
 
+// Entries own their data, they outlive the translation unit they come from
 struct Entry {
-  const char* name;
+  std::string name;
   u32 line;
   u32 col;
-  std::smatch match;
+  // Span of the match in the name
+  long start;
+  long end;
 };
 
 using CursorKinds = std::set<CXCursorKind>;
 
+struct VisitState {
+  const CursorKinds& predicate_kinds;
+  const std::regex& pattern;
+  bool referenced;
+  std::vector<Entry>& entries;
+};
+
+static CXChildVisitResult visit_cursor(CXCursor c, CXCursor parent,
+                                       CXClientData client_data) {
+  auto& state = *static_cast<VisitState*>(client_data);
+  auto loc = clang_getCursorLocation(c);
+  // Whatever comes from headers is skipped along with its children
+  if (!clang_Location_isFromMainFile(loc)) {
+    return CXChildVisit_Continue;
+  }
+  auto kind = clang_getCursorKind(c);
+  if (state.predicate_kinds.find(kind) == state.predicate_kinds.end()) {
+    return CXChildVisit_Recurse;
+  }
+  unsigned line = 0;
+  unsigned col = 0;
+  clang_getSpellingLocation(loc, nullptr, &line, &col, NULL);
+  auto named = c;
+  if (state.referenced) {
+    auto target = clang_getCursorReferenced(c);
+    if (!clang_Cursor_isNull(target)) {
+      named = target;
+    }
+  }
+  auto clang_str = clang_getCursorSpelling(named);
+  auto s = std::string(clang_getCString(clang_str));
+  clang_disposeString(clang_str);
+  if (s.empty()) {
+    return CXChildVisit_Recurse;
+  }
+  std::smatch sm;
+  if (std::regex_search(s, sm, state.pattern)) {
+    long start = sm.position(0);
+    long end = start + sm.length(0);
+    state.entries.push_back(Entry{.name = std::move(s),
+                                  .line = line,
+                                  .col = col,
+                                  .start = start,
+                                  .end = end});
+  }
+  return CXChildVisit_Recurse;
+}
+
+// With `referenced`, entries are named after the declaration the cursor refers
+// to (for references like "Foo" in "Foo x;" whose own spelling is "class Foo")
 std::vector<Entry> process_file_with(CXTranslationUnit unit,
                                      const CursorKinds& predicate_kinds,
-                                     char const* filename,
-                                     char const* pattern_s) {
-  std::regex pattern(pattern_s, std::regex_constants::ECMAScript |
-                                    std::regex_constants::icase);
-  CXCursor cursor = clang_getTranslationUnitCursor(unit);
+                                     const std::regex& pattern,
+                                     bool referenced = false) {
   std::vector<Entry> entries;
-  auto abspath = fs::absolute(filename);
-  const char* abspath_cstr = abspath.c_str();
-  auto visitor = lambda_to_pointer(
-      [&](CXCursor c, CXCursor parent, CXClientData client_data) {
-        auto kind = clang_getCursorKind(c);
-        if (predicate_kinds.find(kind) != predicate_kinds.end()) {
-          auto loc = clang_getCursorLocation(c);
-          CXFile file;
-          unsigned line = 0;
-          unsigned col = 0;
-          clang_getSpellingLocation(loc, &file, &line, &col, NULL);
-          auto sym_fname = clang_File_tryGetRealPathName(file);
-          auto sym_fname_cstr = reinterpret_cast<const char*>(sym_fname.data);
-          // skip if symbol defined in another file
-          auto clang_str = clang_getCursorSpelling(c);
-          auto c_str = reinterpret_cast<const char*>(clang_str.data);
-          if (!fs::equivalent(sym_fname_cstr, abspath_cstr)) {
-            return CXChildVisit_Recurse;
-          }
-          std::smatch sm;
-          auto s = std::string(c_str);
-          if (std::regex_search(s, sm, pattern)) {
-            entries.push_back(
-                Entry{.name = c_str, .line = line, .col = col, .match = sm});
-          }
-        }
-        return CXChildVisit_Recurse;
-      });
-  clang_visitChildren(cursor, visitor, nullptr);
+  // The state goes through the client data, a capturing lambda turned into a
+  // function pointer would keep referring to the locals of the first call
+  VisitState state{predicate_kinds, pattern, referenced, entries};
+  clang_visitChildren(clang_getTranslationUnitCursor(unit), visit_cursor,
+                      &state);
   return entries;
 }
 
-std::vector<Entry> process_file(CXIndex index,
-                                const CursorKinds& predicate_kinds,
-                                char const* filename, char const* pattern_s) {
-  CXTranslationUnit unit = clang_parseTranslationUnit(
-      index, filename, nullptr, 0, nullptr, 0, CXTranslationUnit_None);
-  if (unit == nullptr) {
-    cerr << "Unable to parse translation unit: " << filename << endl;
-    return {};
+// Sets a Python exception and returns false when `pattern_s` isn't valid
+static bool compile_pattern(char const* pattern_s, std::regex& pattern) {
+  try {
+    pattern = std::regex(pattern_s, std::regex_constants::ECMAScript |
+                                        std::regex_constants::icase);
+  } catch (const std::regex_error& e) {
+    PyErr_Format(PyExc_ValueError, "Invalid pattern \"%s\": %s", pattern_s,
+                 e.what());
+    return false;
   }
-  auto res = process_file_with(unit, predicate_kinds, filename, pattern_s);
-  clang_disposeTranslationUnit(unit);
-  return res;
+  return true;
 }
 
 static CXIndex _index;
-std::unordered_map<const char*, CXTranslationUnit> indexed_files;
 
 std::set FUNCTION_CURSOR_KINDS = {CXCursor_FunctionDecl};
 std::set CLASS_CURSOR_KINDS = {CXCursor_ClassDecl, CXCursor_ClassTemplate,
                                CXCursor_StructDecl};
+std::set REFERENCE_CURSOR_KINDS = {
+    CXCursor_DeclRefExpr, CXCursor_MemberRefExpr, CXCursor_TypeRef,
+    CXCursor_TemplateRef, CXCursor_NamespaceRef,  CXCursor_MemberRef,
+    CXCursor_OverloadedDeclRef};
+
+// Parsed translation units kept around, least recently used ones are disposed
+// past this count
+static const size_t MAX_CACHED_UNITS = 16;
+
+// Parses and reparses done so far, from any thread
+static std::atomic<unsigned long> parses{0};
+
+struct CachedUnit {
+  CXTranslationUnit unit;
+  // Whether function bodies were parsed, references are only found in those
+  bool bodies;
+  fs::file_time_type mtime;
+  uintmax_t size;
+  // Position in `unit_order`
+  std::list<std::string>::iterator order;
+};
+
+// Absolute path -> parsed unit
+std::unordered_map<std::string, CachedUnit> indexed_files;
+// Least recently used first
+std::list<std::string> unit_order;
+
+// Directory -> compilation database found in it or in one of its parents
+// (nullptr when there is none)
+std::unordered_map<std::string, CXCompilationDatabase> compilation_databases;
+// Batched searches look up compile commands from several threads
+std::mutex compilation_databases_lock;
+
+// Filesystem errors are treated like missing files: these run on threads where
+// an exception would terminate the process
+static CXCompilationDatabase compilation_database_for(const fs::path& dir) {
+  auto key = dir.string();
+  auto found = compilation_databases.find(key);
+  if (found != compilation_databases.end()) {
+    return found->second;
+  }
+  CXCompilationDatabase_Error error;
+  CXCompilationDatabase db = nullptr;
+  std::error_code ec;
+  if (fs::exists(dir / "compile_commands.json", ec)) {
+    db = clang_CompilationDatabase_fromDirectory(key.c_str(), &error);
+    if (error != CXCompilationDatabase_NoError) {
+      db = nullptr;
+    }
+  } else if (dir.has_parent_path() && dir.parent_path() != dir) {
+    db = compilation_database_for(dir.parent_path());
+  }
+  compilation_databases[key] = db;
+  return db;
+}
+
+// Compiler arguments of `path` from compile_commands.json, without the
+// compiler itself, the source file and the output options
+static std::vector<std::string> compile_args(const fs::path& path) {
+  std::vector<std::string> args;
+  std::lock_guard<std::mutex> guard(compilation_databases_lock);
+  CXCompilationDatabase db = compilation_database_for(path.parent_path());
+  if (db == nullptr) {
+    return args;
+  }
+  CXCompileCommands commands =
+      clang_CompilationDatabase_getCompileCommands(db, path.c_str());
+  if (clang_CompileCommands_getSize(commands) != 0) {
+    CXCompileCommand command = clang_CompileCommands_getCommand(commands, 0);
+    CXString dir = clang_CompileCommand_getDirectory(command);
+    // Relative include paths are relative to the directory of the command
+    args.push_back(std::string("-working-directory=") + clang_getCString(dir));
+    clang_disposeString(dir);
+    unsigned n = clang_CompileCommand_getNumArgs(command);
+    for (unsigned i = 1; i < n; ++i) {
+      CXString arg_s = clang_CompileCommand_getArg(command, i);
+      std::string arg = clang_getCString(arg_s);
+      clang_disposeString(arg_s);
+      if (arg == "--") {
+        // Only input files follow
+        break;
+      }
+      if (arg == "-o" || arg == "-MF" || arg == "-MT" || arg == "-MQ") {
+        ++i;
+        continue;
+      }
+      if (arg == "-c" || arg == "-MD" || arg == "-MMD" ||
+          fs::path(arg).filename() == path.filename()) {
+        continue;
+      }
+      // Commands inferred for headers would have clang emit a precompiled
+      // header
+      if (arg == "c++-header" || arg == "c-header") {
+        arg.resize(arg.size() - 7);
+      }
+      args.push_back(arg);
+    }
+  }
+  clang_CompileCommands_dispose(commands);
+  return args;
+}
+
+// `filename` made absolute, or as is when the working directory can't be read
+static fs::path absolute_path(const char* filename) {
+  std::error_code ec;
+  auto path = fs::absolute(filename, ec);
+  return ec ? fs::path(filename) : path;
+}
+
+// With `cache` the unit is going to be kept for later queries and reparses
+static CXTranslationUnit parse_unit(CXIndex index, const fs::path& path,
+                                    bool bodies, bool cache) {
+  auto args = compile_args(path);
+  std::vector<const char*> argv;
+  for (auto& arg : args) {
+    argv.push_back(arg.c_str());
+  }
+  unsigned options = CXTranslationUnit_KeepGoing;
+  if (cache) {
+    // The preamble (the leading includes) is precompiled on the first reparse
+    // and reused by the next ones as long as the headers don't change. Files
+    // that are parsed only once, as in a cold index build, never pay for it.
+    options |= CXTranslationUnit_PrecompiledPreamble;
+  }
+  if (!bodies) {
+    options |= CXTranslationUnit_SkipFunctionBodies;
+  }
+  CXTranslationUnit unit = nullptr;
+  ++parses;
+  auto error = clang_parseTranslationUnit2(
+      index, path.c_str(), argv.data(), static_cast<int>(argv.size()),
+      nullptr, 0, options, &unit);
+  if (error != CXError_Success) {
+    cerr << "Unable to parse translation unit: " << path << endl;
+    return nullptr;
+  }
+  return unit;
+}
+
+static void dispose_unit(const std::string& key) {
+  auto found = indexed_files.find(key);
+  if (found == indexed_files.end()) {
+    return;
+  }
+  clang_disposeTranslationUnit(found->second.unit);
+  unit_order.erase(found->second.order);
+  indexed_files.erase(found);
+}
 
-static bool build_index(const char* filename) {
-  CXTranslationUnit unit = clang_parseTranslationUnit(
-      _index, filename, nullptr, 0, nullptr, 0, CXTranslationUnit_None);
+// The parsed unit of `filename`, parsed again (through a reparse when
+// possible) if the file changed since it was cached. `bodies` asks for a unit
+// with function bodies.
+static CXTranslationUnit get_indexed_file(char const* filename, bool bodies) {
+  auto path = absolute_path(filename);
+  auto key = path.string();
+  std::error_code ec;
+  auto mtime = fs::last_write_time(path, ec);
+  auto size = fs::file_size(path, ec);
+  auto found = indexed_files.find(key);
+  if (found != indexed_files.end()) {
+    auto& cached = found->second;
+    unit_order.splice(unit_order.end(), unit_order, cached.order);
+    if (cached.bodies || !bodies) {
+      if (cached.mtime == mtime && cached.size == size) {
+        return cached.unit;
+      }
+      ++parses;
+      if (clang_reparseTranslationUnit(
+              cached.unit, 0, nullptr,
+              clang_defaultReparseOptions(cached.unit)) == 0) {
+        cached.mtime = mtime;
+        cached.size = size;
+        return cached.unit;
+      }
+    }
+    // A reparse failure leaves the unit unusable
+    dispose_unit(key);
+  }
+  CXTranslationUnit unit = parse_unit(_index, path, bodies, true);
   if (unit == nullptr) {
-    cerr << "Unable to parse translation unit: " << filename << endl;
-    return false;
+    return nullptr;
   }
-  indexed_files[filename] = unit;
-  return true;
+  unit_order.push_back(key);
+  indexed_files[key] = CachedUnit{.unit = unit,
+                                  .bodies = bodies,
+                                  .mtime = mtime,
+                                  .size = size,
+                                  .order = std::prev(unit_order.end())};
+  while (indexed_files.size() > MAX_CACHED_UNITS) {
+    dispose_unit(unit_order.front());
+  }
+  return unit;
 }
 
-static CXTranslationUnit get_indexed_file(char const* filename) {
-  auto res = indexed_files.find(filename);
-  if (res == indexed_files.end()) {
-    build_index(filename);
+// A list of {"name", "line", "col", "match"} dicts
+static PyObject* entries_to_py(const std::vector<Entry>& entries) {
+  auto* py_entries = PyList_New(entries.size());
+  if (py_entries == NULL) {
+    return NULL;
   }
-  return indexed_files.at(filename);
+  for (size_t i = 0; i < entries.size(); ++i) {
+    auto& entry = entries[i];
+    PyObject* py_entry =
+        Py_BuildValue("{s:s,s:I,s:I,s:(ll)}", "name", entry.name.c_str(),
+                      "line", entry.line, "col", entry.col, "match",
+                      entry.start, entry.end);
+    if (py_entry == NULL) {
+      Py_DECREF(py_entries);
+      return NULL;
+    }
+    PyList_SET_ITEM(py_entries, i, py_entry);
+  }
+  return py_entries;
 }
 
 static PyObject* py_handler_for(PyObject* self, PyObject* args,
-                                CursorKinds kinds) {
+                                CursorKinds kinds, bool referenced = false) {
   const char* filename;
-  const char* pattern;
-  bool use_index = false;
-  if (!PyArg_ParseTuple(args, "ssb", &filename, &pattern, &use_index)) {
+  const char* pattern_s;
+  // Keep the parsed unit for the next queries on the same file
+  bool cache = false;
+  if (!PyArg_ParseTuple(args, "ssb", &filename, &pattern_s, &cache)) {
+    return NULL;
+  }
+  std::regex pattern;
+  if (!compile_pattern(pattern_s, pattern)) {
     return NULL;
   }
-  auto entries = use_index ? process_file_with(get_indexed_file(filename),
-                                               kinds, filename, pattern)
-                           : process_file(_index, kinds, filename, pattern);
-  auto* py_entries = PyList_New(0);
-  for (auto& entry : entries) {
-    auto* py_entry = PyDict_New();
-    PyObject* entry_name = PyUnicode_FromString(entry.name);
-    PyDict_SetItemString(py_entry, "name", entry_name);
-    PyObject* entry_line = PyLong_FromLong(entry.line);
-    PyObject* entry_col = PyLong_FromLong(entry.col);
-    PyDict_SetItemString(py_entry, "line", entry_line);
-
-    auto* py_match = PyTuple_New(2);
-    PyObject* start_pos = PyLong_FromLong(entry.match.position(0));
-    PyObject* end_pos =
-        PyLong_FromLong(entry.match.position(0) + entry.match.length(0));
-    PyTuple_SET_ITEM(py_match, 0, start_pos);
-    PyTuple_SET_ITEM(py_match, 1, end_pos);
-    PyDict_SetItemString(py_entry, "match", py_match);
-
-    PyDict_SetItemString(py_entry, "col", entry_col);
-
-    PyList_Append(py_entries, py_entry);
+  // Only references need function bodies, everything else is declared outside
+  CXTranslationUnit unit =
+      cache ? get_indexed_file(filename, referenced)
+            : parse_unit(_index, absolute_path(filename), referenced, false);
+  if (unit == nullptr) {
+    return PyList_New(0);
   }
-  return py_entries;
+  auto entries = process_file_with(unit, kinds, pattern, referenced);
+  if (!cache) {
+    clang_disposeTranslationUnit(unit);
+  }
+  return entries_to_py(entries);
+}
+
+// Searches `files` on `threads` native threads, each with its own libclang
+// index. Doesn't touch any Python object, so it runs without the GIL.
+static std::vector<std::vector<Entry>> search_files(
+    const std::vector<std::string>& files, const CursorKinds& kinds,
+    const std::regex& pattern, bool referenced, unsigned threads) {
+  std::vector<std::vector<Entry>> results(files.size());
+  std::atomic<size_t> next{0};
+  auto work = [&]() {
+    CXIndex index = clang_createIndex(0, 0);
+    for (size_t i = next++; i < files.size(); i = next++) {
+      CXTranslationUnit unit = nullptr;
+      // An exception leaving the thread would terminate the process, the
+      // file is reported and left without matches instead
+      try {
+        unit = parse_unit(index, absolute_path(files[i].c_str()), referenced,
+                          false);
+        if (unit != nullptr) {
+          results[i] = process_file_with(unit, kinds, pattern, referenced);
+        }
+      } catch (const std::exception& e) {
+        cerr << "Unable to search " << files[i] << ": " << e.what() << endl;
+      }
+      if (unit != nullptr) {
+        clang_disposeTranslationUnit(unit);
+      }
+    }
+    clang_disposeIndex(index);
+  };
+  threads = std::max(1u, std::min<unsigned>(threads, files.size()));
+  std::vector<std::thread> pool;
+  for (unsigned t = 1; t < threads; ++t) {
+    pool.emplace_back(work);
+  }
+  work();
+  for (auto& thread : pool) {
+    thread.join();
+  }
+  return results;
+}
+
+// Takes a sequence of paths, a pattern and a number of threads. Returns a
+// list with the matches of every file, as (name, line, col, match start,
+// match end) tuples.
+static PyObject* py_batch_handler_for(PyObject* self, PyObject* args,
+                                      CursorKinds kinds,
+                                      bool referenced = false) {
+  PyObject* py_files;
+  const char* pattern_s;
+  unsigned threads = 1;
+  if (!PyArg_ParseTuple(args, "Os|I", &py_files, &pattern_s, &threads)) {
+    return NULL;
+  }
+  std::regex pattern;
+  if (!compile_pattern(pattern_s, pattern)) {
+    return NULL;
+  }
+  PyObject* seq = PySequence_Fast(py_files, "files must be a sequence");
+  if (seq == NULL) {
+    return NULL;
+  }
+  std::vector<std::string> files;
+  Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+  for (Py_ssize_t i = 0; i < n; ++i) {
+    const char* f = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(seq, i));
+    if (f == NULL) {
+      Py_DECREF(seq);
+      return NULL;
+    }
+    files.emplace_back(f);
+  }
+  Py_DECREF(seq);
+  std::vector<std::vector<Entry>> results;
+  Py_BEGIN_ALLOW_THREADS;
+  results = search_files(files, kinds, pattern, referenced, threads);
+  Py_END_ALLOW_THREADS;
+  auto* py_results = PyList_New(results.size());
+  if (py_results == NULL) {
+    return NULL;
+  }
+  for (size_t i = 0; i < results.size(); ++i) {
+    auto* py_rows = PyList_New(results[i].size());
+    if (py_rows == NULL) {
+      Py_DECREF(py_results);
+      return NULL;
+    }
+    PyList_SET_ITEM(py_results, i, py_rows);
+    for (size_t j = 0; j < results[i].size(); ++j) {
+      auto& entry = results[i][j];
+      PyObject* row = Py_BuildValue("(sIIll)", entry.name.c_str(), entry.line,
+                                    entry.col, entry.start, entry.end);
+      if (row == NULL) {
+        Py_DECREF(py_results);
+        return NULL;
+      }
+      PyList_SET_ITEM(py_rows, j, row);
+    }
+  }
+  return py_results;
 }
 
 // find all functions inside of a given file
@@ -182,19 +468,80 @@ static PyObject* file_cls(PyObject* self, PyObject* args) {
   return py_handler_for(self, args, CLASS_CURSOR_KINDS);
 }
 
+// find all references to declarations inside of a given file
+static PyObject* file_refs(PyObject* self, PyObject* args) {
+  return py_handler_for(self, args, REFERENCE_CURSOR_KINDS, true);
+}
+
+static PyObject* files_fun(PyObject* self, PyObject* args) {
+  return py_batch_handler_for(self, args, FUNCTION_CURSOR_KINDS);
+}
+
+static PyObject* files_cls(PyObject* self, PyObject* args) {
+  return py_batch_handler_for(self, args, CLASS_CURSOR_KINDS);
+}
+
+static PyObject* files_refs(PyObject* self, PyObject* args) {
+  return py_batch_handler_for(self, args, REFERENCE_CURSOR_KINDS, true);
+}
+
+// The functions, classes and references of a file, as three lists of entries.
+// All of them come from one cached unit parsed with function bodies.
+static PyObject* file_symbols(PyObject* self, PyObject* args) {
+  const char* filename;
+  if (!PyArg_ParseTuple(args, "s", &filename)) {
+    return NULL;
+  }
+  // Matches every name
+  std::regex any("");
+  CXTranslationUnit unit = get_indexed_file(filename, true);
+  std::vector<Entry> functions, classes, refs;
+  if (unit != nullptr) {
+    functions = process_file_with(unit, FUNCTION_CURSOR_KINDS, any);
+    classes = process_file_with(unit, CLASS_CURSOR_KINDS, any);
+    refs = process_file_with(unit, REFERENCE_CURSOR_KINDS, any, true);
+  }
+  auto* py_symbols = PyTuple_New(3);
+  if (py_symbols == NULL) {
+    return NULL;
+  }
+  const std::vector<Entry>* lists[] = {&functions, &classes, &refs};
+  for (Py_ssize_t i = 0; i < 3; ++i) {
+    PyObject* py_entries = entries_to_py(*lists[i]);
+    if (py_entries == NULL) {
+      Py_DECREF(py_symbols);
+      return NULL;
+    }
+    PyTuple_SET_ITEM(py_symbols, i, py_entries);
+  }
+  return py_symbols;
+}
+
+static PyObject* parse_count(PyObject* self, PyObject* args) {
+  return PyLong_FromUnsignedLong(parses);
+}
+
 static PyObject* index_file(PyObject* self, PyObject* args) {
   const char* filename;
   if (!PyArg_ParseTuple(args, "s", &filename)) {
     return NULL;
   }
-  build_index(filename);
-  auto* res = PyBool_FromLong(1);
-  return res;
+  // Parse it with bodies so that every kind of query can use it
+  return PyBool_FromLong(get_indexed_file(filename, true) != nullptr);
 }
 
 static PyMethodDef cppHandlerMethods[] = {
     {"file_fun", file_fun, METH_VARARGS, "File functions"},
     {"file_cls", file_cls, METH_VARARGS, "File class declarations"},
+    {"file_refs", file_refs, METH_VARARGS, "File references"},
+    {"files_fun", files_fun, METH_VARARGS, "Functions of several files"},
+    {"files_cls", files_cls, METH_VARARGS,
+     "Class declarations of several files"},
+    {"files_refs", files_refs, METH_VARARGS, "References of several files"},
+    {"file_symbols", file_symbols, METH_VARARGS,
+     "Functions, classes and references of a file"},
+    {"parse_count", parse_count, METH_NOARGS,
+     "Translation units parsed or reparsed so far"},
     {"index_file", index_file, METH_VARARGS, "Index file"},
     {NULL, NULL, 0, NULL} /* Sentinel */
 };
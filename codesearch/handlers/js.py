@@ -1,74 +1,286 @@
 import re
 import os
+from typing import List, Optional
 from codesearch.config import Config
 from codesearch.entry import Entry, EntryKind
+from codesearch.handlers import cached_symbols, match_symbols
+from codesearch.symbols import FileSymbols
 import esprima
 
 
 class JSHandler:
+    EXTRACTOR = "js:4"
+    # Every reported name is spelled out in the source, which lets searches
+    # skip files that don't contain the literals of the pattern
+    LITERAL_NAMES = True
+    # ...up to the dots joining methods to their class
+    QUALIFIER = "."
+
     @classmethod
-    def parse_file(cls, f: str):
-        with open(f, "r") as source:
-            program = source.read()
-            is_typescript = str(f).endswith(".ts")
-            is_jsx = str(f).endswith(".jsx")
-            tree = esprima.parse(
-                program,
-                {
-                    "loc": True,
-                    "sourceType": "module",
-                    "jsx": is_jsx,
-                    "typescript": is_typescript,
-                },
-            )
-            return tree
+    def parse_source(cls, f: str, program: str, delegate=None):
+        is_typescript = str(f).endswith(".ts")
+        is_jsx = str(f).endswith(".jsx")
+        tree = esprima.parse(
+            program,
+            {
+                "loc": True,
+                "sourceType": "module",
+                "jsx": is_jsx,
+                "typescript": is_typescript,
+            },
+            delegate,
+        )
+        return tree
 
     @classmethod
     def index_file(cls, f: str):
-        return cls.parse_file(f)
+        with open(f, "rb") as source:
+            return cls.index_source(f, source.read())
 
     @classmethod
-    def cls(cls, config: Config, f: str, pattern, index=None):
-        if index is None:
-            tree = JSHandler.parse_file(f)
-        else:
-            tree = index
+    def index_source(cls, f: str, source: bytes):
+        identifiers = []
+
+        def collect_identifier(node, metadata):
+            if node.type == "Identifier":
+                loc = node.loc.start
+                identifiers.append((node.name, loc.line, loc.column))
+
+        tree = cls.parse_source(f, source.decode(), collect_identifier)
+        symbols = FileSymbols()
         for item in tree.body:
-            if item.type == "ClassDeclaration":
-                loc = item.id.loc
+            if item.type in ("ExportNamedDeclaration", "ExportDefaultDeclaration"):
+                item = item.declaration
+                if item is None:
+                    continue
+            if item.type == "ClassDeclaration" and item.id is not None:
                 name = item.id.name
-            else:
-                continue
-            if not pattern.search(name):
+                loc = item.id.loc
+                symbols.add(EntryKind.Class, name, loc.start.line, loc.start.column)
+                for member in item.body.body:
+                    if (
+                        member.type == "MethodDefinition"
+                        and member.key.type == "Identifier"
+                        and not member.computed
+                    ):
+                        loc = member.key.loc
+                        symbols.add(
+                            EntryKind.Function,
+                            f"{name}.{member.key.name}",
+                            loc.start.line,
+                            loc.start.column,
+                        )
                 continue
-            line = loc.start.line
-            col = loc.start.column
-            yield Entry(line=line, col=col, name=name, kind=EntryKind.Class)
-        return []
-
-    @classmethod
-    def fun(cls, config: Config, f: str, pattern, index=None):
-        if index is None:
-            tree = JSHandler.parse_file(f)
-        else:
-            tree = index
-        for item in tree.body:
             if (
                 item.type == "VariableDeclaration"
+                and item.declarations[0].id.type == "Identifier"
+                and item.declarations[0].init is not None
                 and item.declarations[0].init.type == "ArrowFunctionExpression"
             ):
                 # arrow functions
                 loc = item.declarations[0].id.loc
                 name = item.declarations[0].id.name
-            elif item.type == "FunctionDeclaration":
+            elif item.type == "FunctionDeclaration" and item.id is not None:
                 # regular function declarations
                 loc = item.id.loc
                 name = item.id.name
             else:
                 continue
-            if not pattern.search(name):
-                continue
-            line = loc.start.line
-            col = loc.start.column
-            yield Entry(line=line, col=col, name=name, kind=EntryKind.Function)
-        return []
+            symbols.add(EntryKind.Function, name, loc.start.line, loc.start.column)
+        # Every identifier except for the declarations above is a reference
+        declared = set(zip(symbols.lines, symbols.cols))
+        for name, line, col in identifiers:
+            if (line, col) not in declared:
+                symbols.add(EntryKind.Reference, name, line, col)
+        return symbols
+
+    @classmethod
+    def cls(cls, config: Config, f: str, pattern, index=None):
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Class, pattern)
+
+    @classmethod
+    def fun(cls, config: Config, f: str, pattern, index=None):
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Function, pattern)
+
+    @classmethod
+    def ref(cls, config: Config, f: str, pattern, index=None):
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Reference, pattern)
+
+
+class JSFastHandler(JSHandler):
+    """
+    Fast mode: finds top-level and exported functions, arrow function
+    constants and classes with their methods by scanning the text for their
+    headers, skipping over strings, comments, templates and regular
+    expressions. TypeScript syntax is passed over, and the scan never fails.
+
+    Reference searches need a full parse and are left to JSHandler.
+    """
+
+    EXTRACTOR = "js-fast:1"
+
+    @classmethod
+    def ref(cls, config: Config, f: str, pattern, index=None):
+        yield from JSHandler.ref(config, f, pattern, index)
+
+    @classmethod
+    def index_file(cls, f: str):
+        with open(f, "rb") as source:
+            return cls.index_source(f, source.read())
+
+    @classmethod
+    def index_source(cls, f: str, source: bytes):
+        symbols = FileSymbols()
+        scan_declarations(source.decode("utf-8", errors="replace"), symbols)
+        return symbols
+
+
+NAME = r"[A-Za-z_$][\w$]*"
+
+
+def balanced(depth: int) -> str:
+    """Text with parentheses and braces balanced up to `depth` levels deep"""
+    if depth == 0:
+        return r"[^(){};]*"
+    inner = balanced(depth - 1)
+    return rf"(?:[^(){{}};]|\({inner}\)|\{{{inner}\}})*"
+
+
+PARAMS = rf"\({balanced(2)}\)"
+# Declarations start statements, unlike function and class expressions
+STATEMENT = r"(?:^|(?<=[;{}/]))\s*(?:export\s+(?:default\s+)?)?"
+MODIFIERS = "static|async|get|set|public|private|protected|readonly|abstract|override"
+SCAN_TEMPLATE = r"""
+    (?P<skip>
+        //[^\n]*
+        | /\*.*?(?:\*/|\Z)
+        | '(?:\\.|[^'\\\n])*'
+        | "(?:\\.|[^"\\\n])*"
+        # Regular expressions can only follow an operator or a keyword
+        | (?:[(,=:\[!&|?;]|\breturn|\btypeof)\s*
+          /(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/
+    )
+    | (?P<template>`)
+    | (?P<open>\{)
+    | (?P<close>\})
+    | (?P<function>
+        STATEMENT(?:async\s+)?function\b\s*\*?\s*(?P<function_name>NAME)
+    )
+    | (?P<class>
+        STATEMENT(?:declare\s+)?(?:abstract\s+)?class\s+(?P<class_name>NAME)
+    )
+    | (?P<arrow>
+        \b(?:const|let|var)\s+(?P<arrow_name>NAME)\s*(?::[^=;{]*)?=\s*
+        (?:async\s+)?(?:NAME|(?:<[^<>]*>\s*)?PARAMS)\s*(?::[^=;{]*)?=>
+    )
+    | (?P<method>
+        (?:^|(?<=[{};]))[ \t]*(?:(?:MODIFIERS)\s+)*\*?\s*(?P<method_name>\#?NAME)
+        \s*\??\s*(?:<[^<>]*>)?\s*PARAMS\s*(?::[^{};=]*)?(?=\{)
+    )
+    """
+SCAN = re.compile(
+    SCAN_TEMPLATE.replace("STATEMENT", STATEMENT)
+    .replace("NAME", NAME)
+    .replace("PARAMS", PARAMS)
+    .replace("MODIFIERS", MODIFIERS),
+    re.VERBOSE | re.MULTILINE | re.DOTALL,
+)
+# The rest of a template literal, up to its end or its next substitution
+TEMPLATE = re.compile(r"(?:\\.|[^`\\$]|\$(?!\{))*(?:`|\$\{|\Z)", re.DOTALL)
+# Characters after which a function or class is an expression
+EXPRESSION_CONTINUATIONS = set("=(,:?&|!+-*<>[")
+METHOD_KEYWORDS = {"if", "for", "while", "switch", "catch", "with", "function"}
+
+
+def continues_expression(text: str, pos: int, skipped: int) -> bool:
+    """
+    Whether the code before `pos` ends in the middle of an expression.
+    `skipped` is the end of the last string or comment before it.
+    """
+    pos -= 1
+    while pos >= 0 and text[pos] in " \t\r\n":
+        pos -= 1
+    return pos >= 0 and pos + 1 != skipped and text[pos] in EXPRESSION_CONTINUATIONS
+
+
+def scan_declarations(text: str, symbols: FileSymbols):
+    # One entry per open brace, True for the ones opening a template substitution
+    braces: List[bool] = []
+    # Class whose body opens at the next top-level brace, and the class whose
+    # body is open
+    pending_class: Optional[str] = None
+    open_class: Optional[str] = None
+    line = 1
+    line_start = 0
+    counted = 0
+
+    def position(pos: int):
+        nonlocal line, line_start, counted
+        newlines = text.count("\n", counted, pos)
+        if newlines != 0:
+            line += newlines
+            line_start = text.rfind("\n", counted, pos) + 1
+        counted = pos
+        return line, pos - line_start
+
+    pos = 0
+    skipped = -1
+    while True:
+        m = SCAN.search(text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        group = m.lastgroup
+        depth = len(braces)
+        if group == "skip":
+            skipped = pos
+            continue
+        if group == "template" or group == "close" and depth != 0 and braces[-1]:
+            if group == "close":
+                braces.pop()
+            # Resume the template literal, up to its end or its next substitution
+            end = TEMPLATE.match(text, pos)
+            pos = end.end()
+            if end.group().endswith("${"):
+                braces.append(True)
+            continue
+        if group == "open":
+            if depth == 0 and pending_class is not None:
+                open_class, pending_class = pending_class, None
+            braces.append(False)
+            continue
+        if group == "close":
+            if depth != 0:
+                braces.pop()
+            if len(braces) == 0:
+                open_class = None
+            continue
+        if group == "method":
+            name = m.group("method_name")
+            if depth == 1 and open_class is not None and name not in METHOD_KEYWORDS:
+                symbols.add(
+                    EntryKind.Function,
+                    f"{open_class}.{name}",
+                    *position(m.start("method_name")),
+                )
+            continue
+        if (
+            depth != 0
+            or group != "arrow"
+            and continues_expression(text, m.start(), skipped)
+        ):
+            continue
+        if group == "class":
+            name = m.group("class_name")
+            symbols.add(EntryKind.Class, name, *position(m.start("class_name")))
+            pending_class = name
+        else:
+            name_group = group + "_name"
+            symbols.add(
+                EntryKind.Function,
+                m.group(name_group),
+                *position(m.start(name_group)),
+            )
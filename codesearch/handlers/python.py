@@ -4,104 +4,244 @@ import os
 import pathlib
 from codesearch.config import Config
 from codesearch.entry import Entry, EntryKind
+from codesearch.handlers import cached_symbols, match_symbols
+from codesearch.symbols import FileSymbols
 from pydoc import importfile
 import ast
+import bisect
+from typing import List, Tuple
 from codesearch.logger import logger
 
 
 class PythonHandler:
+    # Identifies the shape of the symbols produced by index_file().
+    # Change it whenever the extraction logic changes so that persisted indexes get rebuilt.
+    EXTRACTOR = "py:4"
+    # Every reported name is spelled out in the source, which lets searches
+    # skip files that don't contain the literals of the pattern
+    LITERAL_NAMES = True
+    # ...up to the dots joining nested definitions to their parents
+    QUALIFIER = "."
+
     @classmethod
     def cls(cls, config: Config, f: pathlib.Path, pattern, index=None):
-        if index is not None:
-            tree = index
-        else:
-            with open(f, "r") as pyf:
-                source = pyf.read()
-            tree = ast.parse(source)
-        for node in tree.body:
-            if isinstance(node, ast.ClassDef):
-                name = node.name
-                line = node.lineno
-                match = re.search(pattern, name)
-                if not match:
-                    continue
-                entry = Entry(
-                    line=line, name=name, kind=EntryKind.Class, match=match.span()
-                )
-                yield entry
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Class, pattern)
 
     @classmethod
-    def ref(cls, config: Config, f: pathlib.Path, symname, index=None):
-        if index is not None:
-            tree = index
-        else:
-            with open(f, "r") as pyf:
-                source = pyf.read()
-            tree = ast.parse(source)
-        refs_found = []
-
-        def determine_name_of_call_node(node):
-            if isinstance(node.value.func, ast.Name):
-                return node.value.func.id
-            elif node.value.func.value.id == symname:
-                return node.value.func.value.id
-            else:
-                logger.warn("Unrecognized call node")
-                logger.warn(node)
-                return None
-
-        def find_refs_in(body):
-            for node in body:
-                if isinstance(node, ast.FunctionDef):
-                    find_refs_in(node.body)
-                elif isinstance(node, ast.Expr):
-                    if isinstance(node.value, ast.Call):
-                        name = determine_name_of_call_node(node)
-                        if name is None:
-                            continue
-                        if name != symname:
-                            continue
-                        refs_found.append(
-                            Entry(line=node.lineno, kind=EntryKind.Call, name=name)
-                        )
-
-        find_refs_in(tree.body)
-        return refs_found
-        # if isinstance(node, ast.ClassDef):
-        #     name = node.name
-        #     line = node.lineno
-        #     match = re.search(pattern, name)
-        #     if not match:
-        #         continue
-        #     entry = Entry(
-        #         line=line, name=name, kind=EntryKind.Class, match=match.span()
-        #     )
-        #     yield entry
+    def ref(cls, config: Config, f: pathlib.Path, pattern, index=None):
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Reference, pattern)
 
     @classmethod
     def index_file(cls, f: pathlib.Path):
-        with open(f, "r") as pyf:
-            source = pyf.read()
+        with open(f, "rb") as pyf:
+            return cls.index_source(f, pyf.read())
+
+    @classmethod
+    def index_source(cls, f: pathlib.Path, source: bytes):
+        """Symbols of `source`, the content of `f`, which doesn't have to exist"""
         tree = ast.parse(source)
-        return tree
+        extractor = SymbolExtractor()
+        extractor.visit(tree)
+        return extractor.symbols
 
     @classmethod
     def fun(cls, config: Config, f: pathlib.Path, pattern, index=None):
-        if index is not None:
-            tree = index
+        symbols = index if index is not None else cached_symbols(cls, f)
+        yield from match_symbols(symbols, EntryKind.Function, pattern)
+
+
+class SymbolExtractor(ast.NodeVisitor):
+    """
+    Collects every definition and identifier reference of a module in a
+    single walk.
+
+    Functions and classes defined inside other definitions get qualified
+    names, e.g. "Class.method" or "outer.inner".
+    """
+
+    def __init__(self):
+        self.symbols = FileSymbols()
+        self.scope: List[str] = []
+
+    def _definition(self, node, kind: EntryKind):
+        name = ".".join([*self.scope, node.name])
+        self.symbols.add(kind, name, node.lineno, node.col_offset)
+        # Decorators and defaults belong to the enclosing scope
+        for child in node.decorator_list:
+            self.visit(child)
+        if not isinstance(node, ast.ClassDef):
+            self.visit(node.args)
+            if node.returns is not None:
+                self.visit(node.returns)
         else:
-            with open(f, "r") as pyf:
-                source = pyf.read()
-            tree = ast.parse(source)
-        for node in tree.body:
-            if isinstance(node, ast.FunctionDef):
-                line = node.lineno
-                name = node.name
-                match = re.search(pattern, name)
-                if not match:
-                    continue
-                entry = Entry(
-                    line=line, name=name, kind=EntryKind.Function, match=match.span()
-                )
-                yield entry
-        return []
+            for child in [*node.bases, *node.keywords]:
+                self.visit(child)
+        self.scope.append(node.name)
+        for child in node.body:
+            self.visit(child)
+        self.scope.pop()
+
+    def visit_FunctionDef(self, node):
+        self._definition(node, EntryKind.Function)
+
+    def visit_AsyncFunctionDef(self, node):
+        self._definition(node, EntryKind.Function)
+
+    def visit_ClassDef(self, node):
+        self._definition(node, EntryKind.Class)
+
+    def _reference(self, name: str, line: int, col: int):
+        self.symbols.add(EntryKind.Reference, name, line, col)
+
+    def visit_Name(self, node):
+        self._reference(node.id, node.lineno, node.col_offset)
+
+    def visit_Attribute(self, node):
+        self.visit(node.value)
+        # The attribute name is the last token of the node
+        self._reference(
+            node.attr, node.end_lineno, node.end_col_offset - len(node.attr)
+        )
+
+    def visit_Constant(self, node):
+        # Nothing to collect, and skips NodeVisitor's slow fallback for constants
+        pass
+
+    def visit_keyword(self, node):
+        if node.arg is not None:
+            self._reference(node.arg, node.lineno, node.col_offset)
+        self.visit(node.value)
+
+    def visit_alias(self, node):
+        # Imported names, only located since Python 3.10
+        if "." not in node.name and node.name != "*" and hasattr(node, "lineno"):
+            self._reference(node.name, node.lineno, node.col_offset)
+
+
+class PythonFastHandler(PythonHandler):
+    """
+    Fast mode: definitions are found by scanning the text for `def`/`class`
+    headers instead of parsing it, with scopes tracked through indentation.
+
+    The scan never fails, so half-edited files still yield their definitions.
+    Reference searches need a real parse and are left to PythonHandler.
+    """
+
+    EXTRACTOR = "py-fast:1"
+    LITERAL_NAMES = True
+    QUALIFIER = "."
+
+    @classmethod
+    def ref(cls, config: Config, f: pathlib.Path, pattern, index=None):
+        yield from PythonHandler.ref(config, f, pattern, index)
+
+    @classmethod
+    def index_file(cls, f: pathlib.Path):
+        with open(f, "rb") as pyf:
+            return cls.index_source(f, pyf.read())
+
+    @classmethod
+    def index_source(cls, f: pathlib.Path, source: bytes):
+        symbols = FileSymbols()
+        scan_definitions(source.decode("utf-8", errors="replace"), symbols)
+        return symbols
+
+
+HEADER = re.compile(
+    r"^([ \t]*)(?:async[ \t]+)?(def|class)[ \t]+([^\W\d]\w*)", re.MULTILINE
+)
+CLOSING_QUOTE = {
+    q: re.compile(r"(?<!\\)(?:\\\\)*" + re.escape(q)) for q in ("'''", '"""')
+}
+# Skips code, comments and strings that end on their line (whatever their
+# prefix, which is left out), then captures what may span several lines:
+# triple quotes, strings continued with backslashes, line continuations and
+# quotes that are never closed
+TOKEN = re.compile(
+    r"""(?:[^'"#\\]+|#[^\n]*|\\[^\r\n]"""
+    r"""|(?!\'\'\')'[^'\\\n]*(?:\\[^\r\n][^'\\\n]*)*'|(?!\"\"\")"[^"\\\n]*(?:\\[^\r\n][^"\\\n]*)*")*"""
+    r"""(\'\'\'|\"\"\"|'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'|"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"|\\[\s\S]?|['"]|\Z)"""
+)
+# Indentation -> regex finding the first statement that closes a body at that indentation
+dedent_regexes = {}
+
+
+def dedent_regex(indent: int) -> re.Pattern:
+    regex = dedent_regexes.get(indent, None)
+    if regex is None:
+        # Comments, closing brackets and strings at the start of a line are
+        # taken to be inside a body (or a continuation line)
+        regex = dedent_regexes[indent] = re.compile(
+            r"^[ \t]{0,%d}[^ \t\r\n#)\]}\'\"]" % indent, re.MULTILINE
+        )
+    return regex
+
+
+def multiline_strings(text: str) -> Tuple[List[int], List[int]]:
+    """
+    Starts and ends of the strings of `text` that span several lines. Line
+    continuations count as strings running to the start of the next line.
+    """
+    starts: List[int] = []
+    ends: List[int] = []
+    pos = 0
+    while True:
+        m = TOKEN.match(text, pos)
+        token = m.group(1)
+        if len(token) == 0:
+            break
+        pos = m.end()
+        if token == "'''" or token == '"""':
+            closing = CLOSING_QUOTE[token].search(text, pos)
+            pos = closing.end() if closing is not None else len(text)
+        elif token[0] == "\\":
+            # The next line is only a continuation, whatever it starts with
+            starts.append(m.start(1))
+            ends.append(pos + 1)
+            continue
+        elif "\n" not in token:
+            continue
+        starts.append(m.start(1))
+        ends.append(pos)
+    return starts, ends
+
+
+def scan_definitions(text: str, symbols: FileSymbols):
+    starts, ends = multiline_strings(text)
+
+    def in_string(pos: int) -> int:
+        """The end of the string `pos` is in, or -1"""
+        i = bisect.bisect_right(starts, pos) - 1
+        return ends[i] if i >= 0 and pos < ends[i] else -1
+
+    def body_end(indent: int, pos: int) -> int:
+        regex = dedent_regex(indent)
+        while True:
+            m = regex.search(text, pos)
+            if m is None:
+                return len(text)
+            pos = in_string(m.start())
+            if pos == -1:
+                return m.start()
+
+    # (name, indentation, end of body) of the enclosing definitions
+    scope: List[Tuple[str, int, int]] = []
+    line = 1
+    last = 0
+    for m in HEADER.finditer(text):
+        start = m.start()
+        if in_string(start) != -1:
+            continue
+        line += text.count("\n", last, start)
+        last = start
+        indent = len(m.group(1))
+        while len(scope) != 0 and (scope[-1][1] >= indent or scope[-1][2] <= start):
+            scope.pop()
+        name = m.group(3)
+        kind = EntryKind.Function if m.group(2) == "def" else EntryKind.Class
+        symbols.add(kind, ".".join([*[n for n, _, _ in scope], name]), line, indent)
+        header_end = text.find("\n", m.end())
+        end = body_end(indent, header_end + 1) if header_end != -1 else len(text)
+        scope.append((name, indent, end))
@@ -0,0 +1,179 @@
+"""
+Extraction of the literal strings a regular expression needs in order to match.
+
+The result is a conjunction of clauses, each clause being a set of strings of
+which at least one has to appear in any matching text. Literals are lowercased,
+so the clauses are also valid for case-insensitive matching.
+"""
+
+import functools
+import re
+from typing import List, Optional, Set
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants  # type: ignore
+    import sre_parse  # type: ignore
+
+# Give up on enumerating every string a piece of the pattern can match past this
+MAX_EXACT = 32
+# Character classes with more members than this are treated as "any character"
+MAX_CLASS = 8
+
+Clause = Set[str]
+
+
+class _Info:
+    __slots__ = ("exact", "required")
+
+    def __init__(self, exact: Optional[Set[str]] = None, required=None):
+        # Every string this piece can match, or None if there are too many of them
+        self.exact = exact
+        # Clauses that hold for every match of this piece
+        self.required: List[Clause] = required if required is not None else []
+
+    def clauses(self) -> List[Clause]:
+        if self.exact is None:
+            return list(self.required)
+        return [*self.required, self.exact]
+
+    def best_clause(self) -> Optional[Clause]:
+        """The most selective clause, judged by its shortest literal"""
+        clauses = [c for c in self.clauses() if len(c) != 0 and "" not in c]
+        if len(clauses) == 0:
+            return None
+        return max(clauses, key=lambda c: min(map(len, c)))
+
+
+def _empty() -> _Info:
+    return _Info(exact={""})
+
+
+def _unknown() -> _Info:
+    return _Info()
+
+
+def _alternate(branches: List[_Info]) -> _Info:
+    if all(b.exact is not None for b in branches):
+        exact = set().union(*[b.exact for b in branches])
+        if len(exact) <= MAX_EXACT:
+            return _Info(exact=exact)
+    clause: Clause = set()
+    for b in branches:
+        best = b.best_clause()
+        if best is None:
+            # This branch can match without any particular literal
+            return _unknown()
+        clause |= best
+    return _Info(required=[clause])
+
+
+def _repeat(lo: int, hi, info: _Info) -> _Info:
+    if lo == 0:
+        if hi == 1 and info.exact is not None:
+            return _Info(exact={"", *info.exact})
+        return _unknown()
+    if lo == 1 and hi == 1:
+        return info
+    return _Info(required=info.clauses())
+
+
+def _char_class(items) -> _Info:
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add(chr(av).lower())
+        elif op == sre_constants.RANGE and av[1] - av[0] < MAX_CLASS:
+            chars |= {chr(c).lower() for c in range(av[0], av[1] + 1)}
+        else:
+            return _unknown()
+        if len(chars) > MAX_CLASS:
+            return _unknown()
+    return _Info(exact=chars)
+
+
+def _analyze(subpattern) -> _Info:
+    required: List[Clause] = []
+    # Strings matched by the current run of pieces with a known set of matches
+    run: Clause = {""}
+    # Whether `run` covers everything matched so far
+    whole = True
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            piece = _Info(exact={chr(av).lower()})
+        elif op == sre_constants.IN:
+            piece = _char_class(av)
+        elif op == sre_constants.SUBPATTERN:
+            piece = _analyze(av[-1])
+        elif op == sre_constants.BRANCH:
+            piece = _alternate([_analyze(b) for b in av[1]])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or (
+            op == getattr(sre_constants, "POSSESSIVE_REPEAT", None)
+        ):
+            lo, hi, p = av
+            piece = _repeat(lo, hi, _analyze(p))
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # zero-width
+            piece = _empty()
+        else:
+            piece = _unknown()
+        required += piece.required
+        if piece.exact is not None and len(run) * len(piece.exact) <= MAX_EXACT:
+            run = {x + y for x in run for y in piece.exact}
+            continue
+        # The run ends here, whatever it matched is required to appear
+        required.append(run)
+        whole = False
+        run = piece.exact if piece.exact is not None else {""}
+    if whole:
+        return _Info(exact=run, required=required)
+    return _Info(required=[*required, run])
+
+
+def required_literals(pattern) -> List[Clause]:
+    """
+    Returns the clauses a text has to satisfy to possibly match `pattern`.
+    Clauses that are satisfied by the empty string are dropped.
+    """
+    if isinstance(pattern, re.Pattern):
+        pattern = pattern.pattern
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    clauses = _analyze(parsed).clauses()
+    return [c for c in clauses if len(c) != 0 and "" not in c]
+
+
+@functools.lru_cache(maxsize=256)
+def exact_name(pattern) -> Optional[str]:
+    """
+    The only string `pattern` matches as a whole, when it is a literal anchored
+    at both ends (like `^name$`), None otherwise.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    except re.error:
+        return None
+    if len(parsed) < 2:
+        return None
+    first, last = parsed[0], parsed[-1]
+    if first[0] != sre_constants.AT or first[1] not in (
+        sre_constants.AT_BEGINNING,
+        sre_constants.AT_BEGINNING_STRING,
+    ):
+        return None
+    if last[0] != sre_constants.AT or last[1] not in (
+        sre_constants.AT_END,
+        sre_constants.AT_END_STRING,
+    ):
+        return None
+    chars = []
+    for op, av in parsed[1:-1]:
+        if op != sre_constants.LITERAL:
+            return None
+        chars.append(chr(av))
+    return "".join(chars)
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+from json.encoder import encode_basestring_ascii as json_string
+from typing import IO, Iterable, List, Optional, Sequence, Tuple, Union
+
+from codesearch.entry import Entries, Entry, entry_kind_to_str
+from codesearch.util import COL_ENDC, COL_OKGREEN, COL_WARNING
+
+FORMATS = ("text", "jsonl", "tsv", "null")
+# Machine-readable output is written out in chunks of about this many characters
+OUTPUT_CHUNK = 64 * 1024
+
+Results = Union[Entries, Iterable[Tuple[str, List[Entry]]]]
+
+
+def use_color(out: IO) -> bool:
+    """Colors only go to terminals, and never when NO_COLOR is set"""
+    if "NO_COLOR" in os.environ:
+        return False
+    isatty = getattr(out, "isatty", None)
+    return isatty is not None and isatty()
+
+
+def match_span(entry: Entry) -> Tuple[int, int]:
+    match = entry.match
+    if match is None:
+        return 0, 0
+    if isinstance(match, re.Match):
+        return match.span()
+    start, end = match
+    return start, end
+
+
+def tsv_field(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def text_lines(f: str, fentries: List[Entry], color: bool) -> List[str]:
+    green, yellow, end = (COL_OKGREEN, COL_WARNING, COL_ENDC) if color else ("",) * 3
+    lines = [f"{green}{f}{end}\n"]
+    for entry in fentries:
+        start, stop = match_span(entry)
+        name = entry.name
+        kind = entry_kind_to_str[entry.kind]
+        lines.append(
+            f"\t{kind} [{entry.line}:{entry.col}]: {name[:start]}"
+            f"{yellow}{name[start:stop]}{end}{name[stop:]}\n"
+        )
+    return lines
+
+
+def jsonl_lines(
+    f: str, fentries: List[Entry], query: Optional[int] = None
+) -> List[str]:
+    prefix = "{" if query is None else f'{{"query":{query},'
+    prefix += '"file":' + json_string(f)
+    lines = []
+    for entry in fentries:
+        start, stop = match_span(entry)
+        lines.append(
+            f'{prefix},"line":{entry.line},"col":{entry.col},'
+            f'"kind":"{entry_kind_to_str[entry.kind]}",'
+            f'"name":{json_string(entry.name)},"match":[{start},{stop}]}}\n'
+        )
+    return lines
+
+
+def tsv_lines(f: str, fentries: List[Entry], query: Optional[int] = None) -> List[str]:
+    f = tsv_field(f)
+    if query is not None:
+        f = f"{query}\t{f}"
+    lines = []
+    for entry in fentries:
+        start, stop = match_span(entry)
+        lines.append(
+            f"{f}\t{entry.line}\t{entry.col}\t{entry_kind_to_str[entry.kind]}\t"
+            f"{tsv_field(entry.name)}\t{start}\t{stop}\n"
+        )
+    return lines
+
+
+def write_search_results(
+    entries: Results,
+    format: str = "text",
+    color: Optional[bool] = None,
+    out: Optional[IO] = None,
+    query: Optional[int] = None,
+) -> int:
+    """
+    Writes search results in one of FORMATS and returns the number of entries.
+
+    `text` is meant for people: results of every file are shown as soon as
+    they come in, colored when `out` is a terminal unless `color` says
+    otherwise. The other formats print one entry per line (`null` prints
+    nothing) and are written in large chunks. With `query`, their lines
+    start with that query number.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format "{format}", use one of {", ".join(FORMATS)}')
+    out = out if out is not None else sys.stdout
+    items = entries.items() if isinstance(entries, dict) else entries
+    found = 0
+    if format == "text":
+        color = use_color(out) if color is None else color
+        for f, fentries in items:
+            if len(fentries) == 0:
+                continue
+            found += len(fentries)
+            out.write("".join(text_lines(f, fentries, color)))
+            # Show every file as soon as it's found, even when piped
+            out.flush()
+        if found == 0:
+            out.write("Nothing found\n")
+        out.flush()
+        return found
+    lines_for = jsonl_lines if format == "jsonl" else tsv_lines
+    chunk: List[str] = []
+    size = 0
+    for f, fentries in items:
+        found += len(fentries)
+        if format == "null" or len(fentries) == 0:
+            continue
+        lines = lines_for(f, fentries, query)
+        chunk.extend(lines)
+        size += sum(map(len, lines))
+        if size >= OUTPUT_CHUNK:
+            out.write("".join(chunk))
+            chunk = []
+            size = 0
+    out.write("".join(chunk))
+    out.flush()
+    return found
+
+
+def write_batch_results(
+    queries: Sequence[Tuple[str, str]],
+    results: Sequence[Results],
+    format: str = "text",
+    color: Optional[bool] = None,
+    out: Optional[IO] = None,
+) -> int:
+    """
+    Writes the results of several queries: under a header per query for
+    `text`, in the order of the queries with their (0-based) number as the
+    first field otherwise
+    """
+    out = out if out is not None else sys.stdout
+    found = 0
+    for i, ((handler_key, pattern), entries) in enumerate(zip(queries, results)):
+        if format == "text":
+            out.write(f"== {handler_key} {pattern}\n")
+        found += write_search_results(entries, format, color, out, query=i)
+    return found
+
+
+def print_search_results(entries: Results):
+    """Prints search results, either all at once or as they are streamed in"""
+    write_search_results(entries)
@@ -0,0 +1,214 @@
+import os
+import pathlib
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from codesearch.config import Config
+from codesearch.entry import Entry
+from codesearch.handlers import (
+    Stamp,
+    handler_for_file_type,
+    try_index_file,
+    try_index_stamped,
+)
+from codesearch.logger import logger
+from codesearch.prefilter import Prefilter
+from codesearch.symbols import FileSymbols
+
+if TYPE_CHECKING:
+    from codesearch.stats import SearchStats
+
+# Upper bound on the number of files a worker processes per task
+MAX_CHUNK_SIZE = 64
+# Files handed at once to the search_batch() of handlers that have one
+BATCH_FILES = 32
+
+
+def resolve_jobs(jobs) -> int:
+    """0 means one job per CPU core"""
+    if jobs is None:
+        return 1
+    jobs = int(jobs)
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def chunked(items: Sequence, jobs: int) -> List[Sequence]:
+    # Several chunks per worker so that a few slow files don't leave the other workers idle
+    size = max(1, min(MAX_CHUNK_SIZE, len(items) // (jobs * 4)))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def index_chunk(
+    files: Sequence[pathlib.Path], stamped: bool = False
+) -> List[Tuple[pathlib.Path, FileSymbols, Optional[Stamp]]]:
+    res = []
+    for f in files:
+        handler = handler_for_file_type(f)
+        if stamped:
+            parsed = try_index_stamped(handler, f)
+            if parsed is not None:
+                res.append((f, *parsed))
+            continue
+        symbols = try_index_file(handler, f)
+        if symbols is not None:
+            res.append((f, symbols, None))
+    return res
+
+
+def search_chunk(
+    handler_key: str,
+    config: Config,
+    pattern,
+    prefilter: Optional[Prefilter],
+    files: Sequence[pathlib.Path],
+) -> Tuple[List[Tuple[str, List[Entry]]], int]:
+    """Entries of the searched files, and how many files the prefilter skipped"""
+    res = []
+    skipped = 0
+    for f in files:
+        handler = handler_for_file_type(f, config.fast)
+        if prefilter is not None and not prefilter.admits(f, handler):
+            skipped += 1
+            continue
+        fun = getattr(handler, handler_key).__func__
+        try:
+            res.append((str(f), list(fun(handler, config, f, pattern))))
+        except Exception as e:
+            logger.warn(f'Failed to search "{f}": {e}')
+    return res, skipped
+
+
+class ParallelRunner:
+    """
+    Runs handlers over many files on a pool of worker processes.
+
+    Workers only ever send back symbol records and entries, never syntax trees.
+    Results are yielded in the same order as the input files, as soon as
+    every chunk before them is done.
+    """
+
+    def __init__(self, jobs: int):
+        # multiprocessing takes a while to import, most runs don't need it
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.jobs = jobs
+        self.pool = ProcessPoolExecutor(max_workers=jobs)
+
+    def index_files(
+        self, files: Sequence[pathlib.Path], stamped: bool = False
+    ) -> Iterator[Tuple[pathlib.Path, FileSymbols, Optional[Stamp]]]:
+        """Symbols of the files that could be parsed, stamped when asked to"""
+        chunks = chunked(files, self.jobs)
+        for res in self.pool.map(index_chunk, chunks, [stamped] * len(chunks)):
+            yield from res
+
+    def search_files(
+        self,
+        handler_key: str,
+        config: Config,
+        pattern,
+        files: Sequence[pathlib.Path],
+        prefilter: Optional[Prefilter] = None,
+        stats: Optional["SearchStats"] = None,
+    ) -> Iterator[Tuple[str, List[Entry]]]:
+        chunks = chunked(files, self.jobs)
+        n = len(chunks)
+        results = self.pool.map(
+            search_chunk,
+            [handler_key] * n,
+            [config] * n,
+            [pattern] * n,
+            [prefilter] * n,
+            chunks,
+        )
+        try:
+            for res, skipped in results:
+                if stats is not None:
+                    stats.count_files(skipped=skipped)
+                yield from res
+        finally:
+            # Cancels the chunks that didn't start yet when the caller stops early
+            results.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class BatchRunner:
+    """
+    Searches files with the `search_batch` method of their handler, for
+    native parsers that search many files per call on their own threads with
+    the GIL released.
+
+    Batches run one after the other on a background thread, in the order
+    they were submitted, while the caller goes through the other files.
+    """
+
+    def __init__(self, handler_key: str, config: Config, pattern, threads: int):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.handler_key = handler_key
+        self.config = config
+        self.pattern = pattern
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # File -> future of the results of its batch
+        self.futures: Dict[pathlib.Path, Any] = {}
+
+    def submit(self, handler, files: Sequence[pathlib.Path]):
+        for i in range(0, len(files), BATCH_FILES):
+            batch = files[i : i + BATCH_FILES]
+            future = self.executor.submit(
+                lambda batch=batch: dict(
+                    handler.search_batch(
+                        self.handler_key, self.config, batch, self.pattern, self.threads
+                    )
+                )
+            )
+            for f in batch:
+                self.futures[f] = future
+
+    def result(self, f: pathlib.Path) -> Optional[List[Entry]]:
+        """Entries of `f`, None if it wasn't submitted"""
+        future = self.futures.get(f, None)
+        if future is None:
+            return None
+        return future.result()[f]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def merge_batches(
+    files: Sequence[pathlib.Path],
+    batches: BatchRunner,
+    rest: Iterator[Tuple[str, List[Entry]]],
+) -> Iterator[Tuple[str, List[Entry]]]:
+    """
+    Yields the results of `batches` and of the other files (`rest`, which may
+    leave some files out) in the order of `files`
+    """
+    try:
+        pending = next(rest, None)
+        for f in files:
+            entries = batches.result(f)
+            if entries is not None:
+                yield str(f), entries
+            elif pending is not None and pending[0] == str(f):
+                yield pending
+                pending = next(rest, None)
+    finally:
+        batches.close()
+        if hasattr(rest, "close"):
+            rest.close()
@@ -0,0 +1,95 @@
+import mmap
+import os
+import pathlib
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from codesearch.literals import required_literals
+
+# Files at least this big are scanned through mmap instead of being read in
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def _compile(clauses: List[Set[str]]) -> Tuple[List[List[bytes]], List[re.Pattern]]:
+    literals = [
+        sorted(lit.encode("ascii") for lit in clause)
+        for clause in clauses
+        if all(lit.isascii() for lit in clause)
+    ]
+    # Used for files that are scanned in place, where lowercasing would mean a copy
+    regexes = [
+        re.compile(b"|".join(re.escape(lit) for lit in clause), re.IGNORECASE)
+        for clause in literals
+    ]
+    return literals, regexes
+
+
+def _unqualified(clauses: List[Set[str]], qualifier: str) -> List[Set[str]]:
+    """
+    Clauses for names made of several identifiers joined by `qualifier`
+    (like "Class.method"). Only the identifiers themselves are spelled out in
+    the file, so every literal is replaced by its longest piece.
+    """
+    res = []
+    for clause in clauses:
+        pieces = {max(lit.split(qualifier), key=len) for lit in clause}
+        if "" not in pieces:
+            res.append(pieces)
+    return res
+
+
+class Prefilter:
+    """
+    Skips files whose raw bytes don't contain the literals a search pattern
+    requires, before they are handed to a (much slower) parser.
+
+    Literals are compared case-insensitively, which is correct for every
+    handler no matter how it matches names. Clauses with non-ASCII literals
+    are left out since their case variants can't be checked bytewise.
+    """
+
+    def __init__(self, clauses: List[Set[str]]):
+        self.clauses = clauses
+        # Qualifier -> compiled clauses
+        self.compiled: Dict[
+            Optional[str], Tuple[List[List[bytes]], List[re.Pattern]]
+        ] = {}
+
+    @classmethod
+    def for_pattern(cls, pattern) -> Optional["Prefilter"]:
+        """Returns None when the pattern doesn't require any literal"""
+        clauses = required_literals(pattern)
+        if len(clauses) == 0:
+            return None
+        return cls(clauses)
+
+    def _compiled_for(self, qualifier: Optional[str]):
+        compiled = self.compiled.get(qualifier, None)
+        if compiled is None:
+            clauses = self.clauses
+            if qualifier is not None:
+                clauses = _unqualified(clauses, qualifier)
+            compiled = self.compiled[qualifier] = _compile(clauses)
+        return compiled
+
+    def admits(self, f: pathlib.Path, handler) -> bool:
+        """Whether `f` may define something that matches"""
+        # Only handlers reporting names as they're spelled in the file can be prefiltered
+        if not getattr(handler, "LITERAL_NAMES", False):
+            return True
+        literals, regexes = self._compiled_for(getattr(handler, "QUALIFIER", None))
+        if len(literals) == 0:
+            return True
+        try:
+            with open(f, "rb") as fh:
+                size = os.fstat(fh.fileno()).st_size
+                if size < MMAP_THRESHOLD:
+                    data = fh.read().lower()
+                    return all(
+                        any(lit in data for lit in clause) for clause in literals
+                    )
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return all(regex.search(data) for regex in regexes)
+        except OSError:
+            # Let the handler report the problem
+            return True
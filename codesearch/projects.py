@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from codesearch.logger import logger
+from codesearch.searcher import CodeSearch, CodeSearchIndex
+from codesearch.watcher import Watcher, create_watcher
+
+# Rough in-memory cost of an indexed symbol (record columns, name postings and
+# trigram postings) and of an indexed file
+BYTES_PER_SYMBOL = 160
+BYTES_PER_FILE = 512
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def project_root(dir) -> str:
+    """Projects are identified by the canonical path of their root"""
+    return os.path.realpath(dir)
+
+
+def estimate_index_size(index: CodeSearchIndex) -> int:
+    symbols = sum(len(s) for s in index.by_file.values())
+    return symbols * BYTES_PER_SYMBOL + len(index.files) * BYTES_PER_FILE
+
+
+class Project:
+    """An indexed project root, loaded on first use"""
+
+    searcher: Optional[CodeSearch] = None
+    watcher: Optional[Watcher] = None
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def load(self, jobs: int, watch: bool) -> CodeSearch:
+        with self.lock:
+            if self.searcher is None:
+                logger.info(f'Loading project "{self.root}"')
+                searcher = CodeSearch(self.root, use_index=True, jobs=jobs)
+                if watch:
+                    # Keep the index up to date as files are edited
+                    self.watcher = create_watcher(
+                        self.root, searcher.config, searcher.apply_changes
+                    )
+                    self.watcher.start()
+                self.searcher = searcher
+            return self.searcher
+
+    def size(self) -> int:
+        if self.searcher is None:
+            return 0
+        return estimate_index_size(self.searcher.index)
+
+    def unload(self):
+        with self.lock:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+            if self.searcher is not None:
+                # Queries that are still running keep their own index snapshot
+                self.searcher.close()
+                self.searcher = None
+
+
+class ProjectCache:
+    """
+    The projects served by a daemon, keyed by root.
+
+    Indexes are built lazily when a project is first searched. Once their
+    estimated size goes over `memory_budget` bytes, the least recently used
+    projects are unloaded. The project being searched is never unloaded, even
+    if it doesn't fit by itself.
+    """
+
+    def __init__(self, memory_budget: int, jobs=1, watch=True):
+        self.memory_budget = memory_budget
+        self.jobs = jobs
+        self.watch = watch
+        self.lock = threading.Lock()
+        # Least recently used first
+        self.projects: Dict[str, Project] = OrderedDict()
+
+    def get(self, dir) -> CodeSearch:
+        root = project_root(dir)
+        with self.lock:
+            project = self.projects.get(root, None)
+            if project is None:
+                project = self.projects[root] = Project(root)
+            self.projects.move_to_end(root)
+        loaded = project.searcher is not None
+        try:
+            searcher = project.load(self.jobs, self.watch)
+        except Exception:
+            with self.lock:
+                if self.projects.get(root, None) is project:
+                    del self.projects[root]
+            raise
+        if not loaded:
+            self.evict(keep=project)
+        return searcher
+
+    def loaded(self, dir) -> Optional[CodeSearch]:
+        """The searcher of a project if it's loaded already, never loads it"""
+        root = project_root(dir)
+        with self.lock:
+            project = self.projects.get(root, None)
+            if project is None:
+                return None
+            self.projects.move_to_end(root)
+            return project.searcher
+
+    def evict(self, keep: Project):
+        with self.lock:
+            total = sum(p.size() for p in self.projects.values())
+            evicted: List[Project] = []
+            for root, project in list(self.projects.items()):
+                if total <= self.memory_budget:
+                    break
+                if project is keep:
+                    continue
+                total -= project.size()
+                del self.projects[root]
+                evicted.append(project)
+        for project in evicted:
+            logger.info(f'Unloading project "{project.root}"')
+            project.unload()
+
+    def roots(self) -> List[str]:
+        with self.lock:
+            return list(self.projects.keys())
+
+    def sizes(self) -> Dict[str, int]:
+        """Estimated index size of every project, in bytes"""
+        with self.lock:
+            return {root: p.size() for root, p in self.projects.items()}
+
+    def close(self):
+        with self.lock:
+            projects = list(self.projects.values())
+            self.projects.clear()
+        for project in projects:
+            project.unload()
@@ -0,0 +1,338 @@
+import json
+import struct
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from codesearch.entry import Entries, Entry, EntryKind
+
+PROTOCOL_VERSION = 1
+ENCODING = "utf-8"
+# version, message type, payload length
+HEADER = struct.Struct("!BBI")
+# Refuse to allocate anything bigger than this for a single frame
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+# Results are split into frames of roughly this many entries
+FRAME_ENTRIES = 4096
+
+U32 = struct.Struct("!I")
+# name (string table index), kind, line, col, match start, match end
+ROW = struct.Struct("!IBIIII")
+
+
+# What a search request can ask for
+SEARCH_KINDS = ("fun", "cls", "ref", "find")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class MalformedMessage(ProtocolError):
+    """A well framed message whose payload doesn't make sense"""
+
+
+class NetworkMessageType(IntEnum):
+    ENTRIES_MSG = 0
+    DAEMON_SEARCH = 1
+    END_MSG = 2
+    ERROR_MSG = 3
+    STATS_REQ = 4
+    STATS_MSG = 5
+    DAEMON_BATCH = 6
+
+
+@dataclass
+class NetworkMessage:
+    type: NetworkMessageType
+
+    def payload(self) -> bytes:
+        return b""
+
+    def pack(self) -> bytes:
+        payload = self.payload()
+        return HEADER.pack(PROTOCOL_VERSION, self.type, len(payload)) + payload
+
+    @staticmethod
+    def parse_header(header: bytes) -> Tuple[NetworkMessageType, int]:
+        version, msg_type, length = HEADER.unpack(header)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame too large ({length} bytes)")
+        try:
+            return NetworkMessageType(msg_type), length
+        except ValueError:
+            raise ProtocolError(f"Unknown message type {msg_type}")
+
+    @staticmethod
+    def from_payload(msg_type: NetworkMessageType, payload: bytes) -> "NetworkMessage":
+        ttc = {
+            NetworkMessageType.DAEMON_SEARCH: DaemonSearchReqMsg,
+            NetworkMessageType.ENTRIES_MSG: EntriesMessage,
+            NetworkMessageType.END_MSG: EndMessage,
+            NetworkMessageType.ERROR_MSG: ErrorMessage,
+            NetworkMessageType.STATS_REQ: DaemonStatsReqMsg,
+            NetworkMessageType.STATS_MSG: StatsMessage,
+            NetworkMessageType.DAEMON_BATCH: DaemonBatchReqMsg,
+        }
+        try:
+            return ttc[msg_type].decode(payload)
+        except ProtocolError:
+            raise
+        except (ValueError, TypeError, KeyError, IndexError, struct.error) as e:
+            raise MalformedMessage(f"Malformed {msg_type.name} message: {e!r}")
+
+
+class StringTable:
+    """Strings shared by all rows of a frame, every distinct one is sent once"""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.strings: List[str] = []
+
+    def id(self, s: str) -> int:
+        i = self.ids.get(s, None)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def pack(self) -> bytes:
+        parts = [U32.pack(len(self.strings))]
+        for s in self.strings:
+            b = s.encode(ENCODING)
+            parts.append(U32.pack(len(b)))
+            parts.append(b)
+        return b"".join(parts)
+
+    @staticmethod
+    def unpack(data: bytes, offset: int) -> Tuple[List[str], int]:
+        (n,) = U32.unpack_from(data, offset)
+        offset += U32.size
+        strings = []
+        for _ in range(n):
+            (length,) = U32.unpack_from(data, offset)
+            offset += U32.size
+            strings.append(data[offset : offset + length].decode(ENCODING))
+            offset += length
+        return strings, offset
+
+
+@dataclass
+class EntriesMessage(NetworkMessage):
+    """
+    A batch of search results. Large result sets are sent as several of
+    these, each one holding complete files only.
+
+    `entries` are (file, entries) pairs in the order they were found. A file
+    can come up more than once, e.g. in ranked results, where its entries
+    are interleaved with the ones of other files.
+
+    Layout: string table, number of files, then for every file its name
+    index and number of rows followed by fixed-size rows.
+    """
+
+    entries: List[Tuple[str, List[Entry]]] = field(default_factory=list)
+
+    def __init__(self, entries: Union[Entries, List[Tuple[str, List[Entry]]]]):
+        NetworkMessage.__init__(self, NetworkMessageType.ENTRIES_MSG)
+        self.entries = list(entries.items()) if isinstance(entries, dict) else entries
+
+    def payload(self) -> bytes:
+        table = StringTable()
+        body = [U32.pack(len(self.entries))]
+        for f, fentries in self.entries:
+            body.append(U32.pack(table.id(f)))
+            body.append(U32.pack(len(fentries)))
+            for e in fentries:
+                start, end = e.match if e.match is not None else (0, 0)
+                body.append(
+                    ROW.pack(table.id(e.name), int(e.kind), e.line, e.col, start, end)
+                )
+        return table.pack() + b"".join(body)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        strings, offset = StringTable.unpack(payload, 0)
+        (n_files,) = U32.unpack_from(payload, offset)
+        offset += U32.size
+        entries = []
+        for _ in range(n_files):
+            f_id, n_rows = struct.unpack_from("!II", payload, offset)
+            offset += 2 * U32.size
+            fentries = []
+            for name_id, kind, line, col, start, end in ROW.iter_unpack(
+                payload[offset : offset + n_rows * ROW.size]
+            ):
+                fentries.append(
+                    Entry(
+                        line=line,
+                        kind=EntryKind(kind),
+                        name=strings[name_id],
+                        col=col,
+                        match=(start, end),
+                    )
+                )
+            offset += n_rows * ROW.size
+            entries.append((strings[f_id], fentries))
+        return cls(entries=entries)
+
+
+def entries_frames(
+    results: Iterable[Tuple[str, List[Entry]]],
+) -> Iterable[EntriesMessage]:
+    """Group streamed (file, entries) results into frames of whole files"""
+    batch: List[Tuple[str, List[Entry]]] = []
+    size = 0
+    for f, fentries in results:
+        if len(fentries) == 0:
+            continue
+        batch.append((f, fentries))
+        size += len(fentries)
+        if size >= FRAME_ENTRIES:
+            yield EntriesMessage(entries=batch)
+            batch = []
+            size = 0
+    if len(batch) != 0:
+        yield EntriesMessage(entries=batch)
+
+
+def check_query(handler_key, params):
+    if handler_key not in SEARCH_KINDS:
+        raise MalformedMessage(f"Unknown search kind {handler_key!r}")
+    if not isinstance(params, list) or len(params) != 1 or type(params[0]) is not str:
+        raise MalformedMessage("A search takes a single pattern")
+
+
+def check_options(limit, root):
+    if limit is not None and (type(limit) is not int or limit < 0):
+        raise MalformedMessage(f"Invalid limit {limit!r}")
+    if root is not None and not isinstance(root, str):
+        raise MalformedMessage(f"Invalid project root {root!r}")
+
+
+@dataclass
+class DaemonSearchReqMsg(NetworkMessage):
+    handler_key: str = ""
+    params: List[Any] = field(default_factory=list)
+    limit: Optional[int] = None
+    # Project root to search, the daemon's own directory when not given
+    root: Optional[str] = None
+
+    def payload(self) -> bytes:
+        d = {
+            "params": [p for p in self.params],
+            "handler_key": self.handler_key,
+            "limit": self.limit,
+            "root": self.root,
+        }
+        return json.dumps(d).encode(ENCODING)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        d = json.loads(payload.decode(ENCODING))
+        msg = cls(**d)
+        check_query(msg.handler_key, msg.params)
+        check_options(msg.limit, msg.root)
+        return msg
+
+    def __init__(self, handler_key, params, limit=None, root=None):
+        NetworkMessage.__init__(self, NetworkMessageType.DAEMON_SEARCH)
+        self.handler_key = handler_key
+        self.params = params
+        self.limit = limit
+        self.root = root
+
+
+@dataclass
+class DaemonBatchReqMsg(NetworkMessage):
+    """
+    Many (handler key, pattern) queries run in one pass over the project.
+    The results of every query are streamed back in order, each followed by
+    an EndMessage.
+    """
+
+    queries: List[Tuple[str, str]] = field(default_factory=list)
+    limit: Optional[int] = None
+    root: Optional[str] = None
+
+    def payload(self) -> bytes:
+        d = {
+            "queries": [list(q) for q in self.queries],
+            "limit": self.limit,
+            "root": self.root,
+        }
+        return json.dumps(d).encode(ENCODING)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        d = json.loads(payload.decode(ENCODING))
+        msg = cls(**d)
+        msg.queries = [tuple(q) for q in msg.queries]
+        for kind, pattern in msg.queries:
+            check_query(kind, [pattern])
+        check_options(msg.limit, msg.root)
+        return msg
+
+    def __init__(self, queries, limit=None, root=None):
+        NetworkMessage.__init__(self, NetworkMessageType.DAEMON_BATCH)
+        self.queries = queries
+        self.limit = limit
+        self.root = root
+
+
+@dataclass
+class EndMessage(NetworkMessage):
+    """Marks the end of a streamed response"""
+
+    def __init__(self):
+        NetworkMessage.__init__(self, NetworkMessageType.END_MSG)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        return cls()
+
+
+@dataclass
+class ErrorMessage(NetworkMessage):
+    error: str = ""
+
+    def __init__(self, error):
+        NetworkMessage.__init__(self, NetworkMessageType.ERROR_MSG)
+        self.error = error
+
+    def payload(self) -> bytes:
+        return self.error.encode(ENCODING)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        return cls(error=payload.decode(ENCODING))
+
+
+@dataclass
+class DaemonStatsReqMsg(NetworkMessage):
+    """Asks the daemon for the counters of the searches it served"""
+
+    def __init__(self):
+        NetworkMessage.__init__(self, NetworkMessageType.STATS_REQ)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        return cls()
+
+
+@dataclass
+class StatsMessage(NetworkMessage):
+    stats: Dict[str, Any] = field(default_factory=dict)
+
+    def __init__(self, stats):
+        NetworkMessage.__init__(self, NetworkMessageType.STATS_MSG)
+        self.stats = stats
+
+    def payload(self) -> bytes:
+        return json.dumps(self.stats).encode(ENCODING)
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        return cls(stats=json.loads(payload.decode(ENCODING)))
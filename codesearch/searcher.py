@@ -1,52 +1,69 @@
-import json
+import contextlib
+import itertools
 import os
 import pathlib
 import re
 import sys
+import time
 from collections import defaultdict
 from dataclasses import dataclass, field
-from enum import IntEnum
-from typing import Any, Dict, List, Optional
-
-from util import cmd_green, cmd_yellow
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from codesearch.config import (
     Config,
+    FileFilter,
     determine_included_files,
     load_config,
     merge_configs,
 )
 from codesearch.entry import Entries, Entry
-from codesearch.handlers import handler_for_file_type
+from codesearch.handlers import (
+    Stamp,
+    cached_blob_symbols,
+    cached_symbols,
+    handler_for_file_type,
+    index_stamped,
+    symbol_cache,
+    try_index_file,
+    try_index_stamped,
+)
 from codesearch.logger import configure_loggers, logger
+from codesearch.output import print_search_results  # noqa: F401 (public API)
+from codesearch.parallel import (
+    BatchRunner,
+    ParallelRunner,
+    merge_batches,
+    resolve_jobs,
+)
+from codesearch.prefilter import Prefilter
+from codesearch.symbols import FileSymbols
+from codesearch.trigram import NameIndex
 
+if TYPE_CHECKING:
+    # Only needed by the persistent index and the daemon, kept out of CLI startup
+    from codesearch.stats import SearchStats
+    from codesearch.store import BlobStore, IndexStore
+    from codesearch.watcher import FileChanges
 
-def print_search_results(entries: Entries):
-    found_something = False
-    for f, fentries in entries.items():
-        nothing_in_file = len(fentries) == 0
-        if nothing_in_file:
-            continue
-        print(cmd_green(f))
-        for entry in fentries:
-            found_something = True
-            pt = f"\t{entry.kind} [{entry.line}:{entry.col}]: "
-            if entry.match is None:
-                start, end = 0, 0
-            elif isinstance(entry.match, tuple):
-                start, end = entry.match
-            elif isinstance(entry.match, list):
-                [start, end] = entry.match
-            elif isinstance(entry.match, re.Match):
-                start, end = entry.match.span()
-            t = entry.name
-            pt += t[:start]
-            pt += cmd_yellow(t[start:end])
-            pt += t[end:]
-            print(pt)
-    if not found_something:
-        print("Nothing found")
-        return
+
+def admitted(
+    prefilter: Prefilter, f: pathlib.Path, handler, stats: Optional["SearchStats"]
+) -> bool:
+    res = prefilter.admits(f, handler)
+    if not res and stats is not None:
+        stats.count_files(skipped=1)
+    return res
 
 
 class InvalidDirectoryPath(Exception):
@@ -57,60 +74,599 @@ class InvalidDirectoryPath(Exception):
         return f'Invalid directory path specified: "{self.path}"'
 
 
+# Generations of indexes, see CodeSearchIndex
+generations = itertools.count(1)
+
+
 @dataclass
 class CodeSearchIndex:
-    by_file: Dict[pathlib.Path, Any] = field(default_factory=dict)
+    files: List[pathlib.Path] = field(default_factory=list)
+    by_file: Dict[pathlib.Path, FileSymbols] = field(default_factory=dict)
+    names: NameIndex = field(default_factory=NameIndex)
+    # Unique to every index built in this process, including updated copies
+    generation: int = field(default_factory=lambda: next(generations))
+    # Position of every file in `files`, used to keep results in a stable order
+    positions: Dict[pathlib.Path, int] = field(init=False)
+
+    def __post_init__(self):
+        self.positions = {f: i for i, f in enumerate(self.files)}
 
 
 class CodeSearch:
     index: CodeSearchIndex
 
-    def __init__(self, dir=".", source=None, use_index=False):
+    def __init__(
+        self,
+        dir=".",
+        source=None,
+        use_index=False,
+        persist_index=None,
+        jobs=1,
+        fast=False,
+        stats: Optional["SearchStats"] = None,
+        git=False,
+        untracked=False,
+        commit=None,
+    ):
+        """
+        With `git`, files are listed by the git index instead of walking the
+        tree (`untracked` adds the files git doesn't ignore), and the symbols
+        of unmodified files are shared by every file with the same content.
+        `commit` searches the files of a commit, read straight out of git.
+        """
         if not os.path.exists(dir):
             raise InvalidDirectoryPath(dir)
         configure_loggers(daemon=False)
         self.dir = dir
         sys.path.append(dir)
-        self.config = load_config(dir)
+        # Where the time of construction and searches went, when asked for
+        self.stats = stats
+        with self.phase("config"):
+            self.config = load_config(dir)
         if self.config.source is not None:
             self.config.source = source
-        self.files = determine_included_files(self.config, dir)
+        self.git = git or untracked or commit is not None
+        self.untracked = untracked
+        self.commit: Optional[str] = None
+        if commit is not None:
+            from codesearch.git import resolve_commit
+
+            self.commit = resolve_commit(dir, commit)
+            # Files that aren't checked out can only be searched through an index
+            use_index = True
+        # Git blob id of every listed file whose content git knows
+        self.blobs: Dict[pathlib.Path, str] = {}
+        # Fast extractors only serve one-off searches, indexes keep the precise symbols
+        self.config.fast = (self.config.fast or fast) and not use_index
+        with self.phase("walk"):
+            self.files = self.list_files()
+        self.jobs = resolve_jobs(jobs)
+        self.runner = ParallelRunner(self.jobs) if self.jobs > 1 else None
         self.use_index = use_index
+        # Indexes are persisted under the project root unless asked otherwise
+        self.persist_index = use_index if persist_index is None else persist_index
         if use_index:
             self.index = CodeSearchIndex()
-            self.build_index()
+            with self.phase("index"):
+                self.build_index()
+
+    def phase(self, name: str):
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.phase(name)
+
+    def list_files(self) -> List[pathlib.Path]:
+        if not self.git:
+            return determine_included_files(self.config, self.dir)
+        from codesearch.git import GitError, commit_files, worktree_files
+
+        listed: Dict[str, Optional[str]]
+        try:
+            if self.commit is not None:
+                listed = dict(commit_files(self.dir, self.commit))
+            else:
+                listed = worktree_files(self.dir, self.untracked)
+        except GitError as e:
+            if self.commit is not None:
+                raise
+            logger.warn(f"Couldn't list files with git, walking the tree: {e}")
+            self.blobs = {}
+            return determine_included_files(self.config, self.dir)
+        files = []
+        blobs = {}
+        for rel in FileFilter(self.config, self.dir).select(listed):
+            f = pathlib.Path(self.dir, rel)
+            files.append(f)
+            if listed[rel] is not None:
+                blobs[f] = listed[rel]
+        self.blobs = blobs
+        return files
+
+    def open_store(self) -> Optional["IndexStore"]:
+        # The store is keyed by the files of the working tree
+        if not self.persist_index or self.commit is not None:
+            return None
+        from codesearch.store import IndexStore
+
+        return IndexStore.open(self.dir)
+
+    def open_blob_store(self) -> Optional["BlobStore"]:
+        if not self.persist_index or len(self.blobs) == 0:
+            return None
+        from codesearch.git import GitError
+        from codesearch.store import BlobStore
+
+        try:
+            return BlobStore.open(self.dir)
+        except GitError as e:
+            logger.warn(f"Couldn't open the blob store: {e}")
+            return None
+
+    def blob_of(self, f: pathlib.Path, handler) -> Optional[str]:
+        """
+        The blob id `f` is cached under, if any: symbols of handlers with an
+        index_source() only depend on the content of the file
+        """
+        if not hasattr(handler, "index_source"):
+            return None
+        return self.blobs.get(f, None)
+
+    def blob_symbols(
+        self, f: pathlib.Path, handler, handler_key: str
+    ) -> Optional[FileSymbols]:
+        """
+        Symbols of a file git knows the content of, parsed once for every file
+        with that content. None when the handler has to parse the file itself.
+        """
+        if self.config.fast and handler_key == "ref":
+            # Fast extractors only collect definitions, references need a real parse
+            handler = handler_for_file_type(f)
+        blob = self.blob_of(f, handler)
+        if blob is None:
+            return None
+        return cached_blob_symbols(handler, f, blob)
+
+    def load_symbols(self, f: pathlib.Path, handler, store: Optional["IndexStore"]):
+        if store is None:
+            return handler.index_file(f)
+        symbols = store.lookup(f, handler.EXTRACTOR)
+        if symbols is None:
+            symbols, stamp = index_stamped(handler, f)
+            store.save(f, handler.EXTRACTOR, symbols, stamp)
+        return symbols
 
     def build_index(self):
         logger.info("Building index")
-        for f in self.files:
+        # Queries keep using the previous index until the new one is complete
+        index = CodeSearchIndex(files=list(self.files))
+        store = self.open_store()
+        blob_store = self.open_blob_store()
+        to_parse = []
+        unreadable = 0
+        for f in index.files:
             handler = handler_for_file_type(f)
-            if handler is not None:
-                idx = handler.index_file(f)
-                self.index.by_file[f] = idx
-        logger.info("Done")
+            if handler is None:
+                continue
+            symbols = self.stored_symbols(f, handler, store, blob_store)
+            if symbols is not None:
+                index.by_file[f] = symbols
+            elif self.commit is not None and not hasattr(handler, "index_source"):
+                # Needs the file on disk (e.g. C++, parsed with its includes)
+                unreadable += 1
+            else:
+                to_parse.append(f)
+        parsed = (
+            self.index_files(to_parse, stamped=store is not None)
+            if self.commit is None
+            else self.index_commit_files(to_parse)
+        )
+        for f, symbols, stamp in parsed:
+            index.by_file[f] = symbols
+            handler = handler_for_file_type(f)
+            blob = self.blob_of(f, handler)
+            if blob is not None:
+                symbol_cache.add_blob(handler, blob, symbols)
+                if blob_store is not None:
+                    blob_store.save(blob, handler.EXTRACTOR, symbols)
+            if store is not None:
+                store.save(f, handler.EXTRACTOR, symbols, stamp)
+        if store is not None:
+            store.prune(index.by_file.keys())
+            store.close()
+        if blob_store is not None:
+            blob_store.close()
+        if unreadable != 0:
+            logger.warn(f"Skipped {unreadable} files that can't be read out of git")
+        index.names = NameIndex.build(index.by_file)
+        self.index = index
+        logger.info(f"Done ({len(to_parse)} files parsed)")
 
-    def for_all_files_execute_handler(
-        self, handler_key: str, search_pattern: str
-    ) -> Entries:
-        pattern = re.compile(search_pattern)
-        entries: Any = defaultdict(dict)
-        for f in self.files:
-            idx = self.index.by_file.get(f, None) if self.use_index else None
+    def stored_symbols(
+        self,
+        f: pathlib.Path,
+        handler,
+        store: Optional["IndexStore"],
+        blob_store: Optional["BlobStore"],
+    ) -> Optional[FileSymbols]:
+        blob = self.blob_of(f, handler)
+        if blob is not None:
+            symbols = symbol_cache.get_blob(handler, blob)
+            if blob_store is not None:
+                if symbols is None:
+                    symbols = blob_store.lookup(blob, handler.EXTRACTOR)
+                    if symbols is not None:
+                        symbol_cache.add_blob(handler, blob, symbols)
+                elif not blob_store.contains(blob, handler.EXTRACTOR):
+                    # Parsed by a search that didn't store anything
+                    blob_store.save(blob, handler.EXTRACTOR, symbols)
+            if symbols is not None:
+                return symbols
+        return store.lookup(f, handler.EXTRACTOR) if store is not None else None
+
+    def index_commit_files(self, files: List[pathlib.Path]):
+        """Parses files of the searched commit, read out of git"""
+        from codesearch.git import read_blobs
+
+        blobs = read_blobs(self.dir, [self.blobs[f] for f in files])
+        for f, (_, source) in zip(files, blobs):
+            handler = handler_for_file_type(f)
+            start = time.perf_counter()
+            try:
+                symbols = handler.index_source(f, source)
+            except Exception as e:
+                logger.warn(f'Failed to index "{f}" at {self.commit}: {e}')
+                continue
+            if self.stats is not None:
+                self.stats.add_file(f, time.perf_counter() - start)
+            # Not on disk, nothing to stamp
+            yield f, symbols, None
+
+    def index_files(
+        self, files: List[pathlib.Path], stamped: bool = False
+    ) -> Iterator[Tuple[pathlib.Path, FileSymbols, Optional[Stamp]]]:
+        """
+        Parses the files, skipping the ones that fail. With `stamped`, the
+        symbols come with the stamp of the content they were extracted from.
+        """
+        if self.runner is not None:
+            yield from self.runner.index_files(files, stamped)
+            return
+        for f in files:
+            handler = handler_for_file_type(f)
+            start = time.perf_counter()
+            if stamped:
+                parsed = try_index_stamped(handler, f)
+            else:
+                symbols = try_index_file(handler, f)
+                parsed = (symbols, None) if symbols is not None else None
+            if self.stats is not None:
+                self.stats.add_file(f, time.perf_counter() - start)
+            if parsed is not None:
+                yield (f, *parsed)
+
+    def apply_changes(self, changes: "FileChanges"):
+        """
+        Bring the index up to date with a batch of file changes.
+
+        A new index is built next to the current one and swapped in at the end,
+        so queries that are already running keep a consistent snapshot.
+        """
+        if changes.rescan:
+            self.files = self.list_files()
+            self.build_index()
+            return
+        current = self.index
+        deleted = set(changes.deleted)
+        for f in changes.changed:
+            # Its content isn't the one git knows anymore
+            self.blobs.pop(f, None)
+            if not os.path.isfile(f):
+                deleted.add(f)
+
+        def is_deleted(f: pathlib.Path):
+            return f in deleted or any(p in deleted for p in f.parents)
+
+        files = list(current.files)
+        by_file = dict(current.by_file)
+        removed = {}
+        added = {}
+        if len(deleted) != 0:
+            files = [f for f in files if not is_deleted(f)]
+            removed = {f: idx for f, idx in by_file.items() if is_deleted(f)}
+            by_file = {f: idx for f, idx in by_file.items() if not is_deleted(f)}
+        known = set(files)
+        store = self.open_store()
+        for f in sorted(changes.changed):
+            if f in deleted:
+                continue
+            if f not in known:
+                files.append(f)
+                known.add(f)
             handler = handler_for_file_type(f)
+            if handler is None:
+                continue
+            try:
+                symbols = self.load_symbols(f, handler, store)
+            except Exception as e:
+                # Most likely a half-written file, keep whatever we had for it
+                logger.warn(f'Failed to index "{f}": {e}')
+                continue
+            if f in by_file:
+                removed[f] = by_file[f]
+            by_file[f] = added[f] = symbols
+        if store is not None:
+            store.remove(f for f in current.by_file.keys() if f not in by_file)
+            store.close()
+        logger.info(
+            f"Updated index: {len(changes.changed)} changed, {len(deleted)} deleted"
+        )
+        self.files = files
+        self.index = CodeSearchIndex(
+            files=files, by_file=by_file, names=current.names.updated(removed, added)
+        )
+
+    def handled_files(self, files: Iterable[pathlib.Path], handler_key: str):
+        """Yields (file, handler, handler function) for every file we know how to search"""
+        for f in files:
+            handler = handler_for_file_type(f, self.config.fast)
             if handler is None:
                 # Just skip this file since we don't know how to handle it
                 continue
-            fun = handler.__dict__.get(handler_key)
+            fun = getattr(handler, handler_key, None)
             if fun is None:
                 logger.warn(
                     f'Couldn\'t find action handler "{handler_key}" for file "{f}"',
                 )
                 continue
-            fun = fun.__func__
-            fentries = list(fun(handler, self.config, f, pattern, index=idx))
-            entries[str(f)] = fentries
+            yield f, handler, fun.__func__
+
+    def find(
+        self,
+        query: str,
+        limit: Optional[int] = None,
+        stats: Optional["SearchStats"] = None,
+    ) -> List[Tuple[float, str, Entry]]:
+        """
+        Fuzzy search over the names of every function and class. Returns the
+        `limit` (DEFAULT_TOP_K when not given) best (score, file, entry),
+        best first.
+        """
+        from codesearch.fuzzy import DEFAULT_TOP_K, FuzzyMatcher
+
+        matcher = FuzzyMatcher(query, DEFAULT_TOP_K if limit is None else limit)
+        index = self.index if self.use_index else None
+        if index is not None:
+            files = index.files
+        else:
+            files = [f for f, _, _ in self.handled_files(self.files, "fun")]
+        matcher.add_files(self.symbols_of(files, index, stats))
+        if stats is not None:
+            stats.count_files(searched=len(files))
+        return matcher.results()
+
+    def search_many(
+        self,
+        queries: Sequence[Tuple[str, str]],
+        limit: Optional[int] = None,
+        stats: Optional["SearchStats"] = None,
+    ) -> List[List[Tuple[str, List[Entry]]]]:
+        """
+        Runs many (handler key, pattern) queries in a single pass over the
+        tree: every file is parsed (or looked up in the index) once and all
+        the queries are evaluated against its symbols. Returns the results of
+        every query, in the same order as `queries`, each one holding at most
+        `limit` entries.
+        """
+        stats = stats if stats is not None else self.stats
+        results: List[List[Tuple[str, List[Entry]]]] = [[] for _ in queries]
+        found = [0] * len(queries)
+        # (position, handler key, compiled pattern) of every query but fuzzy ones
+        compiled = []
+        for i, (handler_key, pattern) in enumerate(queries):
+            if handler_key == "find":
+                results[i] = list(self.search(handler_key, pattern, limit, stats))
+            else:
+                compiled.append((i, handler_key, re.compile(pattern)))
+        if len(compiled) == 0:
+            return results
+        index = self.index if self.use_index else None
+        # Files some query needs, with the queries to run on them (None for all)
+        wanted: Dict[pathlib.Path, Optional[Set[int]]] = {}
+        if index is not None:
+            for i, _, pattern in compiled:
+                candidates = index.names.candidate_files(pattern)
+                for f in candidates if candidates is not None else index.files:
+                    wanted.setdefault(f, set()).add(i)
+            files = sorted(wanted, key=index.positions.__getitem__)
+            if stats is not None:
+                stats.count_files(skipped=len(index.files) - len(files))
+        else:
+            prefilters = [Prefilter.for_pattern(pattern) for _, _, pattern in compiled]
+            files = []
+            for f in self.files:
+                handler = handler_for_file_type(f, self.config.fast)
+                if handler is None:
+                    continue
+                # Non-matching queries find nothing anyway, no need to narrow them down
+                if any(p is None or p.admits(f, handler) for p in prefilters):
+                    files.append(f)
+                    wanted[f] = None
+                elif stats is not None:
+                    stats.count_files(skipped=1)
+        for f, symbols in self.symbols_of(files, index, stats):
+            handler = handler_for_file_type(f, self.config.fast)
+            if stats is not None:
+                stats.count_files(searched=1)
+            queries_of_file = wanted[f]
+            for i, handler_key, pattern in compiled:
+                if queries_of_file is not None and i not in queries_of_file:
+                    continue
+                if limit is not None and found[i] >= limit:
+                    continue
+                fun = getattr(handler, handler_key, None)
+                if fun is None:
+                    continue
+                # Fast extractors only collect definitions, their handlers parse
+                # the file again for references
+                fast_ref = self.config.fast and handler_key == "ref"
+                fentries = list(
+                    fun.__func__(
+                        handler,
+                        self.config,
+                        f,
+                        pattern,
+                        index=None if fast_ref else symbols,
+                    )
+                )
+                if limit is not None:
+                    fentries = fentries[: limit - found[i]]
+                if len(fentries) != 0:
+                    found[i] += len(fentries)
+                    results[i].append((str(f), fentries))
+        return results
+
+    def symbols_of(
+        self,
+        files: List[pathlib.Path],
+        index: Optional[CodeSearchIndex],
+        stats: Optional["SearchStats"],
+    ) -> Iterator[Tuple[pathlib.Path, FileSymbols]]:
+        """Symbols of every file, from the index or parsed with the search handlers"""
+        if index is not None:
+            for f in files:
+                symbols = index.by_file.get(f, None)
+                if symbols is not None:
+                    yield f, symbols
+            return
+        if self.runner is not None and not self.config.fast:
+            for f, symbols, _ in self.runner.index_files(files):
+                yield f, symbols
+            return
+        for f in files:
+            handler = handler_for_file_type(f, self.config.fast)
+            start = time.perf_counter()
+            symbols = self.blob_symbols(f, handler, "fun")
+            if symbols is None:
+                symbols = cached_symbols(handler, f)
+            if stats is not None:
+                stats.add_file(f, time.perf_counter() - start)
+            yield f, symbols
+
+    def search(
+        self,
+        handler_key: str,
+        search_pattern: str,
+        limit: Optional[int] = None,
+        stats: Optional["SearchStats"] = None,
+    ) -> Iterator[Tuple[str, List[Entry]]]:
+        """
+        Yields (file, entries) as soon as each file has been searched, in a
+        deterministic order. With `limit`, no more files are searched once
+        that many entries have been found. File counts and timings go to
+        `stats`, or to the stats of the searcher when not given.
+        """
+        stats = stats if stats is not None else self.stats
+        if handler_key == "find":
+            # Ranked, one result per item, no regex involved
+            for score, f, entry in self.find(search_pattern, limit, stats):
+                yield f, [entry]
+            return
+        pattern = re.compile(search_pattern)
+        # Grab the index once so that concurrent updates don't affect this query
+        index = self.index if self.use_index else None
+        files = index.files if index is not None else self.files
+        if index is not None:
+            candidates = index.names.candidate_files(pattern)
+            if candidates is not None:
+                # Only visit the files defining a name that can match
+                files = sorted(candidates, key=index.positions.__getitem__)
+        handled = list(self.handled_files(files, handler_key))
+        if stats is not None and index is not None:
+            # Files the name index ruled out
+            stats.count_files(skipped=len(index.files) - len(files))
+        # Without an index every file is parsed, skip the ones that can't match
+        prefilter = Prefilter.for_pattern(pattern) if index is None else None
+        batches = None
+        rest = handled
+        if index is None:
+            # Native parsers with a batch API search their files in the background
+            batched: Dict[Any, List[pathlib.Path]] = defaultdict(list)
+            for f, handler, _ in handled:
+                if hasattr(handler, "search_batch"):
+                    batched[handler].append(f)
+            if len(batched) != 0:
+                batches = BatchRunner(handler_key, self.config, pattern, self.jobs)
+                for handler, handler_files in batched.items():
+                    batches.submit(handler, handler_files)
+                rest = [h for h in handled if h[0] not in batches.futures]
+        if index is None and self.runner is not None:
+            rest_results = self.runner.search_files(
+                handler_key,
+                self.config,
+                pattern,
+                [f for f, _, _ in rest],
+                prefilter=prefilter,
+                stats=stats,
+            )
+        else:
+            if prefilter is not None:
+                rest = (
+                    (f, handler, fun)
+                    for f, handler, fun in rest
+                    if admitted(prefilter, f, handler, stats)
+                )
+            by_file = index.by_file if index is not None else {}
+
+            def file_symbols(f, handler):
+                if index is not None:
+                    return by_file.get(f)
+                return self.blob_symbols(f, handler, handler_key)
+
+            def search_file(f, handler, fun):
+                # Only parsing files is timed, lookups in the index are negligible
+                if stats is None or index is not None:
+                    symbols = file_symbols(f, handler)
+                    return list(fun(handler, self.config, f, pattern, index=symbols))
+                start = time.perf_counter()
+                symbols = file_symbols(f, handler)
+                fentries = list(fun(handler, self.config, f, pattern, index=symbols))
+                stats.add_file(f, time.perf_counter() - start)
+                return fentries
+
+            rest_results = (
+                (str(f), search_file(f, handler, fun)) for f, handler, fun in rest
+            )
+        results = (
+            merge_batches([f for f, _, _ in handled], batches, rest_results)
+            if batches is not None
+            else rest_results
+        )
+        found = 0
+        try:
+            for f, fentries in results:
+                if stats is not None:
+                    stats.count_files(searched=1)
+                if limit is not None and found + len(fentries) >= limit:
+                    yield f, fentries[: limit - found]
+                    return
+                found += len(fentries)
+                yield f, fentries
+        finally:
+            # Drops the work that was queued but is not needed anymore
+            results.close()
+
+    def for_all_files_execute_handler(
+        self, handler_key: str, search_pattern: str, limit: Optional[int] = None
+    ) -> Entries:
+        entries: Any = defaultdict(dict)
+        for f, fentries in self.search(handler_key, search_pattern, limit):
+            entries[f] = fentries
         return entries
 
+    def close(self):
+        if self.runner is not None:
+            self.runner.close()
+
     def cls(self, classname):
         return self.for_all_files_execute_handler("cls", classname)
 
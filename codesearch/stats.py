@@ -0,0 +1,233 @@
+import bisect
+import contextlib
+import heapq
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Number of files listed by reports, slowest first
+SLOWEST_FILES = 10
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket is open
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)  # fmt: skip
+
+
+def clock() -> Tuple[float, float]:
+    return time.perf_counter(), time.process_time()
+
+
+class SearchStats:
+    """
+    Where the time of a search went: wall and CPU time per phase, how many
+    files were searched or skipped, the time handlers took per file
+    extension and the slowest files.
+
+    CPU time is the one of this process. Files searched by --jobs workers or
+    native batches are counted but not timed.
+    """
+
+    def __init__(self, slowest: int = SLOWEST_FILES):
+        self.lock = threading.Lock()
+        # Phase -> [wall, cpu] seconds, in the order phases first ran
+        self.phases: Dict[str, List[float]] = {}
+        self.files_searched = 0
+        self.files_skipped = 0
+        # Extension -> [files, seconds]
+        self.extensions: Dict[str, List[float]] = {}
+        self.slowest_count = slowest
+        # Min-heap of (seconds, file)
+        self.slowest: List[Tuple[float, str]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        wall, cpu = clock()
+        try:
+            yield
+        finally:
+            end_wall, end_cpu = clock()
+            self.add_phase(name, end_wall - wall, end_cpu - cpu)
+
+    def add_phase(self, name: str, wall: float, cpu: float):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0.0, 0.0])
+            totals[0] += wall
+            totals[1] += cpu
+
+    def add_file(self, f, seconds: float):
+        _, ext = os.path.splitext(f)
+        with self.lock:
+            totals = self.extensions.setdefault(ext, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            self._add_slowest(seconds, str(f))
+
+    def _add_slowest(self, seconds: float, f: str):
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, (seconds, f))
+        elif self.slowest_count > 0:
+            heapq.heappushpop(self.slowest, (seconds, f))
+
+    def count_files(self, searched: int = 0, skipped: int = 0):
+        with self.lock:
+            self.files_searched += searched
+            self.files_skipped += skipped
+
+    def merge(self, other: "SearchStats"):
+        with other.lock:
+            phases = {k: list(v) for k, v in other.phases.items()}
+            extensions = {k: list(v) for k, v in other.extensions.items()}
+            slowest = list(other.slowest)
+            searched, skipped = other.files_searched, other.files_skipped
+        with self.lock:
+            for name, (wall, cpu) in phases.items():
+                totals = self.phases.setdefault(name, [0.0, 0.0])
+                totals[0] += wall
+                totals[1] += cpu
+            for ext, (files, seconds) in extensions.items():
+                totals = self.extensions.setdefault(ext, [0, 0.0])
+                totals[0] += files
+                totals[1] += seconds
+            for seconds, f in slowest:
+                self._add_slowest(seconds, f)
+            self.files_searched += searched
+            self.files_skipped += skipped
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            return {
+                "phases": {
+                    name: {"wall": wall, "cpu": cpu}
+                    for name, (wall, cpu) in self.phases.items()
+                },
+                "files_searched": self.files_searched,
+                "files_skipped": self.files_skipped,
+                "extensions": {
+                    ext: {"files": files, "seconds": seconds}
+                    for ext, (files, seconds) in self.extensions.items()
+                },
+                "slowest": [
+                    {"file": f, "seconds": seconds}
+                    for seconds, f in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+    def report(self) -> str:
+        d = self.to_dict()
+        lines = ["Phase             wall (s)    cpu (s)"]
+        for name, t in d["phases"].items():
+            lines.append(f"  {name:<14} {t['wall']:9.4f} {t['cpu']:10.4f}")
+        lines.append(
+            f"Files: {d['files_searched']} searched, {d['files_skipped']} skipped"
+        )
+        if len(d["extensions"]) != 0:
+            lines.append("Handler time per extension")
+            for ext, t in sorted(d["extensions"].items()):
+                lines.append(
+                    f"  {ext or '(none)':<14} {t['seconds']:9.4f}s"
+                    f" in {t['files']} files"
+                )
+        if len(d["slowest"]) != 0:
+            lines.append("Slowest files")
+            for s in d["slowest"]:
+                lines.append(f"  {s['seconds']:9.4f}s {s['file']}")
+        return "\n".join(lines)
+
+
+def timed_iter(
+    stats: SearchStats, items: Iterable, producer: str, consumer: str
+) -> Iterator:
+    """
+    Splits the time spent going through a stream of results between the
+    phase producing them and the phase consuming them
+    """
+    it = iter(items)
+    try:
+        while True:
+            wall, cpu = clock()
+            try:
+                item = next(it)
+            finally:
+                produced_wall, produced_cpu = clock()
+                stats.add_phase(producer, produced_wall - wall, produced_cpu - cpu)
+            yield item
+            consumed_wall, consumed_cpu = clock()
+            stats.add_phase(
+                consumer, consumed_wall - produced_wall, consumed_cpu - produced_cpu
+            )
+    except StopIteration:
+        return
+    finally:
+        if hasattr(it, "close"):
+            it.close()
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def to_dict(self) -> Dict:
+        bounds: List[Optional[float]] = [*self.buckets, None]
+        return {
+            "count": self.count,
+            "total": self.total,
+            # None is the open bucket above the last bound
+            "buckets": [[le, n] for le, n in zip(bounds, self.counts)],
+        }
+
+
+class DaemonStats:
+    """Counters of every search a daemon served since it started"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        # Requests answered from the query cache
+        self.cache_hits = 0
+        # Handler key -> latency of the whole request, until the last frame was sent
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.search = SearchStats()
+
+    def add_request(
+        self,
+        handler_key: str,
+        seconds: float,
+        stats: Optional[SearchStats],
+        failed: bool,
+        cached: bool = False,
+    ):
+        with self.lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+            if cached:
+                self.cache_hits += 1
+            histogram = self.latencies.get(handler_key, None)
+            if histogram is None:
+                histogram = self.latencies[handler_key] = LatencyHistogram()
+            histogram.observe(seconds)
+        if stats is not None:
+            self.search.merge(stats)
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            res = {
+                "uptime": time.time() - self.started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "cache_hits": self.cache_hits,
+                "latency": {k: h.to_dict() for k, h in self.latencies.items()},
+            }
+        res.update(self.search.to_dict())
+        return res
@@ -0,0 +1,168 @@
+import os
+import pathlib
+import sqlite3
+from typing import Iterable, Optional
+
+from codesearch.git import content_hash
+from codesearch.handlers import Stamp
+from codesearch.logger import logger
+from codesearch.symbols import FileSymbols
+
+INDEX_DIRNAME = ".codesearch"
+INDEX_FILENAME = "index.db"
+# Under the git directory shared by every worktree of a repository
+BLOBS_DIRNAME = "codesearch"
+BLOBS_FILENAME = "blobs.db"
+# Bump whenever the layout of the tables below changes
+SCHEMA_VERSION = 2
+
+
+class IndexStore:
+    """
+    Persistent per-file symbol storage kept under the project root.
+
+    Every file is keyed by its path, mtime, size and content hash, so only files
+    that actually changed since the last run have to be parsed again.
+    """
+
+    db: sqlite3.Connection
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.db = sqlite3.connect(str(path))
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                extractor TEXT NOT NULL,
+                symbols BLOB NOT NULL
+            )
+            """
+        )
+
+    @classmethod
+    def open(cls, dir) -> "IndexStore":
+        index_dir = pathlib.Path(dir, INDEX_DIRNAME)
+        os.makedirs(index_dir, exist_ok=True)
+        return cls(index_dir / INDEX_FILENAME)
+
+    def lookup(self, f: pathlib.Path, extractor: str) -> Optional[FileSymbols]:
+        row = self.db.execute(
+            "SELECT mtime_ns, size, hash, extractor, symbols FROM files WHERE path = ?",
+            (str(f),),
+        ).fetchone()
+        if row is None:
+            return None
+        mtime_ns, size, fhash, fextractor, symbols = row
+        if fextractor != extractor:
+            return None
+        st = os.stat(f)
+        if st.st_mtime_ns == mtime_ns and st.st_size == size:
+            return FileSymbols.from_bytes(symbols)
+        # The file was touched, but its content might still be the same
+        with open(f, "rb") as bf:
+            data = bf.read()
+        if content_hash(data) != fhash:
+            return None
+        self.db.execute(
+            "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?",
+            (st.st_mtime_ns, st.st_size, str(f)),
+        )
+        return FileSymbols.from_bytes(symbols)
+
+    def save(self, f: pathlib.Path, extractor: str, symbols: FileSymbols, stamp: Stamp):
+        """`stamp` is the one of the content `symbols` were extracted from"""
+        mtime_ns, size, fhash = stamp
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (str(f), mtime_ns, size, fhash, extractor, symbols.to_bytes()),
+        )
+
+    def prune(self, files: Iterable[pathlib.Path]):
+        """Forget about every stored file that is not in `files`"""
+        keep = set(map(str, files))
+        stored = [row[0] for row in self.db.execute("SELECT path FROM files")]
+        removed = [(p,) for p in stored if p not in keep]
+        if len(removed) != 0:
+            logger.info(f"Removing {len(removed)} stale files from the index")
+            self.db.executemany("DELETE FROM files WHERE path = ?", removed)
+
+    def remove(self, files: Iterable[pathlib.Path]):
+        self.db.executemany(
+            "DELETE FROM files WHERE path = ?", [(str(f),) for f in files]
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class BlobStore:
+    """
+    Persistent symbols of git blobs, kept in the git directory of a
+    repository so that all its worktrees, branches and checkouts share
+    them: a file is only parsed once for every content it ever had.
+
+    Only holds symbols that depend on nothing but the content of a file.
+    """
+
+    db: sqlite3.Connection
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.db = sqlite3.connect(str(path))
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS blobs")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT NOT NULL,
+                extractor TEXT NOT NULL,
+                symbols BLOB NOT NULL,
+                PRIMARY KEY (hash, extractor)
+            )
+            """
+        )
+
+    @classmethod
+    def open(cls, dir) -> "BlobStore":
+        from codesearch.git import common_dir
+
+        blobs_dir = common_dir(dir) / BLOBS_DIRNAME
+        os.makedirs(blobs_dir, exist_ok=True)
+        return cls(blobs_dir / BLOBS_FILENAME)
+
+    def lookup(self, blob: str, extractor: str) -> Optional[FileSymbols]:
+        row = self.db.execute(
+            "SELECT symbols FROM blobs WHERE hash = ? AND extractor = ?",
+            (blob, extractor),
+        ).fetchone()
+        return FileSymbols.from_bytes(row[0]) if row is not None else None
+
+    def contains(self, blob: str, extractor: str) -> bool:
+        row = self.db.execute(
+            "SELECT 1 FROM blobs WHERE hash = ? AND extractor = ?", (blob, extractor)
+        ).fetchone()
+        return row is not None
+
+    def save(self, blob: str, extractor: str, symbols: FileSymbols):
+        self.db.execute(
+            "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+            (blob, extractor, symbols.to_bytes()),
+        )
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,117 @@
+import struct
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+from codesearch.entry import EntryKind
+
+HEADER = struct.Struct("<I")
+
+
+class Symbol:
+    __slots__ = ("kind", "name", "line", "col")
+
+    def __init__(self, kind: EntryKind, name: str, line: int, col: int):
+        self.kind = kind
+        self.name = name
+        self.line = line
+        self.col = col
+
+    def __repr__(self):
+        return f"Symbol({self.kind!s}, {self.name!r}, {self.line}, {self.col})"
+
+
+class FileSymbols:
+    """
+    Symbols extracted from a single file, stored column-wise.
+
+    Names are interned so that the same identifier used across many files is
+    kept in memory only once, and kinds/lines/cols live in flat arrays instead
+    of one Python object per symbol.
+    """
+
+    __slots__ = ("names", "kinds", "lines", "cols", "_by_name")
+
+    names: List[str]
+    kinds: array
+    lines: array
+    cols: array
+    _by_name: Optional[Dict[str, List[int]]]
+
+    def __init__(self):
+        self.names = []
+        self.kinds = array("B")
+        self.lines = array("I")
+        self.cols = array("I")
+        self._by_name = None
+
+    def by_name(self) -> Dict[str, List[int]]:
+        """
+        Inverted view of the file: every distinct name to the positions of its
+        symbols, in source order. Built on first use.
+        """
+        if self._by_name is None:
+            by_name: Dict[str, List[int]] = {}
+            for i, name in enumerate(self.names):
+                positions = by_name.get(name, None)
+                if positions is None:
+                    by_name[name] = [i]
+                else:
+                    positions.append(i)
+            self._by_name = by_name
+        return self._by_name
+
+    def add(self, kind: EntryKind, name: str, line: int, col: int):
+        self._by_name = None
+        self.names.append(sys.intern(name))
+        self.kinds.append(kind)
+        self.lines.append(line)
+        self.cols.append(col)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> Symbol:
+        return Symbol(
+            EntryKind(self.kinds[i]), self.names[i], self.lines[i], self.cols[i]
+        )
+
+    def __iter__(self) -> Iterator[Symbol]:
+        for i in range(len(self.names)):
+            yield self[i]
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        FileSymbols.__init__(self)
+        self._load(state)
+
+    def to_bytes(self) -> bytes:
+        return b"".join(
+            [
+                HEADER.pack(len(self.names)),
+                self.kinds.tobytes(),
+                self.lines.tobytes(),
+                self.cols.tobytes(),
+                "\0".join(self.names).encode("utf-8"),
+            ]
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "FileSymbols":
+        symbols = cls()
+        symbols._load(data)
+        return symbols
+
+    def _load(self, data: bytes):
+        (n,) = HEADER.unpack_from(data)
+        offset = HEADER.size
+        for column in (self.kinds, self.lines, self.cols):
+            size = n * column.itemsize
+            column.frombytes(data[offset : offset + size])
+            offset += size
+        if n != 0:
+            self.names = [
+                sys.intern(s) for s in data[offset:].decode("utf-8").split("\0")
+            ]
@@ -0,0 +1,150 @@
+import pathlib
+import re
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from codesearch.literals import exact_name, required_literals
+from codesearch.symbols import FileSymbols
+
+EMPTY: FrozenSet = frozenset()
+
+
+def trigrams(s: str) -> Set[str]:
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+def name_keys(name: str) -> Set[str]:
+    """
+    Posting list keys of a name: the trigrams of its lowercased form, or the
+    whole lowercased name when it is too short to have any
+    """
+    lowered = name.lower()
+    if len(lowered) < 3:
+        return {lowered}
+    return trigrams(lowered)
+
+
+def trigram_query(pattern) -> List[List[Set[str]]]:
+    """
+    Translates `pattern` into a conjunction of clauses, each one being a list
+    of alternative trigram sets. A name satisfies a clause when it contains
+    every trigram of at least one of the alternatives.
+    """
+    query = []
+    for clause in required_literals(pattern):
+        if any(len(lit) < 3 for lit in clause):
+            # Some alternative is too short to say anything about its trigrams
+            continue
+        query.append([trigrams(lit) for lit in clause])
+    return query
+
+
+class NameIndex:
+    """
+    Maps symbol names to the files defining them, with trigram posting lists
+    over the (lowercased) names. Names shorter than a trigram are posted under
+    themselves, so that `^id$` doesn't have to look at every name.
+
+    Posting sets are frozen once built. Updates produce a new NameIndex that
+    shares every untouched set with the old one, so readers holding the old
+    index are never affected.
+    """
+
+    files_by_name: Dict[str, FrozenSet[pathlib.Path]]
+    postings: Dict[str, FrozenSet[str]]
+
+    def __init__(self, files_by_name=None, postings=None):
+        self.files_by_name = files_by_name if files_by_name is not None else {}
+        self.postings = postings if postings is not None else {}
+
+    @classmethod
+    def build(cls, by_file: Dict[pathlib.Path, FileSymbols]) -> "NameIndex":
+        files_by_name = defaultdict(set)
+        for f, symbols in by_file.items():
+            for name in symbols.names:
+                files_by_name[name].add(f)
+        postings = defaultdict(set)
+        for name in files_by_name.keys():
+            for t in name_keys(name):
+                postings[t].add(name)
+        return cls(
+            {name: frozenset(fs) for name, fs in files_by_name.items()},
+            {t: frozenset(names) for t, names in postings.items()},
+        )
+
+    def updated(
+        self,
+        removed: Dict[pathlib.Path, FileSymbols],
+        added: Dict[pathlib.Path, FileSymbols],
+    ) -> "NameIndex":
+        """Returns a new index with `removed` files dropped and `added` files indexed"""
+        to_remove = defaultdict(set)
+        to_add = defaultdict(set)
+        for f, symbols in removed.items():
+            for name in symbols.names:
+                to_remove[name].add(f)
+        for f, symbols in added.items():
+            for name in symbols.names:
+                to_add[name].add(f)
+        files_by_name = dict(self.files_by_name)
+        new_postings = defaultdict(set)
+        for name in to_remove.keys() | to_add.keys():
+            current = files_by_name.get(name, None)
+            if current is None:
+                # Names are never removed from the posting lists, stale ones simply
+                # don't point to any file anymore
+                for t in name_keys(name):
+                    new_postings[t].add(name)
+                current = EMPTY
+            fs = (current - to_remove.get(name, EMPTY)) | to_add.get(name, EMPTY)
+            if len(fs) == 0:
+                del files_by_name[name]
+            else:
+                files_by_name[name] = frozenset(fs)
+        postings = self.postings
+        if len(new_postings) != 0:
+            postings = dict(postings)
+            for t, names in new_postings.items():
+                postings[t] = postings.get(t, EMPTY) | names
+        return NameIndex(files_by_name, postings)
+
+    def candidate_names(self, pattern) -> Optional[Iterable[str]]:
+        """
+        Names that might match `pattern`, or None when the pattern doesn't
+        require any trigram and every name is a candidate.
+        """
+        exact = exact_name(pattern)
+        if exact is not None and len(exact.lower()) < 3:
+            return self.postings.get(exact.lower(), EMPTY)
+        query = trigram_query(pattern)
+        if len(query) == 0:
+            return None
+        result: Optional[Set[str]] = None
+        for clause in query:
+            matched: Set[str] = set()
+            for alternative in clause:
+                sets = sorted(
+                    (self.postings.get(t, EMPTY) for t in alternative), key=len
+                )
+                matched |= sets[0].intersection(*sets[1:])
+            result = matched if result is None else result & matched
+            if len(result) == 0:
+                break
+        return result
+
+    def candidate_files(self, pattern) -> Optional[Set[pathlib.Path]]:
+        """
+        Files that define a name matching `pattern` case-insensitively, or None
+        when the trigram index can't narrow the search down.
+        """
+        names = self.candidate_names(pattern)
+        if names is None:
+            return None
+        files: Set[pathlib.Path] = set()
+        # Some handlers match case-insensitively
+        search = re.compile(pattern.pattern, pattern.flags | re.IGNORECASE).search
+        for name in names:
+            fs = self.files_by_name.get(name, None)
+            if fs is not None and search(name):
+                files |= fs
+        return files
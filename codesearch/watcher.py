@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Set, Tuple
+
+from codesearch.config import GITIGNORE, Config, FileFilter, determine_included_files
+from codesearch.logger import logger
+
+# Wait for this many seconds of silence before reporting a batch of changes
+DEBOUNCE_SECONDS = 0.2
+# ...but never hold changes back for longer than this
+MAX_DELAY_SECONDS = 2.0
+POLL_INTERVAL_SECONDS = 1.0
+
+
+@dataclass
+class FileChanges:
+    changed: Set[pathlib.Path] = field(default_factory=set)
+    # May also contain directories, in which case everything under them is gone
+    deleted: Set[pathlib.Path] = field(default_factory=set)
+    # Set when the watcher lost track of the tree and everything has to be re-checked
+    rescan: bool = False
+
+    def __bool__(self):
+        return self.rescan or len(self.changed) != 0 or len(self.deleted) != 0
+
+
+OnChange = Callable[[FileChanges], None]
+
+
+class Watcher(threading.Thread):
+    """
+    Base class for the file watchers.
+
+    Subclasses implement poll(), which waits for at most `timeout` seconds
+    and records what happened into `self.pending`. Batches are debounced and
+    handed over to `on_change` from the watcher thread.
+    """
+
+    def __init__(self, dir, config: Config, on_change: OnChange):
+        threading.Thread.__init__(self, name="codesearch-watcher", daemon=True)
+        self.dir = dir
+        self.config = config
+        self.filter = FileFilter(config, dir)
+        self.on_change = on_change
+        self.pending = FileChanges()
+        self.stopped = threading.Event()
+
+    def poll(self, timeout: float) -> bool:
+        """Returns whether any events were received"""
+        raise NotImplementedError
+
+    def _changed(self, p: pathlib.Path):
+        self.pending.deleted.discard(p)
+        self.pending.changed.add(p)
+
+    def _deleted(self, p: pathlib.Path):
+        self.pending.changed.discard(p)
+        self.pending.deleted.add(p)
+
+    def run(self):
+        first_event_at = None
+        last_event_at = None
+        while not self.stopped.is_set():
+            got_events = self.poll(DEBOUNCE_SECONDS)
+            now = time.monotonic()
+            if got_events:
+                last_event_at = now
+                if first_event_at is None:
+                    first_event_at = now
+            if first_event_at is None:
+                continue
+            quiet = now - last_event_at >= DEBOUNCE_SECONDS
+            overdue = now - first_event_at >= MAX_DELAY_SECONDS
+            if not (quiet or overdue):
+                continue
+            changes, self.pending = self.pending, FileChanges()
+            first_event_at = last_event_at = None
+            if not changes:
+                continue
+            try:
+                self.on_change(changes)
+            except Exception:
+                logger.exception("Failed to apply file changes")
+
+    def stop(self):
+        self.stopped.set()
+
+
+class PollingWatcher(Watcher):
+    """Portable watcher that periodically compares stat() snapshots of the tree"""
+
+    def __init__(self, dir, config: Config, on_change: OnChange):
+        Watcher.__init__(self, dir, config, on_change)
+        self.snapshot = self._take_snapshot()
+        self.next_scan_at = time.monotonic() + POLL_INTERVAL_SECONDS
+
+    def _take_snapshot(self) -> Dict[pathlib.Path, Tuple[int, int]]:
+        snapshot = {}
+        for f in determine_included_files(self.config, self.dir):
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+            snapshot[f] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self, timeout: float) -> bool:
+        wait = self.next_scan_at - time.monotonic()
+        if wait > 0:
+            self.stopped.wait(min(wait, timeout))
+            return False
+        self.next_scan_at = time.monotonic() + POLL_INTERVAL_SECONDS
+        snapshot = self._take_snapshot()
+        got_events = False
+        for f, stat in snapshot.items():
+            if self.snapshot.get(f) != stat:
+                self._changed(f)
+                got_events = True
+        for f in self.snapshot.keys() - snapshot.keys():
+            self._deleted(f)
+            got_events = True
+        self.snapshot = snapshot
+        return got_events
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class InotifyWatcher(Watcher):
+    """Linux watcher built on top of inotify, with one watch per directory"""
+
+    def __init__(self, dir, config: Config, on_change: OnChange, libc):
+        Watcher.__init__(self, dir, config, on_change)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.dirs: Dict[int, pathlib.Path] = {}
+        self._watch_tree(pathlib.Path(dir))
+
+    def _watch_tree(self, d: pathlib.Path, created: bool = False):
+        """
+        Watch `d` and all of its subdirectories. For directories that appeared
+        after we started, the files inside of them are reported as changed too.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), WATCH_MASK)
+        if wd < 0:
+            logger.warn(f'Unable to watch "{d}": {os.strerror(ctypes.get_errno())}')
+            return
+        self.dirs[wd] = d
+        try:
+            entries = list(os.scandir(d))
+        except FileNotFoundError:
+            return
+        for e in entries:
+            p = pathlib.Path(d, e.name)
+            is_dir = e.is_dir()
+            if self.filter.is_excluded(p, is_dir):
+                continue
+            if is_dir:
+                self._watch_tree(p, created)
+            elif created:
+                self._changed(p)
+
+    def poll(self, timeout: float) -> bool:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return False
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset : offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            self._handle_event(wd, mask, name)
+        return True
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warn("Too many file system events, rescanning the whole tree")
+            self.pending.rescan = True
+            return
+        d = self.dirs.get(wd, None)
+        if d is None:
+            return
+        if mask & IN_IGNORED:
+            del self.dirs[wd]
+            return
+        if mask & IN_DELETE_SELF or name == "":
+            return
+        if name == GITIGNORE:
+            # Can change which files are included anywhere below this directory
+            self.filter.invalidate()
+            self.pending.rescan = True
+            return
+        p = pathlib.Path(d, name)
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._deleted(p)
+        elif self.filter.is_excluded(p, bool(mask & IN_ISDIR)):
+            return
+        elif mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(p, created=True)
+        else:
+            self._changed(p)
+
+    def stop(self):
+        Watcher.stop(self)
+        # Also stopped when the daemon fails to start, before the thread ever ran
+        if self.is_alive():
+            self.join()
+        if self.fd != -1:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def create_watcher(dir, config: Config, on_change: OnChange) -> Watcher:
+    """Create the best watcher available on this platform"""
+    if sys.platform.startswith("linux"):
+        libc = _load_libc()
+        if libc is not None:
+            try:
+                return InotifyWatcher(dir, config, on_change, libc)
+            except OSError as e:
+                logger.warn(f"inotify is unavailable ({e}), falling back to polling")
+    return PollingWatcher(dir, config, on_change)
@@ -0,0 +1,3 @@
+#!/bin/bash
+export PYTHONPATH=$(pwd)
+python bench/bench.py $@
@@ -1,10 +1,57 @@
+import contextlib
+import io
+import json
+import logging
 import os
 import pathlib
+import pickle
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
 from unittest.mock import patch
 
 import pytest
 
 from codesearch import CodeSearch, Entry, EntryKind, InvalidDirectoryPath
+from codesearch.cli import main as cli_main
+from codesearch.cli import parse_queries, parse_search_args
+from codesearch.config import (
+    Config,
+    FileFilter,
+    construct_default_config_for_dir,
+    determine_included_files,
+    load_config,
+    merge_configs,
+)
+from codesearch.daemon import (
+    CodeSearchClient,
+    CodeSearchDaemon,
+    ConnectionClosed,
+    DaemonAddress,
+    Socket,
+)
+from codesearch.fuzzy import fuzzy_score
+from codesearch.git import GitError
+from codesearch.handlers import handler_for_file_type, symbol_cache
+from codesearch.handlers.python import PythonHandler
+from codesearch.literals import exact_name, required_literals
+from codesearch.output import write_search_results
+from codesearch.protocol import (
+    HEADER,
+    PROTOCOL_VERSION,
+    DaemonSearchReqMsg,
+    EndMessage,
+    ErrorMessage,
+    NetworkMessageType,
+    entries_frames,
+)
+from codesearch.stats import SearchStats, timed_iter
+from codesearch.symbols import FileSymbols
+from codesearch.watcher import FileChanges, PollingWatcher, create_watcher
 
 tests_root = os.path.dirname(os.path.realpath(__file__))
 
@@ -130,3 +177,1259 @@ def test_cpp_classes():
         ]
     )
     assert set(entries[k]) == expected_entries
+
+
+def copy_tree(name, dest):
+    shutil.copytree(pathlib.Path(tests_root, name), dest)
+    return dest
+
+
+def entry_keys(entries):
+    return set((e.name, e.line, e.col, e.kind) for e in entries)
+
+
+def test_persistent_index_reuses_unchanged_files(tmp_path):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    k = str(pytree / "main.py")
+    c = CodeSearch(dir=pytree, use_index=True)
+    expected = entry_keys(c.fun("some")[k])
+    assert (pytree / ".codesearch" / "index.db").exists()
+    with patch.object(PythonHandler, "index_file", side_effect=AssertionError):
+        c = CodeSearch(dir=pytree, use_index=True)
+        assert entry_keys(c.fun("some")[k]) == expected
+
+
+def test_persistent_index_reparses_changed_files(tmp_path):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    k = str(pytree / "main.py")
+    CodeSearch(dir=pytree, use_index=True)
+    with open(pytree / "main.py", "a") as f:
+        f.write("\ndef some_new_fun():\n    pass\n")
+    c = CodeSearch(dir=pytree, use_index=True)
+    assert "some_new_fun" in set(e.name for e in c.fun("some")[k])
+
+
+def test_persistent_index_keys_symbols_by_the_parsed_content(tmp_path):
+    (tmp_path / "mod.py").write_text("def old():\n    pass\n")
+    index_source = PythonHandler.index_source.__func__
+
+    def edit_while_parsing(cls, f, source):
+        # The file changes after it was read, before its symbols get stored
+        (tmp_path / "mod.py").write_text("def newer():\n    pass\n")
+        return index_source(cls, f, source)
+
+    with patch.object(PythonHandler, "index_source", classmethod(edit_while_parsing)):
+        c = CodeSearch(dir=tmp_path, use_index=True)
+    assert [e.name for e in c.fun(".")[str(tmp_path / "mod.py")]] == ["old"]
+    c = CodeSearch(dir=tmp_path, use_index=True)
+    assert [e.name for e in c.fun(".")[str(tmp_path / "mod.py")]] == ["newer"]
+
+
+def test_apply_changes_updates_index(tmp_path):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    c = CodeSearch(dir=pytree, use_index=True, persist_index=False)
+    snapshot = c.index
+    new_file = pytree / "other.py"
+    new_file.write_text("def some_other_fun():\n    pass\n")
+    (pytree / "main.py").unlink()
+    c.apply_changes(FileChanges(changed={new_file}, deleted={pytree / "main.py"}))
+    entries = c.fun("some")
+    assert set(entries.keys()) == {str(new_file)}
+    assert entry_keys(entries[str(new_file)]) == {
+        ("some_other_fun", 1, 0, EntryKind.Function)
+    }
+    # The old snapshot is left untouched
+    assert pytree / "main.py" in snapshot.by_file
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watcher_reports_changes(tmp_path, polling):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    received = []
+    config = load_config(pytree)
+    if polling:
+        watcher = PollingWatcher(pytree, config, received.append)
+    else:
+        watcher = create_watcher(pytree, config, received.append)
+    watcher.start()
+    try:
+        (pytree / "new.py").write_text("def f():\n    pass\n")
+        (pytree / "main.py").unlink()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            changes = FileChanges()
+            for batch in list(received):
+                changes.changed |= batch.changed
+                changes.deleted |= batch.deleted
+            if (
+                pytree / "new.py" in changes.changed
+                and pytree / "main.py" in changes.deleted
+            ):
+                break
+            time.sleep(0.1)
+        else:
+            pytest.fail(f"Changes were not reported: {received}")
+    finally:
+        watcher.stop()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watcher_stops_without_being_started(tmp_path, polling):
+    config = load_config(tmp_path)
+    if polling:
+        watcher = PollingWatcher(tmp_path, config, lambda changes: None)
+    else:
+        watcher = create_watcher(tmp_path, config, lambda changes: None)
+    watcher.stop()
+    # And more than once
+    watcher.stop()
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_parallel_search_matches_sequential(tmp_path, use_index):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    for i in range(20):
+        (pytree / f"mod{i}.py").write_text(f"def some_fun_{i}():\n    pass\n")
+    sequential = CodeSearch(dir=pytree, use_index=use_index, persist_index=False)
+    parallel = CodeSearch(dir=pytree, use_index=use_index, persist_index=False, jobs=4)
+    try:
+        expected = sequential.fun("some")
+        entries = parallel.fun("some")
+        assert list(entries.keys()) == list(expected.keys())
+        for k in expected:
+            assert entry_keys(entries[k]) == entry_keys(expected[k])
+    finally:
+        parallel.close()
+
+
+def test_file_symbols_roundtrip():
+    symbols = FileSymbols()
+    symbols.add(EntryKind.Function, "some_fun", 1, 0)
+    symbols.add(EntryKind.Class, "Manager", 16, 4)
+    for loaded in [
+        FileSymbols.from_bytes(symbols.to_bytes()),
+        pickle.loads(pickle.dumps(symbols)),
+    ]:
+        assert [(s.kind, s.name, s.line, s.col) for s in loaded] == [
+            (EntryKind.Function, "some_fun", 1, 0),
+            (EntryKind.Class, "Manager", 16, 4),
+        ]
+        # Names are shared with every other file using them
+        assert loaded.names[1] is symbols.names[1]
+    assert len(FileSymbols.from_bytes(FileSymbols().to_bytes())) == 0
+
+
+@pytest.mark.parametrize(
+    "pattern,clauses",
+    [
+        ("Manager", [{"manager"}]),
+        (
+            "^get_(user|group)s?$",
+            [{"get_user", "get_users", "get_group", "get_groups"}],
+        ),
+        ("foo.*bar", [{"foo"}, {"bar"}]),
+        ("(ab)?c", [{"c", "abc"}]),
+        ("a|b.*", [{"a", "b"}]),
+        ("a|.*", []),
+        (".*", []),
+    ],
+)
+def test_required_literals(pattern, clauses):
+    assert required_literals(pattern) == clauses
+
+
+@pytest.mark.parametrize(
+    "pattern, name",
+    [
+        ("^config$", "config"),
+        (r"\Aa\.b\Z", "a.b"),
+        ("^(?:id)$", "id"),
+        ("config", None),
+        ("^config", None),
+        ("^con.ig$", None),
+        ("^a|b$", None),
+        ("(?i)^config$", None),
+    ],
+)
+def test_exact_name(pattern, name):
+    assert exact_name(re.compile(pattern)) == name
+
+
+def test_trigram_index_skips_files_without_candidates(tmp_path):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    (pytree / "other.py").write_text("def unrelated():\n    pass\n")
+    c = CodeSearch(dir=pytree, use_index=True, persist_index=False)
+    visited = []
+    fun = PythonHandler.fun.__func__
+
+    def spy(cls, config, f, pattern, index=None):
+        visited.append(f)
+        return fun(cls, config, f, pattern, index=index)
+
+    with patch.object(PythonHandler, "fun", classmethod(spy)):
+        entries = c.fun("some_fun")
+    assert visited == [pytree / "main.py"]
+    assert entry_keys(entries[str(pytree / "main.py")]) == {
+        ("some_fun", 1, 0, EntryKind.Function)
+    }
+    # Names added later are found as well
+    (pytree / "new.py").write_text("def some_fun_too():\n    pass\n")
+    c.apply_changes(FileChanges(changed={pytree / "new.py"}))
+    assert set(c.fun("some_fun").keys()) == {
+        str(pytree / "main.py"),
+        str(pytree / "new.py"),
+    }
+
+
+def test_name_index_looks_up_short_exact_names(tmp_path):
+    (tmp_path / "a.py").write_text("def run(id):\n    return id\n")
+    (tmp_path / "b.py").write_text("def run(idx):\n    return idx\n")
+    (tmp_path / "c.py").write_text("def run(x):\n    return x\n")
+    c = CodeSearch(dir=tmp_path, use_index=True, persist_index=False)
+    visited = []
+    ref = PythonHandler.ref.__func__
+
+    def spy(cls, config, f, pattern, index=None):
+        visited.append(f)
+        return ref(cls, config, f, pattern, index=index)
+
+    with patch.object(PythonHandler, "ref", classmethod(spy)):
+        entries = c.ref("^id$")
+    # Too short for a trigram, the name is still looked up rather than every file searched
+    assert visited == [tmp_path / "a.py"]
+    assert [(e.name, e.line) for e in entries[str(tmp_path / "a.py")]] == [("id", 2)]
+    (tmp_path / "c.py").write_text("def run(ID):\n    return ID\n")
+    c.apply_changes(FileChanges(changed={tmp_path / "c.py"}))
+    found = {f for f, entries in c.ref("^ID$").items() if len(entries) != 0}
+    assert found == {str(tmp_path / "c.py")}
+
+
+def test_gitignore_semantics(tmp_path):
+    root = tmp_path / "tree"
+    for p in [
+        "main.py",
+        "keep.log",
+        "debug.log",
+        "out/out.py",
+        "src/out/gen.py",
+        "src/a.py",
+        "src/b.tmp.py",
+        "src/nested/c.py",
+        "src/nested/d.py",
+        "docs/x.py",
+        "node_modules/pkg/index.js",
+    ]:
+        (root / p).parent.mkdir(parents=True, exist_ok=True)
+        (root / p).write_text("")
+    (root / ".gitignore").write_text("*.log\n!keep.log\n/out/\n# comment\n")
+    (root / "src" / ".gitignore").write_text("*.tmp.py\nnested/*\n!nested/d.py\n")
+    config = merge_configs(
+        construct_default_config_for_dir(root), Config(exclude={"docs/"})
+    )
+    files = determine_included_files(config, root)
+    rel = set(str(f.relative_to(root)) for f in files)
+    assert rel == {
+        "main.py",
+        "keep.log",
+        "src/a.py",
+        "src/out/gen.py",
+        "src/nested/d.py",
+    }
+    # Paths are built the same way as the watcher builds them
+    assert pathlib.Path(root, "src", "a.py") in files
+    assert FileFilter(config, root).is_excluded(root / "src" / "x.tmp.py", False)
+    assert not FileFilter(config, root).is_excluded(
+        root / "src" / "nested" / "d.py", False
+    )
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_search_streams_and_stops_at_limit(tmp_path, jobs):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    for i in range(10):
+        (pytree / f"mod{i}.py").write_text(f"def some_fun_{i}():\n    pass\n")
+    c = CodeSearch(dir=pytree, jobs=jobs)
+    try:
+        full = list(c.search("fun", "some"))
+        assert sum(len(fentries) for _, fentries in full) == 12
+        limited = list(c.search("fun", "some", limit=3))
+        assert sum(len(fentries) for _, fentries in limited) == 3
+        # Results come in the same order, just cut short
+        assert [f for f, _ in limited] == [f for f, _ in full][: len(limited)]
+        assert len(limited) < len(full)
+    finally:
+        c.close()
+
+
+def test_protocol_streams_framed_entries():
+    a, b = socket.socketpair()
+    sender, receiver = Socket.from_socket(a), Socket.from_socket(b)
+    results = [
+        (
+            f"/tree/file{i}.py",
+            [
+                Entry(
+                    line=j,
+                    col=4,
+                    name=f"fun_{j}",
+                    kind=EntryKind.Function,
+                    match=(0, 3),
+                )
+                for j in range(1000)
+            ],
+        )
+        for i in range(10)
+    ]
+    frames = list(entries_frames(results))
+    assert len(frames) > 1
+
+    def send():
+        sender.send_msg(DaemonSearchReqMsg("fun", ["some"], limit=5))
+        for frame in frames:
+            sender.send_msg(frame)
+        sender.send_msg(EndMessage())
+
+    t = threading.Thread(target=send)
+    t.start()
+    req = receiver.read_msg()
+    assert (req.handler_key, req.params, req.limit) == ("fun", ["some"], 5)
+    received = []
+    while True:
+        msg = receiver.read_msg()
+        if isinstance(msg, EndMessage):
+            break
+        received.extend(msg.entries)
+    t.join()
+    assert [f for f, _ in received] == [f for f, _ in results]
+    for (_, got), (_, expected) in zip(received, results):
+        assert [(e.name, e.line, e.col, e.kind, e.match) for e in got] == [
+            (e.name, e.line, e.col, e.kind, e.match) for e in expected
+        ]
+    sender.close()
+    with pytest.raises(ConnectionClosed):
+        receiver.read_msg()
+
+
+DAEMON_TIMEOUT = 10
+
+
+@contextlib.contextmanager
+def running_daemon(tmp_path, root=None, **kwargs):
+    """Runs a daemon on a socket in tmp_path for the duration of the block"""
+    address = DaemonAddress(socket_path=str(tmp_path / "daemon.sock"))
+    d = CodeSearchDaemon(root, watch=False, address=address, **kwargs)
+    t = threading.Thread(target=d.run)
+    t.start()
+    try:
+        deadline = time.monotonic() + DAEMON_TIMEOUT
+        while not os.path.exists(address.socket_path):
+            if not t.is_alive() or time.monotonic() > deadline:
+                pytest.fail("The daemon didn't start")
+            time.sleep(0.01)
+        yield d
+    finally:
+        d.stop()
+        t.join(DAEMON_TIMEOUT)
+    assert not t.is_alive(), "The daemon didn't stop"
+
+
+def test_daemon_serves_concurrent_clients(tmp_path):
+    pytree = str(copy_tree("python-tree", tmp_path / "python-tree"))
+    with running_daemon(tmp_path, pytree) as d:
+        assert os.stat(d.address.socket_path).st_mode & 0o777 == 0o600
+
+        expected = {f: entry_keys(es) for f, es in CodeSearch(pytree).fun(".").items()}
+        results = {}
+
+        def query(i):
+            c = CodeSearchClient(pytree, False, address=d.address)
+            c.sock.send_msg(DaemonSearchReqMsg("fun", ["."]))
+            results[i] = {f: entry_keys(es) for f, es in c.results()}
+            # The connection can be reused for further queries
+            c.sock.send_msg(DaemonSearchReqMsg("fun", ["("]))
+            assert list(c.results()) == []
+            c.close()
+
+        clients = [threading.Thread(target=query, args=(i,)) for i in range(4)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        assert len(results) == 4
+        assert all(r == expected for r in results.values())
+    assert not os.path.exists(d.address.socket_path)
+
+
+def test_daemon_serves_several_projects(tmp_path):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    jstree = copy_tree("js-tree", tmp_path / "js-tree")
+    # Too small for more than one project at a time
+    with running_daemon(tmp_path, memory_budget=1) as d:
+        for tree in [pytree, jstree, pytree]:
+            c = CodeSearchClient(str(tree), False, address=d.address)
+            c.sock.send_msg(DaemonSearchReqMsg("fun", ["."], root=c.root))
+            files = [f for f, _ in c.results()]
+            c.close()
+            assert len(files) != 0
+            assert all(f.startswith(str(tree)) for f in files)
+            assert d.projects.roots() == [os.path.realpath(tree)]
+
+
+def test_daemon_reports_stats(tmp_path):
+    pytree = str(copy_tree("python-tree", tmp_path / "python-tree"))
+    with running_daemon(tmp_path, pytree) as d:
+        c = CodeSearchClient(pytree, False, address=d.address)
+        assert len(list(c.search("fun", "."))) != 0
+        assert list(c.search("fun", "(")) == []
+        stats = c.stats()
+        c.close()
+    assert stats["requests"] == 2
+    assert stats["errors"] == 1
+    latency = stats["latency"]["fun"]
+    assert latency["count"] == 2
+    assert sum(n for _, n in latency["buckets"]) == 2
+    assert stats["files_searched"] != 0
+    assert {"load", "search"} <= set(stats["phases"])
+    assert list(stats["projects"]) == [os.path.realpath(pytree)]
+
+
+def test_daemon_rejects_malformed_requests(tmp_path):
+    pytree = str(copy_tree("python-tree", tmp_path / "python-tree"))
+    with running_daemon(tmp_path, pytree) as d:
+        for payload in [
+            b"{not json",
+            b'{"handler_key": "rm", "params": ["."]}',
+            b'{"handler_key": "fun", "params": ["."], "extra": 1}',
+            b'{"params": ["."]}',
+            b'{"handler_key": "fun", "params": [1]}',
+        ]:
+            c = CodeSearchClient(pytree, False, address=d.address)
+            c.sock.sock.sendall(
+                HEADER.pack(
+                    PROTOCOL_VERSION, NetworkMessageType.DAEMON_SEARCH, len(payload)
+                )
+                + payload
+            )
+            assert isinstance(c.sock.read_msg(), ErrorMessage)
+            assert isinstance(c.sock.read_msg(), EndMessage)
+            with pytest.raises(ConnectionClosed):
+                c.sock.read_msg()
+            c.close()
+        c = CodeSearchClient(pytree, False, address=d.address)
+        with patch.object(CodeSearch, "search", side_effect=RuntimeError("boom")):
+            c.sock.send_msg(DaemonSearchReqMsg("fun", ["."], root=c.root))
+            msg = c.sock.read_msg()
+            assert isinstance(msg, ErrorMessage) and "boom" in msg.error
+            assert isinstance(c.sock.read_msg(), EndMessage)
+        # The connection is still good
+        assert len(list(c.search("fun", "."))) != 0
+        c.close()
+
+
+def test_daemon_stops_with_clients_connected(tmp_path, caplog):
+    pytree = str(copy_tree("python-tree", tmp_path / "python-tree"))
+    # Stopped at the end of the block, with both clients still connected
+    with running_daemon(tmp_path, pytree) as d:
+        idle = CodeSearchClient(pytree, False, address=d.address)
+        assert len(list(idle.search("fun", "."))) != 0
+        # Never reads its results
+        busy = CodeSearchClient(pytree, False, address=d.address)
+        busy.sock.send_msg(DaemonSearchReqMsg("ref", ["."], root=busy.root))
+        time.sleep(0.1)
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    idle.close()
+    busy.close()
+
+
+def test_daemon_caches_queries_until_the_index_changes(tmp_path):
+    (tmp_path / "mod.py").write_text("def load():\n    pass\n")
+    with running_daemon(tmp_path, str(tmp_path)) as d:
+        c = CodeSearchClient(str(tmp_path), False, address=d.address)
+
+        def names(pattern, limit=None):
+            return [
+                e.name for _, es in c.search("fun", pattern, limit=limit) for e in es
+            ]
+
+        assert names("lo") == ["load"]
+        assert names("lo") == ["load"]
+        assert names("lo", limit=1) == ["load"]
+        assert c.stats()["cache_hits"] == 1
+
+        (tmp_path / "mod.py").write_text(
+            "def load():\n    pass\ndef lock():\n    pass\n"
+        )
+        d.projects.get(str(tmp_path)).apply_changes(
+            FileChanges(changed={tmp_path / "mod.py"})
+        )
+        assert names("lo") == ["load", "lock"]
+        assert names("lo") == ["load", "lock"]
+        assert c.stats()["cache_hits"] == 2
+        c.close()
+
+
+@pytest.mark.parametrize("mmap_threshold", [0, 1 << 20])
+def test_prefilter_skips_parsing_files_without_literals(tmp_path, mmap_threshold):
+    (tmp_path / "a.py").write_text("def load_Config():\n    pass\n")
+    (tmp_path / "b.py").write_text("def other():\n    pass\n")
+    c = CodeSearch(dir=tmp_path)
+    parsed = []
+    index_file = PythonHandler.index_file.__func__
+
+    def record(cls, f):
+        parsed.append(pathlib.Path(f).name)
+        return index_file(cls, f)
+
+    with patch("codesearch.prefilter.MMAP_THRESHOLD", mmap_threshold), patch.object(
+        PythonHandler, "index_file", classmethod(record)
+    ):
+        entries = c.fun("load_(c|C)onfig")
+    assert parsed == ["a.py"]
+    assert [e.name for e in entries[str(tmp_path / "a.py")]] == ["load_Config"]
+
+
+# Cumulative import time of codesearch.cli, in microseconds
+STARTUP_IMPORT_BUDGET_US = 250_000
+
+
+def test_cli_search_startup_skips_unneeded_modules():
+    # Everything that is only needed by the daemon, parallel or indexed
+    # searches and other languages must stay out of a plain search
+    script = """
+import sys
+from codesearch import cli
+sys.argv = ["csr", "fun", "some", "--dir", sys.argv[1]]
+cli.main()
+print(",".join(sorted(sys.modules)))
+"""
+    res = subprocess.run(
+        [sys.executable, "-c", script, os.path.join(tests_root, "python-tree")],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(tests_root),
+    )
+    modules = set(res.stdout.strip().splitlines()[-1].split(","))
+    assert "codesearch.handlers.python" in modules
+    for heavy in [
+        "fire",
+        "asyncio",
+        "multiprocessing",
+        "concurrent.futures.process",
+        "sqlite3",
+        "ctypes",
+        "esprima",
+        "cpp_handler",
+        "codesearch.daemon",
+        "codesearch.watcher",
+    ]:
+        assert heavy not in modules
+
+
+def test_cli_import_time_budget():
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import codesearch.cli"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(tests_root),
+    )
+    # "import time: self [us] | cumulative [us] | module", for every import
+    cumulative = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in res.stderr.splitlines()
+        if line.startswith("import time:") and line.split("|")[1].strip().isdigit()
+    }
+    # About 50ms on a laptop, several times that means something heavy is back
+    assert cumulative["codesearch.cli"] < STARTUP_IMPORT_BUDGET_US
+
+
+@pytest.mark.parametrize(
+    "argv,expected",
+    [
+        (["fun", "x"], ({}, "fun", "x")),
+        (
+            ["--index", "ref", "x", "--first"],
+            ({"index": True, "first": True}, "ref", "x"),
+        ),
+        (
+            ["cls", "x", "--jobs=4", "--noindex"],
+            ({"jobs": 4, "index": False}, "cls", "x"),
+        ),
+        (["fun", "x", "--dir", "src"], ({"dir": "src"}, "fun", "x")),
+        (
+            ["fun", "x", "--stats", "--profile", "out.prof"],
+            ({"stats": True, "profile": "out.prof"}, "fun", "x"),
+        ),
+        (
+            ["ref", "x", "--format", "jsonl", "--nocolor"],
+            ({"format": "jsonl", "color": False}, "ref", "x"),
+        ),
+        (["find", "gus", "--limit", "5"], ({"limit": 5}, "find", "gus")),
+        (["daemon"], None),
+        (["fun", "-h"], None),
+        (["fun", "x", "--unknown"], None),
+        (["fun", "x", "--limit"], None),
+    ],
+)
+def test_parse_search_args(argv, expected):
+    assert parse_search_args(argv) == expected
+
+
+def test_python_nested_definitions(tmp_path):
+    (tmp_path / "mod.py").write_text(
+        "class Outer:\n"
+        "    class Inner:\n"
+        "        def method(self):\n"
+        "            helper()\n"
+        "\n"
+        "    async def load(self):\n"
+        "        def parse():\n"
+        "            pass\n"
+        "        return parse()\n"
+    )
+    c = CodeSearch(dir=tmp_path)
+    k = str(tmp_path / "mod.py")
+    assert [(e.name, e.line, e.col) for e in c.fun(".")[k]] == [
+        ("Outer.Inner.method", 3, 8),
+        ("Outer.load", 6, 4),
+        ("Outer.load.parse", 7, 8),
+    ]
+    assert [e.name for e in c.cls(".")[k]] == ["Outer", "Outer.Inner"]
+    assert [e.name for e in c.ref(".")[k]] == ["helper", "parse"]
+    # Qualified names don't appear in the source, they must get past the prefilter
+    assert [e.name for e in c.fun("Outer\\.load$")[k]] == ["Outer.load"]
+
+
+def test_symbols_are_extracted_once_for_every_query_kind(tmp_path):
+    (tmp_path / "mod.py").write_text("class A:\n    def f(self):\n        g()\n")
+    c = CodeSearch(dir=tmp_path)
+    index_file = PythonHandler.index_file.__func__
+    calls = []
+
+    def record(cls, f):
+        calls.append(f)
+        return index_file(cls, f)
+
+    with patch.object(PythonHandler, "index_file", classmethod(record)):
+        c.fun("f")
+        c.cls("A")
+        c.ref("g")
+        assert len(calls) == 1
+        (tmp_path / "mod.py").write_text("class A:\n    def f(self):\n        gg()\n")
+        os.utime(tmp_path / "mod.py", ns=(0, 0))
+        assert [e.name for e in c.ref("g")[str(tmp_path / "mod.py")]] == ["gg"]
+        assert len(calls) == 2
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_reference_search(tmp_path, use_index):
+    (tmp_path / "a.py").write_text(
+        "import config\n"
+        "def run(x=config.load()):\n"
+        "    return x.config.items()[0].config\n"
+    )
+    (tmp_path / "b.js").write_text(
+        "function configure(config) {\n  return config.get(config);\n}\n"
+    )
+    (tmp_path / "c.js").write_text("configure();\n")
+    c = CodeSearch(dir=tmp_path, use_index=use_index, persist_index=False)
+    # Like definitions, references are found by searching the pattern in the names
+    assert [e.name for e in c.ref("config")[str(tmp_path / "c.js")]] == ["configure"]
+    entries = c.ref("^config$")
+    assert not entries[str(tmp_path / "c.js")]
+    assert [(e.line, e.col, e.kind) for e in entries[str(tmp_path / "a.py")]] == [
+        (1, 7, EntryKind.Reference),
+        (2, 10, EntryKind.Reference),
+        (3, 13, EntryKind.Reference),
+        (3, 31, EntryKind.Reference),
+    ]
+    # The declaration of the parameter counts as an occurrence in JS
+    assert [(e.line, e.col) for e in entries[str(tmp_path / "b.js")]] == [
+        (1, 19),
+        (2, 9),
+        (2, 20),
+    ]
+
+
+FAST_SCAN_SOURCE = '''\
+"""
+class NotADefinition:
+    pass
+"""
+class A:
+    x = "def nor_this(): \'\'\'"
+
+    @property
+    def f(self):
+        return """
+def still_a_string():
+"""
+
+    async def g(self):
+        pass
+
+if True:
+    def h():
+        return (
+1)
+    # A comment at any indentation doesn't close a body
+class B(A): pass
+def i(): pass
+'''
+
+
+def test_fast_mode_matches_parsed_definitions(tmp_path):
+    copy_tree("python-tree", tmp_path / "tree")
+    (tmp_path / "tree" / "tricky.py").write_text(FAST_SCAN_SOURCE)
+    precise = CodeSearch(dir=tmp_path / "tree")
+    fast = CodeSearch(dir=tmp_path / "tree", fast=True)
+    for query in (fast.fun, fast.cls):
+        expected = getattr(precise, query.__name__)(".")
+        found = query(".")
+        assert found.keys() == expected.keys()
+        for k in expected:
+            assert entry_keys(found[k]) == entry_keys(expected[k])
+    k = str(tmp_path / "tree" / "tricky.py")
+    assert [e.name for e in fast.fun(".")[k]] == ["A.f", "A.g", "h", "i"]
+    # Reference searches are answered by the parser
+    assert entry_keys(fast.ref(".")[k]) == entry_keys(precise.ref(".")[k])
+    # Indexes always hold the parsed symbols
+    assert not CodeSearch(dir=tmp_path / "tree", use_index=True, fast=True).config.fast
+
+
+# Strings the fast scan has to skip, from CPython's test_grammar and test_tokenize
+FAST_SCAN_STRINGS = (
+    "class Grammar:\n"
+    "    def test_strings(self):\n"
+    "        y = '\\n\\\n"
+    "The \\'lazy\\' \"dog\".\\n\\\n"
+    "'\n"
+    '        z = "a\\\n'
+    "def not_a_function():\\\n"
+    '"\n'
+    '        x = rf"hello \\{True}"; y = f"hello \\\\{True}"\n'
+    "        return x, y, z\n"
+    "\n"
+    "    def test_continuation(self):\n"
+    "        return 1 + \\\n"
+    "2\n"
+    "\n"
+    "    def test_quotes(self):\n"
+    "        return \"'''\", '\"\"\"', '', \"it's\", b'\\'', r'\\''\n"
+    "\n"
+    "    def test_tokenize(self):\n"
+    "        check('\"a\\\n"
+    "de\\\n"
+    'fg"\', """\\\n'
+    "    STRING\n"
+    '""")\n'
+    "\n"
+    "class After:\n"
+    "    def method(self):\n"
+    "        pass\n"
+)
+
+
+def test_fast_mode_skips_strings_over_several_lines(tmp_path):
+    (tmp_path / "mod.py").write_text(FAST_SCAN_STRINGS)
+    precise = CodeSearch(dir=tmp_path)
+    fast = CodeSearch(dir=tmp_path, fast=True)
+    k = str(tmp_path / "mod.py")
+    assert entry_keys(fast.fun(".")[k]) == entry_keys(precise.fun(".")[k])
+    assert [e.name for e in fast.fun(".")[k]] == [
+        "Grammar.test_strings",
+        "Grammar.test_continuation",
+        "Grammar.test_quotes",
+        "Grammar.test_tokenize",
+        "After.method",
+    ]
+
+
+def test_fast_mode_tolerates_syntax_errors(tmp_path):
+    (tmp_path / "mod.py").write_text(
+        "class A:\n    def f(self):\n        return [\n\ndef g(:\n"
+    )
+    c = CodeSearch(dir=tmp_path, fast=True)
+    k = str(tmp_path / "mod.py")
+    assert [(e.name, e.line, e.col) for e in c.fun(".")[k]] == [
+        ("A.f", 2, 4),
+        ("g", 5, 0),
+    ]
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_unparsable_files_are_skipped(tmp_path, use_index, jobs):
+    (tmp_path / "a.py").write_text("def ok():\n    return ok\n")
+    (tmp_path / "b.py").write_text("def broken(:\n")
+    (tmp_path / "c.js").write_text("function broken( {\n")
+    c = CodeSearch(tmp_path, use_index=use_index, persist_index=False, jobs=jobs)
+    try:
+        for kind, expected in [("fun", ["ok"]), ("ref", ["ok"]), ("find", ["ok"])]:
+            assert [e.name for _, es in c.search(kind, "ok") for e in es] == expected
+        assert [len(r) for r in c.search_many([("fun", "."), ("ref", ".")])] == [1, 1]
+    finally:
+        c.close()
+
+
+def test_cpp_compile_commands_and_reparse(tmp_path):
+    pytest.importorskip("cpp_handler")
+    (tmp_path / "a.cpp").write_text("#ifdef EXTRA\nvoid extra();\n#endif\n")
+    (tmp_path / "compile_commands.json").write_text(
+        f'[{{"directory": "{tmp_path}", "file": "a.cpp",'
+        f' "command": "c++ -DEXTRA -c a.cpp -o a.o"}}]'
+    )
+    c = CodeSearch(dir=tmp_path, use_index=True, persist_index=False)
+    k = str(tmp_path / "a.cpp")
+    # The macro is only defined by the compilation database
+    assert [e.name for e in c.fun("extra")[k]] == ["extra"]
+    (tmp_path / "a.cpp").write_text(
+        "#ifdef EXTRA\nvoid extra();\n#endif\nvoid added();\n"
+    )
+    c.apply_changes(FileChanges(changed={tmp_path / "a.cpp"}))
+    assert [e.name for e in c.fun("added")[k]] == ["added"]
+
+
+def test_cpp_indexing_parses_a_file_once(tmp_path):
+    cpp_handler = pytest.importorskip("cpp_handler")
+    from codesearch.handlers.cpp import CppHandler
+
+    f = tmp_path / "a.cpp"
+    f.write_text("struct Point { int x; };\nint norm(Point p) { return p.x; }\n")
+    parses = cpp_handler.parse_count()
+    symbols = CppHandler.index_file(f)
+    assert cpp_handler.parse_count() == parses + 1
+    assert {(s.kind, s.name) for s in symbols} >= {
+        (EntryKind.Class, "Point"),
+        (EntryKind.Function, "norm"),
+        (EntryKind.Reference, "x"),
+    }
+    # Unchanged, the cached unit is used as is
+    CppHandler.index_file(f)
+    assert cpp_handler.parse_count() == parses + 1
+    f.write_text("struct Point { int x, y; };\nint norm(Point p) { return p.y; }\n")
+    assert "y" in {s.name for s in CppHandler.index_file(f)}
+    assert cpp_handler.parse_count() == parses + 2
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_cpp_batch_search_keeps_file_order(tmp_path, jobs):
+    pytest.importorskip("cpp_handler")
+    for i in range(3):
+        (tmp_path / f"m{i}.cpp").write_text(f"int shared();\nint only_{i}();\n")
+        (tmp_path / f"m{i}.py").write_text("def shared():\n    pass\n")
+    c = CodeSearch(dir=tmp_path, jobs=jobs)
+    pattern = re.compile("shared|only")
+    # What searching every file on its own gives
+    expected = [
+        (str(f), list(handler_for_file_type(f).fun(c.config, f, pattern)))
+        for f in c.files
+    ]
+    assert [pathlib.Path(f).suffix for f, _ in expected] == [".cpp", ".py"] * 3
+    assert list(c.search("fun", pattern.pattern)) == expected
+    assert list(c.search("fun", pattern.pattern, limit=3)) == [
+        expected[0],
+        expected[1],
+    ]
+    c.close()
+
+
+JS_SCAN_SOURCE = """\
+import { a } from "b";
+// function notADefinition() {}
+const s = `class NotAClass { ${"}"} }`;
+const re = /function notThis\\(\\) {/g;
+export class Widget extends Base {
+  static create({ size = {} } = {}) {
+    return new Widget();
+  }
+  async render() {
+    if (this.ready) {
+      helper();
+    }
+  }
+}
+export const makeWidget = async (options) => new Widget(options);
+export default function build() {
+  function inner() {}
+}
+const notAFunction = (1 + 2);
+module.exports.Other = class Other {};
+"""
+
+
+def test_js_fast_mode_matches_parsed_declarations(tmp_path):
+    (tmp_path / "mod.js").write_text(JS_SCAN_SOURCE)
+    k = str(tmp_path / "mod.js")
+    precise = CodeSearch(dir=tmp_path)
+    fast = CodeSearch(dir=tmp_path, fast=True)
+    assert [e.name for e in fast.fun(".")[k]] == [
+        "Widget.create",
+        "Widget.render",
+        "makeWidget",
+        "build",
+    ]
+    assert [e.name for e in fast.cls(".")[k]] == ["Widget"]
+    for query in ("fun", "cls", "ref"):
+        assert entry_keys(getattr(fast, query)(".")[k]) == entry_keys(
+            getattr(precise, query)(".")[k]
+        )
+
+
+def test_js_fast_mode_reads_typescript(tmp_path):
+    (tmp_path / "mod.ts").write_text(
+        "export abstract class Store<T> implements Base {\n"
+        "  private items: T[] = [];\n"
+        "  public get<K extends keyof T>(key: K): T[K] | undefined {\n"
+        "    return undefined;\n"
+        "  }\n"
+        "}\n"
+        "export const select = <T,>(store: Store<T>): T[] => [];\n"
+        "export function reset(store?: Store<unknown>): void {}\n"
+    )
+    c = CodeSearch(dir=tmp_path, fast=True)
+    k = str(tmp_path / "mod.ts")
+    assert [(e.name, e.line, e.col) for e in c.fun(".")[k]] == [
+        ("Store.get", 3, 9),
+        ("select", 7, 13),
+        ("reset", 8, 16),
+    ]
+    assert [e.name for e in c.cls(".")[k]] == ["Store"]
+
+
+def test_bench_corpus_is_reproducible(tmp_path):
+    from bench.bench import compare_results, run_benchmarks
+    from bench.corpus import CorpusSpec, corpus_files, generate
+
+    spec = CorpusSpec(files=12, mix={"py": 2, "js": 1}, seed=3)
+
+    def read_all(root):
+        return {
+            str(f.relative_to(root)): f.read_text()
+            for files in corpus_files(root).values()
+            for f in files
+        }
+
+    first = read_all(generate(tmp_path / "a", spec))
+    assert len(first) == 12
+    assert first == read_all(generate(tmp_path / "b", spec))
+    c = CodeSearch(dir=tmp_path / "a")
+    # The generated build/ directory is gitignored
+    assert not any(
+        (tmp_path / "a" / "build") in f.parents for f in map(pathlib.Path, c.files)
+    )
+    assert sum(len(e) for e in c.fun(".").values()) > 0
+
+    results = run_benchmarks(str(tmp_path / "a"), spec, repeat=1, daemon=False)
+    metrics = results["metrics"]
+    assert {
+        "startup",
+        "walk",
+        "index.build",
+        "parse.py",
+        "query.ref.literal.index",
+    } <= set(metrics)
+    slower = {
+        "meta": results["meta"],
+        "metrics": {
+            name: {**m, "median": m["median"] * 2 + 1} for name, m in metrics.items()
+        },
+    }
+    assert compare_results(results, results, 0.2) == []
+    assert set(compare_results(results, slower, 0.2)) == set(metrics)
+
+
+def test_search_stats(tmp_path):
+    (tmp_path / "a.py").write_text("def load_config():\n    pass\n")
+    (tmp_path / "b.py").write_text("def other():\n    pass\n")
+    (tmp_path / "c.js").write_text("function loadConfig() {}\n")
+    stats = SearchStats(slowest=2)
+    c = CodeSearch(dir=tmp_path, stats=stats)
+    results = timed_iter(stats, c.search("fun", "load"), "search", "output")
+    assert [pathlib.Path(f).name for f, _ in results] == ["a.py", "c.js"]
+    assert list(stats.phases) == ["config", "walk", "search", "output"]
+    # b.py doesn't contain "load" and isn't parsed
+    assert (stats.files_searched, stats.files_skipped) == (2, 1)
+    assert {ext: n for ext, (n, _) in stats.extensions.items()} == {
+        ".py": 1,
+        ".js": 1,
+    }
+    assert len(stats.slowest) == 2
+    report = stats.report()
+    assert "2 searched, 1 skipped" in report
+    assert str(tmp_path / "a.py") in report
+
+    c = CodeSearch(dir=tmp_path, use_index=True, persist_index=False, stats=stats)
+    assert stats.extensions[".py"][0] == 3
+    list(c.search("fun", "other"))
+    assert "index" in stats.phases
+    assert stats.files_searched == 3
+
+
+def test_search_stats_count_files_skipped_in_workers(tmp_path):
+    for i in range(8):
+        name = "load_config" if i % 2 == 0 else "other"
+        (tmp_path / f"m{i}.py").write_text(f"def {name}():\n    pass\n")
+    stats = SearchStats()
+    c = CodeSearch(dir=tmp_path, jobs=2, stats=stats)
+    try:
+        assert len(list(c.search("fun", "load"))) == 4
+    finally:
+        c.close()
+    assert (stats.files_searched, stats.files_skipped) == (4, 4)
+
+
+def test_output_formats():
+    results = [
+        ("a\tb.py", [Entry(3, EntryKind.Function, "load_all", col=4, match=(0, 4))]),
+        ("empty.py", []),
+        ("c.js", [Entry(1, EntryKind.Reference, 'we"ird', match=None)]),
+    ]
+
+    def write(format, color=None):
+        out = io.StringIO()
+        assert write_search_results(iter(results), format, color, out) == 2
+        return out.getvalue()
+
+    # Not a terminal, so no colors unless asked for
+    assert write("text") == (
+        'a\tb.py\n\tFun [3:4]: load_all\nc.js\n\tRef [1:0]: we"ird\n'
+    )
+    assert "\033[93mload\033[0m_all" in write("text", color=True)
+    lines = [json.loads(line) for line in write("jsonl").splitlines()]
+    assert lines == [
+        {
+            "file": "a\tb.py",
+            "line": 3,
+            "col": 4,
+            "kind": "Fun",
+            "name": "load_all",
+            "match": [0, 4],
+        },
+        {
+            "file": "c.js",
+            "line": 1,
+            "col": 0,
+            "kind": "Ref",
+            "name": 'we"ird',
+            "match": [0, 0],
+        },
+    ]
+    assert write("tsv") == (
+        'a\\tb.py\t3\t4\tFun\tload_all\t0\t4\nc.js\t1\t0\tRef\twe"ird\t0\t0\n'
+    )
+    assert write("null") == ""
+    out = io.StringIO()
+    write_search_results({}, "text", out=out)
+    assert out.getvalue() == "Nothing found\n"
+    with pytest.raises(ValueError):
+        write_search_results({}, "xml")
+
+
+def test_fuzzy_score():
+    assert fuzzy_score("gus", "args") is None
+    assert fuzzy_score("gus", "get_user_settings")[1] == (0, 6)
+    ranked = sorted(
+        ["debug_using", "getUserSettings", "gus", "gusto", "argus"],
+        key=lambda name: fuzzy_score("gus", name)[0],
+        reverse=True,
+    )
+    assert ranked == ["gus", "gusto", "getUserSettings", "argus", "debug_using"]
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_find_keeps_best_matches(tmp_path, use_index):
+    (tmp_path / "deep" / "er").mkdir(parents=True)
+    source = (
+        "class UserStore:\n"
+        "    def get_user(self):\n"
+        "        pass\n"
+        "def gus():\n"
+        "    get_user()\n"
+        "def debug_using():\n"
+        "    pass\n"
+    )
+    (tmp_path / "a.py").write_text(source)
+    (tmp_path / "deep" / "er" / "b.py").write_text(source)
+    (tmp_path / "c.js").write_text("function getUserSettings() {}\n")
+    c = CodeSearch(dir=tmp_path, use_index=use_index, persist_index=False)
+    results = [(pathlib.Path(f).name, e.name) for _, f, e in c.find("gus", 4)]
+    # Shallower files first among equal names, references never show up
+    assert results == [
+        ("a.py", "gus"),
+        ("b.py", "gus"),
+        ("c.js", "getUserSettings"),
+        ("a.py", "UserStore.get_user"),
+    ]
+    assert [e.name for _, es in c.search("find", "usrstr", limit=1) for e in es] == [
+        "UserStore"
+    ]
+
+
+def test_daemon_keeps_the_ranking_of_find(tmp_path):
+    (tmp_path / "a.py").write_text(
+        "def mgr():\n    pass\nclass Manager:\n    pass\n"
+        "def make_group_report():\n    pass\n"
+    )
+    (tmp_path / "b.py").write_text("def mgr_b():\n    pass\n")
+    expected = [
+        (f, entry_keys(es)) for f, es in CodeSearch(tmp_path).search("find", "mgr")
+    ]
+    # Files come up several times, interleaved with others
+    assert [pathlib.Path(f).name for f, _ in expected] == [
+        "a.py",
+        "b.py",
+        "a.py",
+        "a.py",
+    ]
+    with running_daemon(tmp_path, str(tmp_path)) as d:
+        c = CodeSearchClient(str(tmp_path), False, address=d.address)
+        # The second one is answered from the query cache
+        for _ in range(2):
+            results = [(f, entry_keys(es)) for f, es in c.search("find", "mgr")]
+            assert results == expected
+        [batch] = c.search_many([("find", "mgr")])
+        assert [(f, entry_keys(es)) for f, es in batch] == expected
+        c.close()
+
+
+QUERIES = [("fun", "main"), ("cls", "."), ("ref", "Manager"), ("fun", "^no_such")]
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+@pytest.mark.parametrize("fast", [False, True])
+def test_search_many_matches_single_searches(tmp_path, use_index, fast):
+    pytree = copy_tree("python-tree", tmp_path / "python-tree")
+    c = CodeSearch(pytree, use_index=use_index, persist_index=False, fast=fast)
+    expected = [
+        [(f, entry_keys(es)) for f, es in c.search(kind, pattern, limit=2)]
+        for kind, pattern in QUERIES
+    ]
+    results = c.search_many(QUERIES, limit=2)
+    assert [[(f, entry_keys(es)) for f, es in r] for r in results] == expected
+    assert any(len(r) != 0 for r in expected[2])
+
+
+def test_daemon_answers_query_batches(tmp_path):
+    pytree = str(copy_tree("python-tree", tmp_path / "python-tree"))
+    with running_daemon(tmp_path, pytree) as d:
+        c = CodeSearchClient(pytree, False, address=d.address)
+        results = c.search_many(QUERIES)
+        # One error for the whole batch, still ended once per query
+        assert c.search_many([("fun", "("), ("cls", ".")]) == [[], []]
+        assert len(list(c.search("cls", "."))) != 0
+        c.close()
+    expected = CodeSearch(pytree).search_many(QUERIES)
+    assert [[(f, entry_keys(es)) for f, es in r] for r in results] == [
+        [(f, entry_keys(es)) for f, es in r] for r in expected
+    ]
+
+
+def test_parse_queries():
+    lines = ["# Definitions", "fun  ^load_", "", "ref Manager ", "find usrstr"]
+    assert parse_queries(lines) == [
+        ("fun", "^load_"),
+        ("ref", "Manager"),
+        ("find", "usrstr"),
+    ]
+    with pytest.raises(ValueError, match="Line 2"):
+        parse_queries(["fun x", "grep x"])
+
+
+def git_commit(repo, message="commit"):
+    for args in (["init", "-q"], ["add", "-A"], ["commit", "-q", "-m", message]):
+        if args[0] == "init" and (repo / ".git").exists():
+            continue
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+            cwd=repo,
+            check=True,
+        )
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_git_file_listing_and_blob_symbols(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / ".gitignore").write_text("generated.py\n")
+    (tmp_path / "a.py").write_text("def first():\n    pass\n")
+    (tmp_path / "sub" / "b.py").write_text("def shared():\n    pass\n")
+    (tmp_path / "sub" / "c.py").write_text("def shared():\n    pass\n")
+    git_commit(tmp_path)
+    (tmp_path / "a.py").write_text("def second():\n    pass\n")
+    (tmp_path / "untracked.py").write_text("def untracked():\n    pass\n")
+    (tmp_path / "generated.py").write_text("def generated():\n    pass\n")
+
+    def names(c, kind="fun"):
+        return sorted(e.name for es in c.search(kind, ".") for e in es[1])
+
+    symbol_cache.clear()
+    parsed = []
+    index_file = PythonHandler.index_file.__func__
+
+    def record(cls, f):
+        parsed.append(pathlib.Path(f).name)
+        return index_file(cls, f)
+
+    with patch.object(PythonHandler, "index_file", classmethod(record)):
+        c = CodeSearch(tmp_path, git=True)
+        assert names(c) == ["second", "shared", "shared"]
+    # Modified files are keyed by path, identical unmodified ones share a parse
+    assert sorted(parsed) == ["a.py", "b.py"]
+    assert set(c.blobs) == {tmp_path / "sub" / "b.py", tmp_path / "sub" / "c.py"}
+    c = CodeSearch(tmp_path, untracked=True)
+    assert names(c) == ["second", "shared", "shared", "untracked"]
+
+    # Commits are read out of git, whatever the working tree looks like
+    (tmp_path / "sub" / "c.py").unlink()
+    c = CodeSearch(tmp_path, commit="HEAD")
+    assert names(c) == ["first", "shared", "shared"]
+    assert (tmp_path / ".git" / "codesearch" / "blobs.db").exists()
+    assert not (tmp_path / ".codesearch").exists()
+    symbol_cache.clear()
+    with patch.object(PythonHandler, "index_source", side_effect=AssertionError):
+        c = CodeSearch(tmp_path / "sub", commit="HEAD")
+        assert [pathlib.Path(f).name for f in c.files] == ["b.py", "c.py"]
+        assert names(c) == ["shared", "shared"]
+    with pytest.raises(GitError, match="Unknown commit"):
+        CodeSearch(tmp_path, commit="no-such-branch")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_cli_reports_errors_in_one_line(tmp_path, capsys):
+    (tmp_path / "repo").mkdir()
+    (tmp_path / "repo" / "a.py").write_text("def f():\n    pass\n")
+    git_commit(tmp_path / "repo")
+    repo = str(tmp_path / "repo")
+    (tmp_path / "queries.txt").write_text("fun f\ngrep f\n")
+    for argv, error in [
+        (["fun", "f", "--commit", "nope", "--dir", repo], 'Unknown commit "nope"'),
+        # Not a repository
+        (["fun", "f", "--commit", "HEAD", "--dir", str(tmp_path)], "Unknown commit"),
+        (["fun", "f", "--dir", str(tmp_path / "missing")], "Invalid directory path"),
+        (["fun", "(", "--dir", repo], "Invalid pattern: missing )"),
+        (["fun", "f", "--format", "xml", "--dir", repo], 'Unknown format "xml"'),
+        (["fun", "f", "--client", "--git", "--dir", repo], "The daemon searches"),
+        (["batch", str(tmp_path / "queries.txt"), "--dir", repo], "Line 2"),
+    ]:
+        with patch.object(sys, "argv", ["csr", *argv]):
+            assert cli_main() == 1
+        out, err = capsys.readouterr()
+        assert out == ""
+        assert err.startswith(f"csr: {error}") and err.count("\n") == 1
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+@pytest.mark.parametrize("use_index", [False, True])
+def test_git_modes_skip_unparsable_blobs(tmp_path, use_index):
+    (tmp_path / "a.py").write_text("def ok():\n    return ok\n")
+    (tmp_path / "b.py").write_text("def broken(:\n")
+    (tmp_path / "c.js").write_text("function broken( {\n")
+    git_commit(tmp_path)
+    symbol_cache.clear()
+    for c in [
+        CodeSearch(tmp_path, git=True, use_index=use_index, persist_index=False),
+        CodeSearch(tmp_path, commit="HEAD", persist_index=use_index),
+    ]:
+        for kind in ("fun", "ref", "find"):
+            assert [e.name for _, es in c.search(kind, "ok") for e in es] == ["ok"]